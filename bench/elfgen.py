@@ -0,0 +1,187 @@
+'''
+Generates synthetic ET_EXEC ELF files for benchmarking.
+
+The generated files are well formed enough for Botox to load and patch, but
+are not meant to be run: the code is all zeros. Their size, section count,
+symbol count and segment alignment can each be varied independently.
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from botox.elf import ELF, Elf_Layout
+
+# Size of the (all zero) code section
+TEXT_SIZE = 4096
+
+# Lowest virtual address the file will be loaded at
+BASE_ADDRESS = 0x400000
+
+def _align(value, alignment):
+    return (value + alignment - 1) & ~(alignment - 1)
+
+def _pack(record, elf64, endianess, **values):
+    '''
+    Packs a record with its Elf_Layout. Fields which aren't specified are zero.
+    '''
+    layout = Elf_Layout.get(record, elf64, endianess)
+    return layout.struct.pack(*[values.get(name, 0) for name in layout.names])
+
+def generate(path, machine, elfclass, encoding, size=64*1024, sections=16, align=0x1000, symbols=64):
+    '''
+    Writes a synthetic ELF executable.
+
+    @path     - The file to write.
+    @machine  - The e_machine value (ELF.EM_XXX).
+    @elfclass - The ELF class (ELF.ELFCLASS32 or ELF.ELFCLASS64).
+    @encoding - The ELF data encoding (ELF.ELFDATA2LSB or ELF.ELFDATA2MSB).
+    @size     - The approximate file size; the bulk of the file is a sparse data segment.
+    @sections - The number of section headers, including the NULL section.
+    @align    - The p_align value of the load segments.
+    @symbols  - The number of function symbols in .symtab.
+
+    Returns a dictionary describing the generated file.
+    '''
+    elf64 = (elfclass == ELF.ELFCLASS64)
+    if encoding == ELF.ELFDATA2MSB:
+        endianess = ">"
+    else:
+        endianess = "<"
+
+    ehdr_size = Elf_Layout.get("ehdr", elf64, endianess).size
+    phdr_size = Elf_Layout.get("phdr", elf64, endianess).size
+    shdr_size = Elf_Layout.get("shdr", elf64, endianess).size
+    sym_size = Elf_Layout.get("sym", elf64, endianess).size
+
+    base = _align(max(BASE_ADDRESS, align), align)
+
+    # Fixed sections: NULL, .text, .symtab, .strtab, .shstrtab; everything
+    # else is a filler section covering a slice of the data segment.
+    sections = max(sections, 5)
+    fillers = sections - 5
+
+    # Code segment: ELF header, program headers and .text
+    text_offset = _align(ehdr_size + (2 * phdr_size), 16)
+    text_end = text_offset + TEXT_SIZE
+    entry = base + text_offset
+
+    # Data segment, starting on the next alignment boundary
+    data_offset = _align(text_end, align)
+    data_size = max(0, size - data_offset)
+    data_address = base + data_offset + align
+
+    # Symbol and string tables
+    strtab = "\x00"
+    symtab = _pack("sym", elf64, endianess)
+    for n in range(0, symbols):
+        if n == 0:
+            name = "main"
+        else:
+            name = "function_%d" % n
+        symtab += _pack("sym", elf64, endianess,
+                        st_name=len(strtab),
+                        st_value=entry + ((n * 16) % TEXT_SIZE),
+                        st_size=16,
+                        st_info=(1 << 4) | ELF.STT_FUNC,
+                        st_shndx=1)
+        strtab += name + "\x00"
+
+    names = [""] + [".text"] + [".data.%d" % n for n in range(0, fillers)] + [".symtab", ".strtab", ".shstrtab"]
+    shstrtab = "\x00"
+    name_offsets = []
+    for name in names:
+        if name:
+            name_offsets.append(len(shstrtab))
+            shstrtab += name + "\x00"
+        else:
+            name_offsets.append(0)
+
+    symtab_offset = _align(data_offset + data_size, 8)
+    strtab_offset = symtab_offset + len(symtab)
+    shstrtab_offset = strtab_offset + len(strtab)
+    shoff = _align(shstrtab_offset + len(shstrtab), 8)
+
+    symtab_index = sections - 3
+    shstrndx = sections - 1
+
+    # Section headers
+    shdrs = []
+    if sections >= ELF.SHN_LORESERVE:
+        shdrs.append(_pack("shdr", elf64, endianess, sh_size=sections, sh_link=shstrndx))
+    else:
+        shdrs.append(_pack("shdr", elf64, endianess))
+    shdrs.append(_pack("shdr", elf64, endianess, sh_name=name_offsets[1], sh_type=1,
+                       sh_flags=ELF.SHF_ALLOC | ELF.SHF_EXECINSTR, sh_addr=entry,
+                       sh_offset=text_offset, sh_size=TEXT_SIZE, sh_addralign=16))
+    chunk = (data_size / fillers) if fillers else 0
+    for n in range(0, fillers):
+        shdrs.append(_pack("shdr", elf64, endianess, sh_name=name_offsets[2+n], sh_type=1,
+                           sh_flags=ELF.SHF_ALLOC | ELF.SHF_WRITE, sh_addr=data_address + (n * chunk),
+                           sh_offset=data_offset + (n * chunk), sh_size=chunk, sh_addralign=1))
+    shdrs.append(_pack("shdr", elf64, endianess, sh_name=name_offsets[symtab_index], sh_type=ELF.SHT_SYMTAB,
+                       sh_offset=symtab_offset, sh_size=len(symtab), sh_link=symtab_index + 1,
+                       sh_info=1, sh_addralign=8, sh_entsize=sym_size))
+    shdrs.append(_pack("shdr", elf64, endianess, sh_name=name_offsets[symtab_index+1], sh_type=3,
+                       sh_offset=strtab_offset, sh_size=len(strtab), sh_addralign=1))
+    shdrs.append(_pack("shdr", elf64, endianess, sh_name=name_offsets[shstrndx], sh_type=3,
+                       sh_offset=shstrtab_offset, sh_size=len(shstrtab), sh_addralign=1))
+
+    # ELF header and program headers
+    ident = "\x7FELF" + chr(elfclass) + chr(encoding) + "\x01" + ("\x00" * 9)
+    ehdr = ident + _pack("ehdr", elf64, endianess,
+                         e_type=ELF.ET_EXEC, e_machine=machine, e_version=1, e_entry=entry,
+                         e_phoff=ehdr_size, e_shoff=shoff, e_ehsize=ehdr_size,
+                         e_phentsize=phdr_size, e_phnum=2, e_shentsize=shdr_size,
+                         e_shnum=(0 if sections >= ELF.SHN_LORESERVE else sections),
+                         e_shstrndx=(ELF.SHN_XINDEX if shstrndx >= ELF.SHN_LORESERVE else shstrndx))[16:]
+    phdrs = _pack("phdr", elf64, endianess, p_type=ELF.PT_LOAD, p_flags=0b101, p_offset=0,
+                  p_vaddr=base, p_paddr=base, p_filesz=text_end, p_memsz=text_end, p_align=align)
+    phdrs += _pack("phdr", elf64, endianess, p_type=ELF.PT_LOAD, p_flags=0b110, p_offset=data_offset,
+                   p_vaddr=data_address, p_paddr=data_address, p_filesz=data_size, p_memsz=data_size, p_align=align)
+
+    with open(path, "wb") as fp:
+        fp.write(ehdr)
+        fp.write(phdrs)
+
+        # The code and data are left as holes
+        fp.seek(symtab_offset)
+        fp.write(symtab)
+        fp.write(strtab)
+        fp.write(shstrtab)
+
+        fp.seek(shoff)
+        fp.write("".join(shdrs))
+
+    return {
+            "path"      : path,
+            "size"      : os.path.getsize(path),
+            "sections"  : sections,
+            "symbols"   : symbols,
+            "align"     : align,
+            "entry"     : entry,
+           }
+
+if __name__ == "__main__":
+    import argparse
+
+    machines = {"x86" : (ELF.EM_386, ELF.ELFCLASS32), "x86_64" : (ELF.EM_X86_64, ELF.ELFCLASS64),
+                "mips" : (ELF.EM_MIPS, ELF.ELFCLASS32), "arm" : (ELF.EM_ARM, ELF.ELFCLASS32)}
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic ELF executable.")
+    parser.add_argument("output", metavar="FILE", help="output file")
+    parser.add_argument("--machine", choices=sorted(machines.keys()), default="x86_64", help="target architecture")
+    parser.add_argument("--big-endian", action="store_true", default=False, help="generate a big endian file")
+    parser.add_argument("--size", type=int, default=64*1024, help="approximate file size, in bytes")
+    parser.add_argument("--sections", type=int, default=16, help="number of sections")
+    parser.add_argument("--align", type=lambda value: int(value, 0), default=0x1000, help="segment alignment")
+    parser.add_argument("--symbols", type=int, default=64, help="number of symbols")
+    args = parser.parse_args()
+
+    (machine, elfclass) = machines[args.machine]
+    if args.big_endian == True:
+        encoding = ELF.ELFDATA2MSB
+    else:
+        encoding = ELF.ELFDATA2LSB
+
+    print generate(args.output, machine, elfclass, encoding, args.size, args.sections, args.align, args.symbols)
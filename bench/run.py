@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+'''
+Benchmarks ELF loading, header iteration, payload generation and end to end
+patching against synthetic ELF files (see elfgen.py), for every registered
+architecture, ELF class and endianess.
+
+Each case is measured in a fresh worker process, so that peak RSS and I/O
+counters aren't polluted by other cases. Results are written as JSON.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import itertools
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import elfgen
+from botox import Botox, architecture
+from botox.elf import ELF
+
+# Version of the results file format
+RESULTS_VERSION = 2
+
+def parse_size(value):
+    '''
+    Parses a size with an optional K/M/G suffix.
+    '''
+    units = {"K" : 1024, "M" : 1024 * 1024, "G" : 1024 * 1024 * 1024}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value, 0)
+
+def parse_list(value, parser=int):
+    return [parser(item) for item in value.split(",") if item.strip()]
+
+def io_counters():
+    '''
+    Returns this process's I/O counters from /proc/self/io, or None if they aren't available.
+    '''
+    try:
+        with open("/proc/self/io") as fp:
+            return dict((key, int(value)) for (key, value) in [line.split(":") for line in fp if ":" in line])
+    except (IOError, OSError, ValueError):
+        return None
+
+def io_overhead(samples=10):
+    '''
+    Measures the I/O counted against a pair of io_counters() calls themselves, as
+    the smallest difference between back to back calls.
+
+    Returns a dictionary of counter overheads, or None if the counters aren't available.
+    '''
+    overhead = None
+    for n in range(0, samples):
+        before = io_counters()
+        after = io_counters()
+        if before is None or after is None:
+            return None
+
+        delta = dict((key, after[key] - before[key]) for key in after)
+        if overhead is None:
+            overhead = delta
+        else:
+            overhead = dict((key, min(overhead[key], delta[key])) for key in overhead)
+
+    return overhead
+
+def measure(function, repeat, setup=None):
+    '''
+    Runs function repeat times, recording wall clock time and I/O counters, less
+    the I/O done by reading the counters.
+
+    @function - The function to time.
+    @repeat   - The number of times to run it.
+    @setup    - An optional function which is run (untimed) before each run;
+                its return value is passed to function.
+
+    Returns a dictionary of results.
+    '''
+    times = []
+    syscr = 0
+    syscw = 0
+    rchar = 0
+    wchar = 0
+    overhead = io_overhead()
+    counted = (overhead is not None)
+
+    for n in range(0, repeat):
+        argument = None
+        if setup is not None:
+            argument = setup()
+
+        before = io_counters()
+        start = time.time()
+        if setup is None:
+            function()
+        else:
+            function(argument)
+        times.append(time.time() - start)
+        after = io_counters()
+
+        if before is None or after is None:
+            counted = False
+        else:
+            syscr += max(after["syscr"] - before["syscr"] - overhead["syscr"], 0)
+            syscw += max(after["syscw"] - before["syscw"] - overhead["syscw"], 0)
+            rchar += max(after["rchar"] - before["rchar"] - overhead["rchar"], 0)
+            wchar += max(after["wchar"] - before["wchar"] - overhead["wchar"], 0)
+
+    results = {
+                "min"   : min(times),
+                "mean"  : sum(times) / len(times),
+                "max"   : max(times),
+              }
+
+    # Per run averages. /proc/self/io only counts read and write family system
+    # calls (read, pread, readv, etc; write, pwrite, writev, etc) and the bytes
+    # they transfer, not mmap, lseek, fallocate or any other system calls.
+    if counted == True:
+        results.update({
+                        "read_calls"        : syscr / repeat,
+                        "write_calls"       : syscw / repeat,
+                        "bytes_read"        : rchar / repeat,
+                        "bytes_written"     : wchar / repeat,
+                       })
+
+    return results
+
+def worker(case):
+    '''
+    Runs the benchmarks for a single generated file.
+
+    @case - Dictionary describing the case; see cases().
+
+    Returns a dictionary of results.
+    '''
+    path = case["path"]
+    repeat = case["repeat"]
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results = {}
+
+    def load():
+        with ELF(path, read_only=True, cache_headers=True) as elf:
+            pass
+    results["load"] = measure(load, repeat)
+
+    def iterate():
+        with ELF(path, read_only=True, cache_headers=True) as elf:
+            for phdr in elf.program_headers:
+                phdr.unpack()
+            for shdr in elf.section_headers:
+                shdr.unpack()
+                shdr.name
+    results["iterate"] = measure(iterate, repeat)
+
+    arch = architecture.lookup(case["machine"], case["class"], case["encoding"])
+
+    def payload_cold():
+        architecture._templates = architecture.LRUCache(architecture.TEMPLATE_CACHE_SIZE)
+        arch(case["encoding"]).payload(case["entry"])
+    results["payload_cold"] = measure(payload_cold, repeat)
+
+    def payload_warm():
+        for n in range(0, 1000):
+            arch(case["encoding"]).payload(case["entry"])
+    results["payload_warm_x1000"] = measure(payload_warm, repeat)
+
+    copy = path + ".patched"
+    def copy_file():
+        shutil.copyfile(path, copy)
+        return copy
+    def patch(target):
+        Botox(target).patch()
+    results["patch"] = measure(patch, repeat, setup=copy_file)
+    os.unlink(copy)
+
+    results["baseline_rss_kb"] = baseline_rss
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return results
+
+def cases(args, workdir):
+    '''
+    Generates the benchmark files.
+
+    Yields a dictionary describing each case.
+    '''
+    keys = sorted(architecture.REGISTRY.keys())
+
+    for ((machine, elfclass, encoding), size, sections, align) in itertools.product(keys, args.sizes, args.sections, args.align):
+        name = architecture.REGISTRY[(machine, elfclass, encoding)].__name__
+        if args.arch and name not in args.arch:
+            continue
+
+        if encoding == ELF.ELFDATA2MSB:
+            endianess = "big"
+        else:
+            endianess = "little"
+
+        path = os.path.join(workdir, "%s-%d-%s-%d-%d-%x.elf" % (name, elfclass, endianess, size, sections, align))
+        generated = elfgen.generate(path, machine, elfclass, encoding, size=size, sections=sections, align=align, symbols=args.symbols)
+
+        yield {
+                "arch"          : name,
+                "machine"       : machine,
+                "class"         : elfclass,
+                "encoding"      : encoding,
+                "endianess"     : endianess,
+                "requested_size": size,
+                "size"          : generated["size"],
+                "sections"      : sections,
+                "symbols"       : args.symbols,
+                "align"         : align,
+                "entry"         : generated["entry"],
+                "path"          : path,
+                "repeat"        : args.repeat,
+              }
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the Botox benchmarks.")
+    parser.add_argument("-o", "--output", metavar="FILE", default="bench-results.json", help="write results to FILE (default: %(default)s)")
+    parser.add_argument("--sizes", type=lambda value: parse_list(value, parse_size), default=[64*1024, 4*1024*1024], help="comma separated file sizes, e.g. 64K,16M,1G")
+    parser.add_argument("--sections", type=parse_list, default=[10, 1000], help="comma separated section counts, e.g. 10,1000,100000")
+    parser.add_argument("--align", type=lambda value: parse_list(value, lambda item: int(item, 0)), default=[0x1000, 0x10000], help="comma separated p_align values")
+    parser.add_argument("--symbols", type=int, default=64, help="number of symbols per file")
+    parser.add_argument("--arch", type=lambda value: value.split(","), default=None, help="comma separated Architecture class names to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement")
+    parser.add_argument("--workdir", default=None, help="directory to generate files in (default: a temporary directory)")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print json.dumps(worker(json.loads(args.worker)))
+        return 0
+
+    if args.workdir is None:
+        workdir = tempfile.mkdtemp(prefix="botox-bench-")
+    else:
+        workdir = args.workdir
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+
+    results = []
+    try:
+        for case in cases(args, workdir):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(case)])
+            os.unlink(case["path"])
+
+            case = dict(case)
+            del case["path"]
+            case["results"] = json.loads(output)
+            results.append(case)
+
+            sys.stderr.write("%-8s %d %-6s %10d bytes %6d sections align 0x%-6X load %.4fs patch %.4fs rss %dKB\n" %
+                             (case["arch"], case["class"], case["endianess"], case["size"], case["sections"], case["align"],
+                              case["results"]["load"]["mean"], case["results"]["patch"]["mean"], case["results"]["peak_rss_kb"]))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, True)
+
+    with open(args.output, "w") as fp:
+        json.dump({
+                    "version"   : RESULTS_VERSION,
+                    "timestamp" : time.time(),
+                    "python"    : platform.python_version(),
+                    "platform"  : platform.platform(),
+                    "results"   : results,
+                  }, fp, indent=4, sort_keys=True)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
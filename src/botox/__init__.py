@@ -1,81 +1,229 @@
+import os
 import sys
+import json
 import struct
+import logging
+import tempfile
 
+import stream
+import placement
 import architecture
 from elf import ELF
+from plan import PatchPlan
+from stats import Stats
 from exceptions import BotoxException
 
+__version__ = "0.1b"
+
+logger = logging.getLogger("botox")
+
+# Payload placements; see Botox.plan()
+INSERT = "insert"
+CAVE = "cave"
+APPEND = "append"
+PLACEMENTS = [INSERT, CAVE, APPEND]
+
+# Padding of inserted payloads; see Botox.plan()
+ALIGN = "align"
+PAGE = "page"
+PADDINGS = [ALIGN, PAGE]
+
+def _log_to_stderr():
+    '''
+    Sends the botox logger's debug messages to stderr, for verbose mode.
+
+    Returns None.
+    '''
+    for handler in logger.handlers:
+        if getattr(handler, "botox_verbose", False) == True:
+            return None
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.botox_verbose = True
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
 class Botox(object):
 
-    def __init__(self, elfile, verbose=False):
+    def __init__(self, elfile, verbose=False, stats=None, architectures=None, store=None):
         '''
         Class constructor.
 
-        @elfile  - Path to the target ELF file to patch.
-        @verbose - Set to True to enable verbose debug print statements.
+        @elfile  - Path to the target ELF file to patch (may be None if only patch_bytes() is used).
+        @verbose - Set to True to print the botox logger's debug messages to stderr.
+        @stats   - An instance of stats.Stats to record timings and I/O counters in.
+                   If not specified, a new one is created; see self.stats.
+        @architectures - Dictionary of Architecture instances to reuse, keyed by (e_machine,
+                         ei_class, ei_encoding). Share one between Botox instances to keep
+                         each architecture's assembler warm across files.
+        @store   - An instance of store.PatchStore to look patched files up in (and add them to),
+                   or None. Files patched before with the same options (and the same version of
+                   botox) are emitted from the store without being parsed.
 
         Returns None.
         '''
         self.elfile = elfile
         self.verbose = verbose
+        self.store = store
+
+        if architectures is None:
+            architectures = {}
+        self.architectures = architectures
 
-    def _resolve_architecture(self, machine_type):
+        if stats is None:
+            stats = Stats()
+        self.stats = stats
+
+        if True == self.verbose:
+            _log_to_stderr()
+
+    def _resolve_architecture(self, machine_type, elf_class, endianess):
         '''
         Returns a subclass of architecture.Architecture that corresponds
         to the target ELF's architecture.
 
         @machine_type - The e_machine value from the ELF header.
+        @elf_class    - The e_ident.ei_class value from the ELF header.
+        @endianess    - The e_ident.ei_encoding value from the ELF header.
 
         Returns a subclass of architecture.Architecture on success.
         Returns None on failure.
         '''
-        # Loop through all the attributes in the architecture.py module
-        # and find the Architecture subclass that matches the target
-        # ELF's machine type.
-        for attribute_name in dir(architecture):
-            try:
-                try:
-                    attribute = getattr(architecture, attribute_name)
-                except AttributeError as e:
-                    continue
-
-                if issubclass(attribute, architecture.Architecture):
-                    if attribute.MACHINE == machine_type:
-                        return attribute
-            except TypeError as e:
-                continue
+        return architecture.lookup(machine_type, elf_class, endianess)
 
-        return None
+    def patch(self, payload=None, output=None, target=None, placement=INSERT, padding=ALIGN, page_size=None):
+        '''
+        Injects the supplied payload into the target ELF file.
+        The entry point will be modified to point to the injected code.
 
-    def _debug_print(self, msg):
+        @payload   - The payload to inject into the ELF file.
+                     If no payload is provided, the default pause payload will be used.
+        @output    - Path to write the patched ELF file to. If not specified, the target
+                     ELF file is modified in place.
+        @target    - Name of a symbol (e.g., "main") to pause at instead of the entry point.
+                     Only supported with the default pause payload.
+        @placement - Where to put the payload; one of PLACEMENTS (see plan()).
+        @padding   - How to pad an inserted payload; one of PADDINGS (see plan()).
+        @page_size - The target's page size; defaults to the architecture's (see plan()).
+
+        Returns the new entry point address (or, if target was specified, the address of the
+        code the symbol now branches to) on success.
+        Returns None on failure, or (more likely) raises an exception.
         '''
-        For internal debug use.
+        if self.store is None:
+            return self.apply(self.plan(payload, target, placement, padding, page_size=page_size), output)
 
-        @msg - Message to print to stderr, if self.verbose is True.
+        if output is None:
+            output = self.elfile
 
-        Returns None.
-        '''
-        if True == self.verbose:
-            sys.stderr.write(msg + "\n")
+        import store
+        with self.stats.phase("store lookup"):
+            key = store.hash_file(self.elfile, self._store_prefix(payload, target, placement, padding, page_size))
+            metadata = self.store.get(key)
+
+        if metadata is not None:
+            with self.stats.phase("store emit"):
+                method = self.store.emit(key, output, mode=(os.stat(self.elfile).st_mode & 07777))
+            logger.debug("Emitted %s from the patch store (%s)", output, method)
+            self._log_patched(output)
+            return metadata["entry_point"]
+
+        entry_point = self.apply(self.plan(payload, target, placement, padding, page_size=page_size), output)
 
-    def patch(self, payload=None):
+        with self.stats.phase("store add"):
+            self.store.put(key, output, {"entry_point" : entry_point})
+
+        return entry_point
+
+    def _store_prefix(self, payload, target, placement, padding, page_size):
         '''
-        Injects the supplied payload into the target ELF file.
-        The entry point will be modified to point to the injected code.
+        Returns the string hashed ahead of an ELF file's contents to get its key in
+        self.store: everything other than the file itself that the patch depends on.
+        '''
+        if payload is None:
+            payload_kind = "pause"
+        else:
+            import store
+            payload_kind = "sha256:" + store.hash_bytes(payload)
 
-        @payload - The payload to inject into the ELF file.
-                   If no payload is provided, the default pause payload will be used.
+        return json.dumps([__version__, payload_kind, target, placement, padding, page_size]) + "\x00"
 
-        Returns the new entry point address on success.
-        Returns None on failure, or (more likely) raises an exception.
+    def plan(self, payload=None, target=None, placement=INSERT, padding=ALIGN, data=None, page_size=None):
         '''
-        alignment_size = None
-        load_segment_size = None
-        load_segment_offset = None
-        load_segment_virtual_base_address = None
+        Works out how to inject the supplied payload into the target ELF file.
+        The target ELF file is only read, never modified.
+
+        The payload can be placed:
+
+            o INSERT - In a block of p_align bytes (or a multiple of p_align, for large payloads)
+                       inserted after the first executable load segment.
+            o CAVE   - In an unused run of zero bytes in (or just after) the first executable load
+                       segment, so that the file doesn't grow; see placement.find_cave().
+            o APPEND - At the end of the file, mapped by a spare program header (PT_NOTE) which
+                       is turned into a new executable load segment. Nothing in the file moves.
+
+        Inserted payloads are padded to:
+
+            o ALIGN - A multiple of the load segment's p_align, as the ELF specification requires
+                      (or of the page size, if that is larger).
+            o PAGE  - A multiple of the page size, which is all the kernel needs to map the
+                      segments after the payload. This keeps files with a large p_align (e.g.,
+                      0x200000 on x86_64) from growing by megabytes; the p_align of any load
+                      segment which is no longer aligned to it is reduced to the page size,
+                      and never below it.
+
+        Either way, the zeros padding the payload are left as holes in the file where
+        the file system supports it.
+
+        @payload   - The payload to inject into the ELF file.
+                     If no payload is provided, the default pause payload will be used.
+        @target    - Name of a symbol (e.g., "main") to pause at instead of the entry point.
+                     Only supported with the default pause payload.
+        @placement - Where to put the payload; one of PLACEMENTS.
+        @padding   - How to pad an inserted payload; one of PADDINGS.
+        @data      - The contents of the ELF file to plan for, instead of the target ELF file.
+        @page_size - The page size of the system the ELF file will run on. Defaults to the
+                     largest page size used on the file's architecture; see Architecture.PAGE_SIZE.
+
+        Returns a PatchPlan on success.
+        Raises a BotoxException on failure.
+        '''
+        if target is not None and payload is not None:
+            raise BotoxException("Custom payloads can't be hooked into a symbol; they must run from the entry point!")
+        if placement not in PLACEMENTS:
+            raise BotoxException("Unknown payload placement '%s'!" % placement)
+        if padding not in PADDINGS:
+            raise BotoxException("Unknown payload padding '%s'!" % padding)
+
+        # Anything that doesn't look like an ELF file would be taken for a path by ELF()
+        if data is not None:
+            if len(data) < ELF.EI_NIDENT or str(bytearray(data[0:4])) != ELF.ELFMAG or \
+               (isinstance(data, str) and "\x00" not in data):
+                raise BotoxException("The input isn't an ELF file!")
+            elfile = data
+        else:
+            elfile = self.elfile
+
+        with self.stats.phase("plan"):
+            try:
+                return self._plan(elfile, payload, target, placement, padding, page_size)
+            # Header tables that run past the end of the file
+            except struct.error:
+                raise BotoxException("The ELF file is truncated!")
+
+    def _plan(self, elfile, payload, target, placement, padding, page_size):
+        '''
+        Does the work for self.plan().
+        '''
+        arch = None
+
+        with self.stats.phase("load"):
+            elf = ELF(elfile, read_only=True, cache_headers=True, stats=self.stats)
+
+        with elf:
+            plan = PatchPlan(elf.elfile, elf.size)
 
-        # Open the target ELF file for writing
-        with ELF(self.elfile, read_only=False) as elf:
             # Relocatable files, shared objects, etc should be ignored.
             # These can be supported in the future, but relative addressing
             # support needs to be added to the payload code in architectures.py.
@@ -84,91 +232,474 @@ class Botox(object):
 
             # If no payload was specified, use the built-in pause payload
             if payload is None:
-                arch = self._resolve_architecture(elf.header.e_machine)
+                key = (elf.header.e_machine, elf.header.e_ident.ei_class, elf.header.e_ident.ei_encoding)
+                arch = self.architectures.get(key)
                 if arch is None:
-                    raise BotoxException("Sorry, this architecture [0x%X 0x%X] is not supported!" % (elf.header.e_machine, elf.header.e_ident.ei_class))
-                payload = arch(elf.header.e_ident.ei_encoding).payload(elf.header.e_entry)
+                    with self.stats.phase("arch resolve"):
+                        arch = self._resolve_architecture(*key)
+                    if arch is None:
+                        raise BotoxException("Sorry, this architecture [0x%X 0x%X 0x%X] is not supported!" % key)
+                    arch = arch(elf.header.e_ident.ei_encoding)
+                    self.architectures[key] = arch
+
+            # Look for the first executable load segment
+            for segment in elf.program_headers:
+                if ELF.PT_LOAD == segment.p_type and True == segment.flags.execute:
+                    break
+            else:
+                raise BotoxException("Failed to locate a loadable, executable segment! What is this, an ELF file for ants?!")
 
-            # Loop through all the program headers looking for the first executable load segment
-            for phdr in elf.program_headers:
-                if ELF.PT_LOAD == phdr.p_type and True == phdr.flags.execute:
-                    self._debug_print("Modifying program header #%d" % phdr.index)
+            # Don't want to insert multiple SIGSTOPs, do a sanity check before modifying anything.
+            # Check the first few bytes of the current entry point against the first few bytes of the payload.
+            # Can't check against the entire payload, since the end of the payload will be jumping to the
+            # entry point, which will change each time botox modifies an ELF file; 16 bytes should be sufficient.
+            if target is None and payload is None:
+                with self.stats.phase("assemble"):
+                    payload = arch.payload(elf.header.e_entry)
+            if target is None:
+                check = payload[0:16]
+            else:
+                with self.stats.phase("assemble"):
+                    check = arch.payload(elf.header.e_entry)[0:16]
+            entry_offset = elf.address_offset(elf.header.e_entry)
+            if entry_offset is not None and elf.read(entry_offset, 16) == check:
+                raise BotoxException("I've already patched this binary, and I shan't do it again!")
+
+            # Likewise if a symbol has already been hooked (see self._hook())
+            if arch is not None:
+                with self.stats.phase("hook check"):
+                    hooked = self._find_hook(elf, arch)
+                if hooked is not None:
+                    raise BotoxException("I've already hooked a symbol in this binary (trampoline at file offset 0x%X), and I shan't patch it again!" % hooked)
+
+            if page_size is None:
+                page_size = self._page_size(elf, arch)
+
+            if placement == CAVE:
+                payload_address = self._plan_cave(elf, plan, segment, arch, payload, target, page_size)
+            elif placement == APPEND:
+                payload_address = self._plan_append(elf, plan, segment, arch, payload, target, page_size)
+            else:
+                payload_address = self._plan_insert(elf, plan, segment, arch, payload, target, padding, page_size)
+
+            # Update the program entry point to be the location of our payload,
+            # unless the payload is reached through a hooked symbol instead
+            plan.entry_point = payload_address
+            if target is None:
+                logger.debug("Setting ELF entry point to 0x%X", plan.entry_point)
+                plan.edit("ehdr", None, "e_entry", elf.header.e_entry, plan.entry_point)
+
+        return plan
+
+    def _find_hook(self, elf, arch):
+        '''
+        Looks for a trampoline left by a previous symbol hook, wherever one
+        could have been placed; see placement.find_payload().
 
-                    alignment_size = phdr.p_align
+        @elf  - The ELF instance being planned for.
+        @arch - The Architecture instance for the ELF file.
 
-                    load_segment_size = phdr.p_filesz
-                    load_segment_offset = phdr.p_offset
-                    load_segment_virtual_base_address = phdr.p_vaddr - phdr.p_offset
+        Returns the file offset of the trampoline, or None if there isn't one.
+        '''
+        signature = arch.hook_signature()
+        if not signature:
+            return None
+        return placement.find_payload(elf, signature)
 
-                    # Don't want to insert multiple SIGSTOPs, do a sanity check before modifying anything.
-                    # Check the first few bytes of the current entry point against the first few bytes of the payload.
-                    # Can't check against the entire payload, since the end of the payload will be jumping to the
-                    # entry point, which will change each time botox modifies an ELF file; 16 bytes should be sufficient.
-                    if elf.read((elf.header.e_entry - load_segment_virtual_base_address), 16) == payload[0:16]:
-                        raise BotoxException("I've already patched this binary, and I shan't do it again!")
+    def _page_size(self, elf, arch):
+        '''
+        Returns the page size to plan for: that of the ELF file's architecture (see
+        Architecture.PAGE_SIZE), or placement.PAGE_SIZE if the architecture isn't supported.
+        A file whose load segments are aligned to less than that can only run with smaller
+        pages, so their alignment is used instead (but never less than placement.PAGE_SIZE).
 
-                    # Increase this segment's file and memory size so we can shove our payload in it
-                    phdr.p_memsz += alignment_size
-                    phdr.p_filesz += alignment_size
+        @elf  - The ELF instance being planned for.
+        @arch - The Architecture instance for the ELF file (None for custom payloads).
+        '''
+        if arch is None:
+            arch = self._resolve_architecture(elf.header.e_machine, elf.header.e_ident.ei_class, elf.header.e_ident.ei_encoding)
+        if arch is None:
+            page_size = placement.PAGE_SIZE
+        else:
+            page_size = arch.PAGE_SIZE
 
-                    break
+        alignments = [phdr.p_align for phdr in elf.program_headers if ELF.PT_LOAD == phdr.p_type and phdr.p_align > 1]
+        if alignments:
+            page_size = max(min([page_size] + alignments), placement.PAGE_SIZE)
 
-            # Sanity checks
-            if None in [alignment_size, load_segment_size, load_segment_offset, load_segment_virtual_base_address]:
-                raise BotoxException("Failed to locate a loadable, executable segment! What is this, an ELF file for ants?!")
-            if len(payload) > alignment_size:
-                raise BotoxException("Sorry, my developer was too lazy to tell me how to handle payloads larger than the segment alignment size (%d)!" % alignment_size)
-
-            # Pad our payload out to the alignment size of the load segment
-            payload += "\x00" * (alignment_size - len(payload))
-            payload_size = len(payload)
-
-            # By default, the payload is just slapped on the end of the executable
-            # load segment as defined in the program headers.
-            payload_offset = load_segment_offset + load_segment_size
-            self._debug_print("Payload will be placed at file offset 0x%X (virtual address: 0x%X)" % (payload_offset, load_segment_virtual_base_address + payload_offset))
-
-            # Each segment defined in the program headers that starts *after*
-            # the offset where our payload will be inserted must have its
-            # starting offset increased by the size of our payload.
-            for phdr in elf.program_headers:
-                if payload_offset <= phdr.p_offset:
-                    self._debug_print("Increasing the size of program header #%d by 0x%X" % (phdr.index, payload_size))
-                    phdr.p_offset += payload_size
-
-            # Each section defined in the section headers that starts *after*
-            # the offset where our payload will be inserted must have its
-            # starting offset increased by the size of our payload.
-            for shdr in elf.section_headers:
-                if payload_offset <= shdr.sh_offset:
-                    self._debug_print("Increasing the size of section header %s by 0x%X" % (shdr.name, payload_size))
-                    shdr.sh_offset += payload_size
-
-                # The section in which the actual payload should reside must have its size increased
-                # to acommodate the new payload, and must also be marked as executable.
-                if payload_offset > shdr.sh_offset and payload_offset <= (shdr.sh_offset + shdr.sh_size):
-                    self._debug_print("Payload will reside in section %s, increasing its size by 0x%X" % (shdr.name, payload_size))
-                    shdr.flags.execute = True
-                    shdr.flags.allocate = True
-                    shdr.sh_size += payload_size
-
-            # If the section headers come after the new payload insertion location
-            # (which they will), update the offset of the section headers by the
-            # size of the payload.
-            if payload_offset <= elf.header.e_shoff:
-                self._debug_print("Increasing section header offset by 0x%X" % payload_size)
-                elf.header.e_shoff += payload_size
-
-            # Update the program entry point to be the location of our payload
-            self._debug_print("Setting ELF entry point to 0x%X" % (load_segment_virtual_base_address + payload_offset))
-            elf.header.e_entry = load_segment_virtual_base_address + payload_offset
-
-            # Now that all header information has been updated to acommodate the
-            # payload, insert the payload into the ELF file.
-            self._debug_print("Inserting payload of size 0x%X at file offset 0x%X" % (payload_size, payload_offset))
-            elf.insert(payload_offset, payload)
-
-            return elf.header.e_entry
-
-        return None
+        return page_size
+
+    def _plan_insert(self, elf, plan, segment, arch, payload, target, padding=ALIGN, page_size=placement.PAGE_SIZE):
+        '''
+        Plans the insertion of the payload after the executable load segment.
+
+        @elf     - The ELF instance being planned for.
+        @plan    - The PatchPlan to add to.
+        @segment - The Elf_Phdr of the executable load segment.
+        @arch    - The Architecture instance for the ELF file (None for custom payloads).
+        @payload - The payload (None if target is specified).
+        @target  - The name of the symbol to hook, or None.
+        @padding - How to pad the payload; one of PADDINGS.
+        @page_size - The target's page size.
+
+        Returns the virtual address of the payload.
+        '''
+        logger.debug("Modifying program header #%d", segment.index)
+
+        # Segments after the payload only stay mappable if they move by a multiple of the page size
+        if padding == PAGE:
+            alignment_size = page_size
+        else:
+            alignment_size = max(segment.p_align, page_size)
+        base_address = segment.p_vaddr - segment.p_offset
+
+        # By default, the payload is just slapped on the end of the executable
+        # load segment as defined in the program headers.
+        payload_offset = segment.p_offset + segment.p_filesz
+
+        if target is not None:
+            payload = self._hook(elf, arch, target, plan, segment, base_address + payload_offset)
+
+        # Virtual addresses don't move, so the payload must fit below the next load segment
+        limit = placement.address_limit(elf, segment, page_size)
+        if limit is not None and (base_address + payload_offset + len(payload)) > limit:
+            raise BotoxException("The %d byte payload would run into the load segment at 0x%X; try the cave or append placements!" % (len(payload), limit))
+
+        # Pad our payload out to a multiple of the alignment size of the load segment
+        # (or of the page size), so that the segments after it stay aligned
+        if alignment_size > 1:
+            payload += "\x00" * (-len(payload) % alignment_size)
+        payload_size = len(payload)
+
+        # Increase this segment's file and memory size so we can shove our payload in it
+        plan.edit("phdr", segment.index, "p_memsz", segment.p_memsz, segment.p_memsz + payload_size)
+        plan.edit("phdr", segment.index, "p_filesz", segment.p_filesz, segment.p_filesz + payload_size)
+
+        logger.debug("Payload will be placed at file offset 0x%X (virtual address: 0x%X)", payload_offset, base_address + payload_offset)
+
+        # Each segment defined in the program headers that starts *after*
+        # the offset where our payload will be inserted must have its
+        # starting offset increased by the size of our payload.
+        for phdr in elf.program_headers:
+            if payload_offset <= phdr.p_offset:
+                logger.debug("Increasing the size of program header #%d by 0x%X", phdr.index, payload_size)
+                plan.edit("phdr", phdr.index, "p_offset", phdr.p_offset, phdr.p_offset + payload_size)
+
+                # Keep p_offset congruent to p_vaddr modulo p_align
+                if ELF.PT_LOAD == phdr.p_type and phdr.p_align > alignment_size and (payload_size % phdr.p_align) != 0:
+                    logger.debug("Reducing the alignment of program header #%d to 0x%X", phdr.index, alignment_size)
+                    plan.edit("phdr", phdr.index, "p_align", phdr.p_align, alignment_size)
+
+        # Each section defined in the section headers that starts *after*
+        # the offset where our payload will be inserted must have its
+        # starting offset increased by the size of our payload.
+        for shdr in elf.section_headers:
+            # The NULL section describes no data (and may hold the section count)
+            if shdr.sh_type == ELF.SHT_NULL:
+                continue
+
+            if payload_offset <= shdr.sh_offset:
+                logger.debug("Increasing the size of section header %s by 0x%X", shdr, payload_size)
+                plan.edit("shdr", shdr.index, "sh_offset", shdr.sh_offset, shdr.sh_offset + payload_size)
+
+            # The section in which the actual payload should reside must have its size increased
+            # to acommodate the new payload, and must also be marked as executable.
+            elif payload_offset <= (shdr.sh_offset + shdr.sh_size):
+                logger.debug("Payload will reside in section %s, increasing its size by 0x%X", shdr, payload_size)
+                plan.edit("shdr", shdr.index, "sh_flags", shdr.sh_flags, shdr.sh_flags | ELF.SHF_ALLOC | ELF.SHF_EXECINSTR)
+                plan.edit("shdr", shdr.index, "sh_size", shdr.sh_size, shdr.sh_size + payload_size)
+
+        # If the section headers come after the new payload insertion location
+        # (which they will), update the offset of the section headers by the
+        # size of the payload.
+        if payload_offset <= elf.header.e_shoff:
+            logger.debug("Increasing section header offset by 0x%X", payload_size)
+            plan.edit("ehdr", None, "e_shoff", elf.header.e_shoff, elf.header.e_shoff + payload_size)
+
+        plan.insert_offset = payload_offset
+        plan.payload = payload
+
+        return base_address + payload_offset
+
+    def _plan_cave(self, elf, plan, segment, arch, payload, target, page_size=placement.PAGE_SIZE):
+        '''
+        Plans writing the payload into a code cave in the executable load segment.
+        Nothing is inserted into the file; at most, the segment's p_filesz and
+        p_memsz are extended to cover the cave.
+
+        Arguments are the same as for self._plan_insert().
+
+        Returns the virtual address of the payload.
+        '''
+        base_address = segment.p_vaddr - segment.p_offset
+
+        # A hook's trampoline depends on its address, but not its size; size it up
+        # for an arbitrary address, then generate it for real once it has a home.
+        if target is not None:
+            size = len(self._hook(elf, arch, target, None, segment, segment.p_vaddr + segment.p_filesz))
+        else:
+            size = len(payload)
+
+        cave = placement.find_cave(elf, segment, size, page_size=page_size)
+        if cave is None:
+            raise BotoxException("Couldn't find a code cave big enough for the %d byte payload!" % size)
+
+        if target is not None:
+            payload = self._hook(elf, arch, target, plan, segment, base_address + cave.offset)
+
+        logger.debug("Payload will be placed in a code cave at file offset 0x%X (virtual address: 0x%X)", cave.offset, base_address + cave.offset)
+
+        if cave.filesz is not None:
+            logger.debug("Extending program header #%d to 0x%X bytes", segment.index, cave.filesz)
+            plan.edit("phdr", segment.index, "p_memsz", segment.p_memsz, max(segment.p_memsz, cave.filesz))
+            plan.edit("phdr", segment.index, "p_filesz", segment.p_filesz, cave.filesz)
+
+        plan.write(cave.offset, elf.read(cave.offset, len(payload)), payload)
+        plan.payload = payload
+
+        return base_address + cave.offset
+
+    def _plan_append(self, elf, plan, segment, arch, payload, target, page_size=placement.PAGE_SIZE):
+        '''
+        Plans appending the payload to the end of the file, and converting a
+        PT_NOTE program header into a load segment that maps it. Only the
+        program header and (unless hooking) the entry point are modified.
+
+        Arguments are the same as for self._plan_insert().
+
+        Returns the virtual address of the payload.
+        '''
+        for spare in elf.program_headers:
+            if ELF.PT_NOTE == spare.p_type:
+                break
+        else:
+            raise BotoxException("There is no PT_NOTE program header to turn into a load segment!")
+
+        # Map the payload above every existing segment. The kernel requires that
+        # the virtual address and file offset are congruent modulo the alignment,
+        # so pick an address which matches the current end of the file; that way
+        # no padding is needed.
+        alignment = max(segment.p_align, page_size)
+        offset = elf.size
+        end = max([phdr.p_vaddr + phdr.p_memsz for phdr in elf.program_headers if ELF.PT_LOAD == phdr.p_type])
+        address = (((end + alignment - 1) / alignment) * alignment) + (offset % alignment)
+
+        if target is not None:
+            payload = self._hook(elf, arch, target, plan, segment, address)
+
+        logger.debug("Payload will be appended at file offset 0x%X (virtual address: 0x%X) using program header #%d", offset, address, spare.index)
+
+        plan.edit("phdr", spare.index, "p_type", spare.p_type, ELF.PT_LOAD)
+        plan.edit("phdr", spare.index, "p_flags", spare.p_flags, ELF.PF_R | ELF.PF_X)
+        plan.edit("phdr", spare.index, "p_offset", spare.p_offset, offset)
+        plan.edit("phdr", spare.index, "p_vaddr", spare.p_vaddr, address)
+        plan.edit("phdr", spare.index, "p_paddr", spare.p_paddr, address)
+        plan.edit("phdr", spare.index, "p_filesz", spare.p_filesz, len(payload))
+        plan.edit("phdr", spare.index, "p_memsz", spare.p_memsz, len(payload))
+        plan.edit("phdr", spare.index, "p_align", spare.p_align, alignment)
+
+        plan.append = True
+        plan.payload = payload
+
+        return address
+
+    def _hook(self, elf, arch, target, plan, segment, payload_address):
+        '''
+        Plans the branch from a symbol to the payload, and generates the payload.
+
+        @elf             - The ELF instance being planned for.
+        @arch            - The Architecture instance for the ELF file.
+        @target          - The name of the symbol to hook.
+        @plan            - The PatchPlan to add the branch to, or None to just generate the payload.
+        @segment         - The Elf_Phdr of the executable load segment.
+        @payload_address - The virtual address the payload will be placed at.
+
+        Returns the payload.
+        '''
+        symbol = elf.symbol_by_name(target)
+        if symbol is None:
+            raise BotoxException("No symbol named '%s' was found!" % target)
+
+        # The hooked code must be in the executable load segment
+        base_address = segment.p_vaddr - segment.p_offset
+        segment_end = segment.p_offset + segment.p_filesz
+        code_offset = symbol.value - base_address
+        if code_offset < segment.p_offset or code_offset >= segment_end:
+            raise BotoxException("Symbol '%s' (0x%X) is not in the executable load segment!" % (target, symbol.value))
+        code = elf.read(code_offset, min(32, segment_end - code_offset))
+
+        with self.stats.phase("assemble"):
+            (hook_address, branch, payload) = arch.hook(symbol.value, code, payload_address)
+        hook_offset = hook_address - base_address
+        if (hook_offset + len(branch)) > segment_end:
+            raise BotoxException("Symbol '%s' (0x%X) is too close to the end of the executable load segment to hook!" % (target, symbol.value))
+
+        if plan is not None:
+            logger.debug("Hooking %s at 0x%X (file offset 0x%X)", target, hook_address, hook_offset)
+            plan.write(hook_offset, elf.read(hook_offset, len(branch)), branch)
+            plan.target = target
+            plan.hook_address = hook_address
+
+        return payload
+
+    def patch_bytes(self, data, payload=None, target=None, placement=INSERT, padding=ALIGN, page_size=None):
+        '''
+        Injects the supplied payload into an ELF file held in memory.
+        Nothing is read from or written to the file system.
+
+        @data      - The contents of the ELF file, as a str, bytearray, memoryview or buffer.
+        @payload   - The payload to inject into the ELF file.
+                     If no payload is provided, the default pause payload will be used.
+        @target    - Name of a symbol (e.g., "main") to pause at instead of the entry point.
+                     Only supported with the default pause payload.
+        @placement - Where to put the payload; one of PLACEMENTS (see plan()).
+        @padding   - How to pad an inserted payload; one of PADDINGS (see plan()).
+        @page_size - The target's page size; defaults to the architecture's (see plan()).
+
+        Returns the contents of the patched ELF file, as a str.
+        Raises a BotoxException on failure.
+        '''
+        if self.store is not None:
+            import store
+            with self.stats.phase("store lookup"):
+                key = store.hash_bytes(data, self._store_prefix(payload, target, placement, padding, page_size))
+                if self.store.get(key) is not None:
+                    return self.store.read(key)
+
+        plan = self.plan(payload, target, placement, padding, data=data, page_size=page_size)
+
+        with self.stats.phase("load"):
+            elf = ELF(data, read_only=False, cache_headers=True, stats=self.stats)
+
+        with elf:
+            self._apply_elf(elf, plan)
+
+        patched = elf.getvalue()
+
+        if self.store is not None:
+            with self.stats.phase("store add"):
+                self.store.put_bytes(key, patched, {"entry_point" : plan.entry_point})
+
+        return patched
+
+    def patch_stream(self, source, destination, payload=None, target=None, placement=INSERT, padding=ALIGN, page_size=None):
+        '''
+        Reads an ELF file from one stream (e.g., stdin) and writes the patched ELF file to
+        another (e.g., stdout). Nothing is written to the file system. The whole input must
+        be read before anything is written, since the section header table (which the
+        patch depends on) is usually at the end of the file; see stream.write_stream().
+
+        @source      - The file object to read the ELF file from.
+        @destination - The file object to write the patched ELF file to.
+        @payload     - The payload to inject into the ELF file.
+                       If no payload is provided, the default pause payload will be used.
+        @target      - Name of a symbol (e.g., "main") to pause at instead of the entry point.
+                       Only supported with the default pause payload.
+        @placement   - Where to put the payload; one of PLACEMENTS (see plan()).
+        @padding     - How to pad an inserted payload; one of PADDINGS (see plan()).
+        @page_size   - The target's page size; defaults to the architecture's (see plan()).
+
+        Returns the new entry point address (or, if target was specified, the address of the
+        code the symbol now branches to) on success.
+        Raises a BotoxException on failure.
+        '''
+        with self.stats.phase("read"):
+            data = stream.read_stream(source, stats=self.stats)
+
+        plan = self.plan(payload, target, placement, padding, data=data, page_size=page_size)
+
+        with self.stats.phase("write"):
+            stream.write_stream(destination, data, plan, stats=self.stats)
+
+        return plan.entry_point
+
+    def apply(self, plan, output=None):
+        '''
+        Carries out a PatchPlan produced by self.plan().
+
+        @plan   - The PatchPlan to apply.
+        @output - Path to write the patched ELF file to. If not specified, the target
+                  ELF file is modified in place.
+
+        Returns the new entry point address on success.
+        Returns None on failure, or (more likely) raises an exception.
+        '''
+        if output is None:
+            entry_point = self._apply_file(self.elfile, plan)
+            self._log_patched(self.elfile)
+            return entry_point
+
+        # Patch a clone of the target ELF file that lives in the same directory as
+        # the output file, then atomically rename it over the output file. The
+        # output file is either the original or the fully patched file, never
+        # anything in between; if output is the target ELF file itself, this is
+        # a crash-safe in-place patch.
+        import fsutil
+
+        output = os.path.abspath(output)
+        (fd, temp_file) = tempfile.mkstemp(prefix=".botox-", dir=os.path.dirname(output))
+        os.close(fd)
+
+        try:
+            with self.stats.phase("clone"):
+                method = fsutil.clone_file(self.elfile, temp_file)
+            logger.debug("Cloned %s to %s (%s)", self.elfile, temp_file, method)
+
+            entry_point = self._apply_file(temp_file, plan)
+
+            with self.stats.phase("sync"):
+                fsutil.fsync(temp_file)
+                os.rename(temp_file, output)
+                fsutil.fsync(os.path.dirname(output))
+        except:
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+            raise
+
+        self._log_patched(output)
+        return entry_point
+
+    def _log_patched(self, path):
+        '''
+        Logs the completion of a patch, along with the statistics collected so far.
+
+        @path - The path of the patched file.
+
+        Returns None.
+        '''
+        logger.info("Patched %s", path, extra={"elfile" : path, "stats" : self.stats.to_dict()})
+
+    def _apply_file(self, elfile, plan):
+        '''
+        Carries out a PatchPlan on an ELF file, in place.
+
+        @elfile - Path to the ELF file to patch.
+        @plan   - The PatchPlan to apply.
+
+        Returns the new entry point address.
+        '''
+        # Header edits are made in memory and written back in one go
+        # once the payload has been inserted.
+        with self.stats.phase("load"):
+            elf = ELF(elfile, read_only=False, cache_headers=True, stats=self.stats)
+
+        with elf:
+            self._apply_elf(elf, plan)
+
+        return plan.entry_point
+
+    def _apply_elf(self, elf, plan):
+        '''
+        Carries out a PatchPlan on a loaded ELF file.
+
+        @elf  - An instance of elf.ELF, opened for writing with cache_headers=True.
+        @plan - The PatchPlan to apply.
+
+        Returns None.
+        '''
+        if plan.insert_offset is not None:
+            logger.debug("Inserting payload of size 0x%X at file offset 0x%X", len(plan.payload), plan.insert_offset)
+        plan.apply(elf)
+        with self.stats.phase("header rewrite"):
+            elf.commit()
 
@@ -1,18 +1,434 @@
+import os
+import json
 import struct
+import hashlib
+import tempfile
+import collections
 from elf import ELF
 from exceptions import BotoxException
 
-try:
-    from keystone import *
-except ImportError as e:
-    raise BotoxException("Botox requires the keystone module! Please install it from: https://github.com/keystone-engine/keystone")
+# The keystone module, once imported by _load_keystone()
+_keystone = None
+
+def _load_keystone():
+    '''
+    Imports the keystone module on first use. Keystone is only needed to assemble
+    custom payloads; the built-in payloads are encoded without it.
+
+    Returns the keystone module.
+    '''
+    global _keystone
+
+    if _keystone is None:
+        try:
+            import keystone
+        except ImportError as e:
+            raise BotoxException("Assembling custom payloads requires the keystone module! Please install it from: https://github.com/keystone-engine/keystone")
+        _keystone = keystone
+
+    return _keystone
+
+# Maximum number of assembled payload templates kept in memory
+TEMPLATE_CACHE_SIZE = 32
+
+# If set, assembled payload templates are also cached on disk in this directory
+TEMPLATE_CACHE_DIR = os.environ.get("BOTOX_TEMPLATE_CACHE")
+
+class Relocation(object):
+    '''
+    Describes how the entry point address is encoded in an assembled payload,
+    so that a payload assembled once can be re-targeted by patching bytes.
+    '''
+    # Address substituted for the entry point when assembling a payload template.
+    # It must force the assembler to use the full-width form of the instruction.
+    SENTINEL = None
+
+    def __init__(self, endianess):
+        '''
+        Class constructor.
+
+        @endianess - The struct module endianess character, '<' or '>'.
+
+        Returns None.
+        '''
+        self.endianess = endianess
+
+    def find(self, code):
+        '''
+        Locates the entry point in a payload assembled with SENTINEL as the entry point.
+
+        @code - The assembled payload.
+
+        Returns a list of offsets into code, or None if the entry point could not be found.
+        '''
+        return None
+
+    def apply(self, code, offsets, address):
+        '''
+        Patches an address into an assembled payload.
+
+        @code    - The assembled payload, as a bytearray.
+        @offsets - The offsets returned by find().
+        @address - The address to patch in.
+
+        Returns None.
+        '''
+        pass
+
+class Absolute(Relocation):
+    '''
+    An absolute address stored as a single immediate or literal pool entry.
+    '''
+    FORMAT = None
+
+    def find(self, code):
+        sentinel = struct.pack(self.endianess + self.FORMAT, self.SENTINEL)
+        offset = code.find(sentinel)
+        if offset == -1 or code.find(sentinel, offset+1) != -1:
+            return None
+        return [offset]
+
+    def apply(self, code, offsets, address):
+        struct.pack_into(self.endianess + self.FORMAT, code, offsets[0], address)
+
+class Absolute32(Absolute):
+    FORMAT = "I"
+    SENTINEL = 0x89ABCDEF
+
+class Absolute64(Absolute):
+    FORMAT = "Q"
+    SENTINEL = 0x89ABCDEF01234567
+
+class MipsHi16Lo16(Relocation):
+    '''
+    An absolute address loaded by a MIPS lui/ori instruction pair (as generated for "li").
+    '''
+    SENTINEL = 0x89ABCDEF
+
+    LUI = 0x0F
+    ORI = 0x0D
+
+    def find(self, code):
+        hi = None
+        lo = None
+
+        for offset in range(0, len(code) - 3, 4):
+            word = struct.unpack_from(self.endianess + "I", code, offset)[0]
+            if (word >> 26) == self.LUI and (word & 0xFFFF) == (self.SENTINEL >> 16):
+                hi = offset
+            elif (word >> 26) == self.ORI and (word & 0xFFFF) == (self.SENTINEL & 0xFFFF):
+                lo = offset
+
+        if None in [hi, lo]:
+            return None
+        return [hi, lo]
+
+    def apply(self, code, offsets, address):
+        for (offset, value) in zip(offsets, [address >> 16, address & 0xFFFF]):
+            word = struct.unpack_from(self.endianess + "I", code, offset)[0]
+            struct.pack_into(self.endianess + "I", code, offset, (word & 0xFFFF0000) | value)
+
+class Template(object):
+    '''
+    An assembled payload along with the location(s) of its entry point address.
+    '''
+
+    def __init__(self, code, relocation, offsets):
+        '''
+        Class constructor.
+
+        @code       - The assembled payload, as a string.
+        @relocation - Instance of the Relocation subclass describing how the entry point is encoded.
+        @offsets    - The entry point offsets, as returned by relocation.find().
+
+        Returns None.
+        '''
+        self.code = code
+        self.relocation = relocation
+        self.offsets = offsets
+
+    def render(self, jump_address):
+        '''
+        Returns a copy of the payload, jumping to jump_address.
+        '''
+        code = bytearray(self.code)
+        self.relocation.apply(code, self.offsets, jump_address)
+        return str(code)
+
+class LRUCache(object):
+    '''
+    Minimal least-recently-used cache.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return None
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+_templates = LRUCache(TEMPLATE_CACHE_SIZE)
+
+# Architecture subclasses, keyed by (e_machine, ei_class, ei_encoding)
+REGISTRY = {}
+
+# Setuptools entry point group through which other packages can provide
+# Architecture subclasses. Each entry point should name a module (or the
+# class itself); defining the class is enough to register it.
+ENTRY_POINT_GROUP = "botox.architectures"
+
+_entry_points_loaded = False
+
+def lookup(machine, elfclass, endianess):
+    '''
+    Returns the Architecture subclass for an ELF file.
+
+    @machine   - The e_machine value from the ELF header.
+    @elfclass  - The e_ident.ei_class value from the ELF header.
+    @endianess - The e_ident.ei_encoding value from the ELF header.
+
+    Returns a subclass of Architecture on success.
+    Returns None if the architecture is not supported.
+    '''
+    key = (machine, elfclass, endianess)
+
+    try:
+        return REGISTRY[key]
+    except KeyError:
+        pass
+
+    # Only go looking for third-party architectures when the built-in ones don't match
+    if _load_entry_points() == True:
+        return REGISTRY.get(key)
+
+    return None
+
+def _load_entry_points():
+    '''
+    Loads the Architecture subclasses provided through ENTRY_POINT_GROUP, once.
+
+    Returns True if entry points were loaded by this call.
+    '''
+    global _entry_points_loaded
+
+    if _entry_points_loaded == True:
+        return False
+    _entry_points_loaded = True
+
+    try:
+        import pkg_resources
+    except ImportError:
+        return False
+
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+        try:
+            entry_point.load()
+        except KeyboardInterrupt as e:
+            raise e
+        except Exception:
+            # A broken plugin shouldn't take the built-in architectures down with it
+            continue
+
+    return True
+
+class ArchitectureType(type):
+    '''
+    Metaclass which adds each Architecture subclass to REGISTRY when it is defined.
+    Only classes which set MACHINE themselves are registered, so subclassing an
+    existing architecture (e.g. to change its ASM) doesn't replace it.
+    '''
+
+    def __init__(cls, name, bases, attributes):
+        super(ArchitectureType, cls).__init__(name, bases, attributes)
+
+        if attributes.get('MACHINE') is not None:
+            for elfclass in cls.CLASSES:
+                for endianess in cls.ENDIANESS:
+                    REGISTRY[(cls.MACHINE, elfclass, endianess)] = cls
+
+# x86 opcodes which take a ModRM byte and no immediate, and are safe to execute
+# from a different address (no branches, no implicit use of the instruction pointer)
+_X86_MODRM = [0x01, 0x03, 0x09, 0x0B, 0x21, 0x23, 0x29, 0x2B, 0x31, 0x33, 0x39, 0x3B, 0x85, 0x89, 0x8B, 0x8D]
+# As above, followed by an 8-bit / 32-bit immediate
+_X86_MODRM_IMM8 = [0x83, 0xC6]
+_X86_MODRM_IMM32 = [0x81, 0xC7]
+# Two-byte (0x0F XX) opcodes which take a ModRM byte and no immediate: nop r/m, movzx, movsx
+_X86_0F_MODRM = [0x1F, 0xB6, 0xB7, 0xBE, 0xBF]
+
+def _x86_modrm_length(code, offset, x64):
+    '''
+    Decodes the length of a ModRM byte and its SIB byte and displacement, if any.
+
+    @code   - The instruction bytes.
+    @offset - Offset of the ModRM byte in code.
+    @x64    - True for 64-bit mode.
+
+    Returns a tuple of (length, offset of a RIP-relative displacement or None).
+    '''
+    modrm = ord(code[offset])
+    mod = modrm >> 6
+    rm = modrm & 7
+    length = 1
+
+    if mod == 3:
+        return (length, None)
+
+    if rm == 4:
+        sib = ord(code[offset+1])
+        length += 1
+        if mod == 0 and (sib & 7) == 5:
+            length += 4
+    elif mod == 0 and rm == 5:
+        # disp32; an absolute address in 32-bit mode, but relative to the
+        # next instruction in 64-bit mode.
+        if x64 == True:
+            return (length + 4, offset + 1)
+        length += 4
+
+    if mod == 1:
+        length += 1
+    elif mod == 2:
+        length += 4
+
+    return (length, None)
+
+def _x86_instruction_length(code, x64):
+    '''
+    A (very) small x86 instruction length decoder, which understands the
+    instructions commonly found in function prologues.
+
+    @code - The instruction bytes.
+    @x64  - True for 64-bit mode.
+
+    Returns a tuple of (length, offset of a RIP-relative displacement or None).
+    Returns None if the instruction isn't understood.
+    '''
+    offset = 0
+    rex_w = False
+
+    try:
+        opcode = ord(code[offset])
+        if opcode in [0x64, 0x65]:                      # fs/gs segment override
+            offset += 1
+            opcode = ord(code[offset])
+        if x64 == True and (opcode & 0xF0) == 0x40:
+            rex_w = bool(opcode & 0x08)
+            offset += 1
+            opcode = ord(code[offset])
+        offset += 1
+
+        if (opcode & 0xF8) == 0x50 or opcode == 0x90:   # push reg, nop
+            return (offset, None)
+        elif opcode == 0x6A:                            # push imm8
+            return (offset + 1, None)
+        elif opcode == 0x68:                            # push imm32
+            return (offset + 4, None)
+        elif (opcode & 0xF8) == 0xB8:                   # mov reg, imm
+            if rex_w == True:
+                return (offset + 8, None)
+            return (offset + 4, None)
+        elif opcode in [0xA1, 0xA3]:                    # mov eax/rax, moffs; mov moffs, eax/rax
+            if x64 == True:
+                return (offset + 8, None)
+            return (offset + 4, None)
+
+        if opcode == 0x0F:
+            opcode = 0x0F00 | ord(code[offset])
+            offset += 1
+            if (opcode & 0xFF) not in _X86_0F_MODRM:
+                return None
+            immediate = 0
+        elif opcode in _X86_MODRM:
+            immediate = 0
+        elif opcode in _X86_MODRM_IMM8:
+            immediate = 1
+        elif opcode in _X86_MODRM_IMM32:
+            immediate = 4
+        elif opcode == 0xFF and ((ord(code[offset]) >> 3) & 7) == 6:   # push r/m
+            immediate = 0
+        else:
+            return None
+
+        (length, displacement) = _x86_modrm_length(code, offset, x64)
+        if offset + length + immediate > len(code):
+            return None
+        return (offset + length + immediate, displacement)
+    except IndexError:
+        return None
+
+def _x86_displace(address, code, new_address, minimum, x64):
+    '''
+    Copies whole instructions from the start of code, so that they can be
+    executed at a different address.
+
+    @address     - The address code was read from.
+    @code        - The instruction bytes.
+    @new_address - The address the instructions will be executed from.
+    @minimum     - The minimum number of bytes to displace.
+    @x64         - True for 64-bit mode.
+
+    Returns a tuple of (number of bytes displaced, displaced instructions).
+    '''
+    length = 0
+    displaced = ""
+
+    while length < minimum:
+        decoded = _x86_instruction_length(code[length:], x64)
+        if decoded is None:
+            raise BotoxException("Don't know how to relocate the instruction at 0x%X (%s); try hooking a different symbol" % (address + length, code[length:length+8].encode("hex")))
+
+        (size, displacement) = decoded
+        instruction = code[length:length+size]
+
+        # RIP-relative operands must be adjusted to point at the same place from the new address
+        if displacement is not None:
+            value = struct.unpack_from("<i", instruction, displacement)[0]
+            value += (address + length) - (new_address + len(displaced))
+            if not (-0x80000000 <= value <= 0x7FFFFFFF):
+                raise BotoxException("The instruction at 0x%X can't reach its operand from 0x%X!" % (address + length, new_address + len(displaced)))
+            instruction = instruction[:displacement] + struct.pack("<i", value) + instruction[displacement+4:]
+
+        displaced += instruction
+        length += size
+
+    return (length, displaced)
+
+def _x86_jump(from_address, to_address):
+    '''
+    Returns a 5 byte x86 "jmp rel32" from one address to another.
+    '''
+    offset = to_address - (from_address + 5)
+    if not (-0x80000000 <= offset <= 0x7FFFFFFF):
+        raise BotoxException("Can't jump from 0x%X to 0x%X!" % (from_address, to_address))
+    return "\xE9" + struct.pack("<i", offset)
 
 class Architecture(object):
     '''
     Architecture class. All other arch-specific classes should be subclassed from this.
+
+    The built-in architectures encode their payloads directly (see _encode_template);
+    architectures which only provide ASM, and instances created with custom assembly,
+    are assembled with keystone.
+
+    Subclasses which set MACHINE are registered for every combination of
+    CLASSES and ENDIANESS; see lookup().
     '''
-    # Payload code, one assembly instruction per list entry. This code will
-    # be assembled at run time by the keystone library. The payload code should
+    __metaclass__ = ArchitectureType
+
+    # Payload code, one assembly instruction per list entry. Unless the class
+    # also provides a built-in encoder, this code will be assembled at run time
+    # by the keystone library. The payload code should
     # send itself a SIGSTOP signal, then jump to the original program's entry
     # point; effectively:
     #
@@ -23,30 +439,55 @@ class Architecture(object):
     # literal string "entry_point" may be used in the assembly code. This will
     # be replaced at runtime by the hexadecimal entry point address prior to
     # assembly.
+    #
+    # The payload is only assembled once per architecture and endianess; the
+    # result is kept as a Template, and the entry point address is patched into
+    # a copy of the template for each payload generated.
     ASM = []
-    # The keystone.KS_ARCH_XXX architecture associated with this architecture
+    # The Relocation subclass describing how the entry point is encoded in the
+    # assembled payload.
+    RELOCATION = Absolute32
+    # The name of the keystone.KS_ARCH_XXX architecture associated with this architecture
     ARCH = None
-    # The keystone.KS_MODE_XXX mode to be used with this architecture
+    # The name of the keystone.KS_MODE_XXX mode to be used with this architecture
     MODE = None
     # The machine type of the target architecture, as defined in the ELF header
     # See the elf.ELF.EM_XXX constants.
     MACHINE = None
+    # The ELF classes (elf.ELF.ELFCLASSXX) supported by this architecture
+    CLASSES = [ELF.ELFCLASS32, ELF.ELFCLASS64]
 
     BIG = ELF.ELFDATA2MSB
     LITTLE = ELF.ELFDATA2LSB
 
+    # The endianesses supported by this architecture
+    ENDIANESS = [LITTLE, BIG]
+
     ENTRY_POINT = "entry_point"
 
-    def __init__(self, endianess):
+    # The largest page size used by the architecture's kernels (and GNU ld's default
+    # max-page-size). Inserted payloads are padded to at least this, and no load
+    # segment's alignment is reduced below it.
+    PAGE_SIZE = 0x1000
+
+    # Size, in bytes, of the branch written over the start of a hooked symbol
+    # (see hook()). None if this architecture doesn't support hooking symbols.
+    HOOK_SIZE = None
+
+    def __init__(self, endianess, asm=None):
         '''
         Class constructor.
 
         @endianess - The endianess of the target architecture, as specified in the ELF
                      header (e_ident.ei_encoding).
+        @asm       - Custom payload code to use instead of self.ASM, in the same format.
+                     Custom code is always assembled with keystone.
 
         Returns None.
         '''
         self.endianess = endianess
+        if asm is not None:
+            self.ASM = asm
 
     def payload(self, jump_address):
         '''
@@ -58,16 +499,164 @@ class Architecture(object):
 
         Returns a string containing the shellcode.
         '''
+        return self.template().render(jump_address)
+
+    def template(self):
+        '''
+        Returns the payload Template for this architecture and endianess,
+        from the in-memory or on-disk template caches if possible.
+        '''
+        if self.endianess not in self.ENDIANESS:
+            raise BotoxException("Sorry, %s doesn't support this endianess!" % self.__class__.__name__)
+
+        key = (self.__class__, self.endianess, tuple(self.ASM))
+
+        template = _templates.get(key)
+        if template is None:
+            if self._has_builtin_encoder() == True:
+                template = self._encode_template()
+            else:
+                template = self._load_template()
+                if template is None:
+                    template = self._assemble_template()
+                    self._save_template(template)
+            _templates.put(key, template)
+
+        return template
+
+    def _has_builtin_encoder(self):
+        '''
+        Returns True if self.ASM can be encoded without keystone, i.e. if the
+        class that provides the ASM code also provides _encode_template.
+        '''
+        if 'ASM' in self.__dict__:
+            return False
+
+        for cls in self.__class__.__mro__:
+            if 'ASM' in cls.__dict__:
+                return ('_encode_template' in cls.__dict__)
+
+        return False
+
+    def _encode_template(self):
+        '''
+        Built-in encoder for self.ASM, overridden by subclasses that have one.
+
+        Returns a Template.
+        '''
+        raise NotImplementedError()
+
+    def _words(self, words):
+        '''
+        Packs a list of 32-bit instruction words with this architecture's endianess.
+
+        @words - List of integers.
+
+        Returns a string.
+        '''
+        return struct.pack(self._relocation().endianess + ("I" * len(words)), *words)
+
+    def _relocation(self):
+        '''
+        Returns an instance of self.RELOCATION for this architecture's endianess.
+        '''
+        if self.endianess == self.BIG:
+            return self.RELOCATION(">")
+        else:
+            return self.RELOCATION("<")
+
+    def _assemble_template(self):
+        '''
+        Assembles the payload with a placeholder entry point and records where the entry point ended up.
+
+        Returns a Template.
+        '''
+        relocation = self._relocation()
+        code = self.assemble(relocation.SENTINEL)
+
+        offsets = relocation.find(code)
+        if offsets is None:
+            raise BotoxException("Failed to locate the entry point in the assembled %s payload!" % self.__class__.__name__)
+
+        return Template(code, relocation, offsets)
+
+    def _template_cache_file(self):
+        '''
+        Returns the path of the on-disk cache file for this payload template,
+        or None if on-disk caching is disabled.
+        '''
+        if not TEMPLATE_CACHE_DIR:
+            return None
+
+        # Anything that could change the assembled code is part of the key
+        key = json.dumps([_load_keystone().ks_version(), self.__class__.__name__, self.ARCH, self.MODE,
+                          self.endianess, self.ASM, self.RELOCATION.__name__])
+        return os.path.join(TEMPLATE_CACHE_DIR, hashlib.sha1(key).hexdigest() + ".json")
+
+    def _load_template(self):
+        '''
+        Loads this payload template from the on-disk cache.
+
+        Returns a Template, or None if it isn't cached.
+        '''
+        path = self._template_cache_file()
+        if path is None:
+            return None
+
+        try:
+            with open(path, "rb") as fp:
+                cached = json.load(fp)
+            return Template(cached["code"].decode("hex"), self._relocation(), cached["offsets"])
+        except KeyboardInterrupt as e:
+            raise e
+        except Exception:
+            return None
+
+    def _save_template(self, template):
+        '''
+        Saves a payload template to the on-disk cache. Failures are ignored;
+        the cache is only an optimization.
+
+        @template - The Template to save.
+
+        Returns None.
+        '''
+        path = self._template_cache_file()
+        if path is None:
+            return None
+
+        try:
+            if not os.path.isdir(TEMPLATE_CACHE_DIR):
+                os.makedirs(TEMPLATE_CACHE_DIR)
+
+            (fd, temp_file) = tempfile.mkstemp(dir=TEMPLATE_CACHE_DIR)
+            with os.fdopen(fd, "wb") as fp:
+                json.dump({"code" : template.code.encode("hex"), "offsets" : template.offsets}, fp)
+            os.rename(temp_file, path)
+        except KeyboardInterrupt as e:
+            raise e
+        except Exception:
+            pass
+
+    def assemble(self, jump_address):
+        '''
+        Assembles the payload code with keystone.
+
+        @jump_address - The address substituted for the entry point.
+
+        Returns a string containing the assembled code.
+        '''
         encoding = []
+        keystone = _load_keystone()
 
         # Set big/little endian flag for keystone
         if self.endianess == self.BIG:
-            endian_mode = KS_MODE_BIG_ENDIAN
+            endian_mode = keystone.KS_MODE_BIG_ENDIAN
         else:
-            endian_mode = KS_MODE_LITTLE_ENDIAN
+            endian_mode = keystone.KS_MODE_LITTLE_ENDIAN
 
         # Instatiate the keystone.Ks class for assembly
-        ks = Ks(self.ARCH, self.MODE | endian_mode)
+        ks = keystone.Ks(getattr(keystone, self.ARCH), getattr(keystone, self.MODE) | endian_mode)
 
         # Assemble each line to a list of raw bytes that are appended to the
         # encoding list. Exceptions in assembling any specific line of code
@@ -86,10 +675,87 @@ class Architecture(object):
         # Convert the list of raw bytes into a string and return
         return ''.join([chr(byte) for byte in encoding])
 
+    def hook(self, address, code, trampoline_address):
+        '''
+        Generates the code needed to pause the process when it reaches a given
+        address, rather than at the entry point. The first instructions at the
+        address are replaced with a branch to a trampoline, which saves the
+        registers, sends itself a SIGSTOP, restores the registers, executes the
+        displaced instructions and then branches back.
+
+        Only instructions which can safely be moved to a different address are
+        displaced; if anything else is found, a BotoxException is raised.
+
+        @address            - The virtual address to hook.
+        @code               - The instruction bytes at that address (at least 32 bytes are recommended).
+        @trampoline_address - The virtual address the trampoline will be placed at.
+
+        Returns a tuple of (hooked address, branch code to write there, trampoline code).
+        '''
+        if self.HOOK_SIZE is None:
+            raise BotoxException("Sorry, %s doesn't support hooking symbols!" % self.__class__.__name__)
+
+        skip = self._hook_skip(code)
+        address += skip
+        code = code[skip:]
+
+        pause = self._pause()
+        (length, displaced) = self._displace(address, code, trampoline_address + len(pause))
+
+        trampoline = pause + displaced
+        trampoline += self._branch(trampoline_address + len(trampoline), address + length)
+
+        return (address, self._branch(address, trampoline_address), trampoline)
+
+    def hook_signature(self):
+        '''
+        Returns the bytes that every trampoline generated by hook() starts with, or None
+        if this architecture doesn't support hooking symbols. Used to recognize files
+        which already have a hooked symbol.
+        '''
+        if self.HOOK_SIZE is None:
+            return None
+        return self._pause()
+
+    def _hook_skip(self, code):
+        '''
+        Returns the number of bytes at the start of a hooked symbol that should be left in place.
+        '''
+        return 0
+
+    def _displace(self, address, code, new_address):
+        '''
+        Copies the instructions overwritten by a HOOK_SIZE branch, so that they
+        can be executed at a different address.
+
+        @address     - The address code was read from.
+        @code        - The instruction bytes.
+        @new_address - The address the instructions will be executed from.
+
+        Returns a tuple of (number of bytes displaced, displaced instructions).
+        '''
+        raise NotImplementedError()
+
+    def _branch(self, from_address, to_address):
+        '''
+        Returns HOOK_SIZE bytes of code which branch from one address to another.
+        '''
+        raise NotImplementedError()
+
+    def _pause(self):
+        '''
+        Returns position independent code which sends a SIGSTOP to the current
+        process, preserving the registers a function's caller may have set up.
+        '''
+        raise NotImplementedError()
+
 class X86(Architecture):
     MACHINE = ELF.EM_386
-    ARCH = KS_ARCH_X86
-    MODE = KS_MODE_32
+    CLASSES = [ELF.ELFCLASS32]
+    ENDIANESS = [Architecture.LITTLE]
+    ARCH = "KS_ARCH_X86"
+    MODE = "KS_MODE_32"
+    HOOK_SIZE = 5
     ASM = [
                 "mov eax, 20",
                 "int 0x80",         # getpid();
@@ -101,10 +767,48 @@ class X86(Architecture):
                 "jmp eax",          # goto entry_point
           ]
 
+    SIGSTOP = ("\xB8\x14\x00\x00\x00"      # mov eax, 20
+               "\xCD\x80"                    # int 0x80
+               "\x89\xC3"                    # mov ebx, eax
+               "\xB9\x13\x00\x00\x00"        # mov ecx, 19
+               "\xB8\x25\x00\x00\x00"        # mov eax, 37
+               "\xCD\x80")                   # int 0x80
+
+    def _encode_template(self):
+        code = (self.SIGSTOP +
+                "\xB8")                       # mov eax, entry_point
+        offsets = [len(code)]
+        code += ("\x00\x00\x00\x00"
+                 "\xFF\xE0")                  # jmp eax
+        return Template(code, self._relocation(), offsets)
+
+    def _hook_skip(self, code):
+        # Leave endbr32 in place for indirect branches
+        if code.startswith("\xF3\x0F\x1E\xFB"):
+            return 4
+        return 0
+
+    def _displace(self, address, code, new_address):
+        return _x86_displace(address, code, new_address, self.HOOK_SIZE, False)
+
+    def _branch(self, from_address, to_address):
+        return _x86_jump(from_address, to_address)
+
+    def _pause(self):
+        return ("\x60"                         # pushad
+                "\x9C" +                       # pushfd
+                self.SIGSTOP +
+                "\x9D"                         # popfd
+                "\x61")                        # popad
+
 class X86_64(Architecture):
     MACHINE = ELF.EM_X86_64
-    ARCH = KS_ARCH_X86
-    MODE = KS_MODE_64
+    CLASSES = [ELF.ELFCLASS64]
+    ENDIANESS = [Architecture.LITTLE]
+    ARCH = "KS_ARCH_X86"
+    MODE = "KS_MODE_64"
+    RELOCATION = Absolute64
+    HOOK_SIZE = 5
     ASM = [
                 "mov eax, 0x27",
                 "syscall",          # getpid();
@@ -116,10 +820,58 @@ class X86_64(Architecture):
                 "jmp rax",          # goto entry_point;
           ]
 
+    SIGSTOP = ("\xB8\x27\x00\x00\x00"               # mov eax, 0x27
+               "\x0F\x05"                            # syscall
+               "\x48\x89\xC7"                        # mov rdi, rax
+               "\x48\xC7\xC6\x13\x00\x00\x00"        # mov rsi, 19
+               "\x48\xC7\xC0\x3E\x00\x00\x00"        # mov rax, 0x3E
+               "\x0F\x05")                           # syscall
+
+    def _encode_template(self):
+        code = (self.SIGSTOP +
+                "\x48\xB8")                           # mov rax, entry_point
+        offsets = [len(code)]
+        code += ("\x00\x00\x00\x00\x00\x00\x00\x00"
+                 "\xFF\xE0")                          # jmp rax
+        return Template(code, self._relocation(), offsets)
+
+    def _hook_skip(self, code):
+        # Leave endbr64 in place for indirect branches
+        if code.startswith("\xF3\x0F\x1E\xFA"):
+            return 4
+        return 0
+
+    def _displace(self, address, code, new_address):
+        return _x86_displace(address, code, new_address, self.HOOK_SIZE, True)
+
+    def _branch(self, from_address, to_address):
+        return _x86_jump(from_address, to_address)
+
+    def _pause(self):
+        # Saves the registers clobbered by the system calls, along with
+        # rdi/rsi (the first two function arguments).
+        return ("\x9C"                                 # pushfq
+                "\x50"                                 # push rax
+                "\x57"                                 # push rdi
+                "\x56"                                 # push rsi
+                "\x51"                                 # push rcx
+                "\x41\x53" +                           # push r11
+                self.SIGSTOP +
+                "\x41\x5B"                             # pop r11
+                "\x59"                                 # pop rcx
+                "\x5E"                                 # pop rsi
+                "\x5F"                                 # pop rdi
+                "\x58"                                 # pop rax
+                "\x9D")                                # popfq
+
 class MIPS(Architecture):
     MACHINE = ELF.EM_MIPS
-    ARCH = KS_ARCH_MIPS
-    MODE = KS_MODE_MIPS32
+    CLASSES = [ELF.ELFCLASS32]
+    ARCH = "KS_ARCH_MIPS"
+    MODE = "KS_MODE_MIPS32"
+    RELOCATION = MipsHi16Lo16
+    HOOK_SIZE = 8
+    PAGE_SIZE = 0x10000
     ASM = [
                 "li $v0, 0xFB4",
                 "syscall 0",        # getpid();
@@ -131,10 +883,71 @@ class MIPS(Architecture):
                 "jr $t0",           # goto entry_point;
            ]
 
+    SIGSTOP = [
+                0x24020FB4,     # li $v0, 0xFB4
+                0x0000000C,     # syscall 0
+                0x00402025,     # move $a0, $v0
+                0x24050017,     # li $a1, 23
+                0x24020FC5,     # li $v0, 0xFC5
+                0x0000000C,     # syscall 0
+              ]
+
+    # Registers which may be clobbered by a system call: $at, $v0-$v1, $a0-$a3, $t0-$t9
+    SAVED_REGISTERS = range(1, 16) + [24, 25]
+
+    # Opcodes (bits 31-26) of the jump and branch instructions
+    BRANCH_OPCODES = [0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x14, 0x15, 0x16, 0x17, 0x3B]
+
+    def _encode_template(self):
+        code = self._words(self.SIGSTOP)
+        offsets = [len(code), len(code) + 4]
+        code += self._words([
+                    0x3C080000,     # lui $t0, %hi(entry_point)
+                    0x35080000,     # ori $t0, $t0, %lo(entry_point)
+                    0x01000008,     # jr $t0
+                    0x00000000,     # nop
+               ])
+        return Template(code, self._relocation(), offsets)
+
+    def _displace(self, address, code, new_address):
+        endianess = self._relocation().endianess
+
+        for offset in range(0, self.HOOK_SIZE, 4):
+            word = struct.unpack_from(endianess + "I", code, offset)[0]
+            opcode = word >> 26
+            if opcode in self.BRANCH_OPCODES or (opcode == 0 and (word & 0x3F) in [0x08, 0x09]):
+                raise BotoxException("Don't know how to relocate the branch at 0x%X; try hooking a different symbol" % (address + offset))
+
+        return (self.HOOK_SIZE, code[:self.HOOK_SIZE])
+
+    def _branch(self, from_address, to_address):
+        # j can only reach addresses in the same 256MB region as its delay slot
+        if ((from_address + 4) & 0xF0000000) != (to_address & 0xF0000000):
+            raise BotoxException("Can't jump from 0x%X to 0x%X!" % (from_address, to_address))
+
+        return self._words([
+                    0x08000000 | ((to_address >> 2) & 0x03FFFFFF),  # j to_address
+                    0x00000000,                                     # nop
+               ])
+
+    def _pause(self):
+        frame = ((len(self.SAVED_REGISTERS) * 4) + 7) & ~7
+        words = [0x27BD0000 | (-frame & 0xFFFF)]                     # addiu $sp, $sp, -frame
+        words += [0xAFA00000 | (register << 16) | (n * 4)           # sw $register, n*4($sp)
+                  for (n, register) in enumerate(self.SAVED_REGISTERS)]
+        words += self.SIGSTOP
+        words += [0x8FA00000 | (register << 16) | (n * 4)           # lw $register, n*4($sp)
+                  for (n, register) in enumerate(self.SAVED_REGISTERS)]
+        words += [0x27BD0000 | frame]                               # addiu $sp, $sp, frame
+        return self._words(words)
+
 class ARM(Architecture):
     MACHINE = ELF.EM_ARM
-    ARCH = KS_ARCH_ARM
-    MODE = KS_MODE_ARM
+    CLASSES = [ELF.ELFCLASS32]
+    ARCH = "KS_ARCH_ARM"
+    MODE = "KS_MODE_ARM"
+    HOOK_SIZE = 4
+    PAGE_SIZE = 0x10000
     ASM = [
                 "mov R7, #0x14",
                 "svc #0",           # getpid();
@@ -144,3 +957,55 @@ class ARM(Architecture):
                 "ldr PC, =%s" % Architecture.ENTRY_POINT  # goto entry_point
            ]
 
+    SIGSTOP = [
+                0xE3A07014,     # mov r7, #0x14
+                0xEF000000,     # svc #0
+                0xE3A01013,     # mov r1, #19
+                0xE3A07025,     # mov r7, #0x25
+                0xEF000000,     # svc #0
+              ]
+
+    def _encode_template(self):
+        code = self._words(self.SIGSTOP + [
+                    0xE51FF004,     # ldr pc, [pc, #-4]
+               ])
+        offsets = [len(code)]
+        code += self._words([
+                    0x00000000,     # .word entry_point
+               ])
+        return Template(code, self._relocation(), offsets)
+
+    def hook(self, address, code, trampoline_address):
+        if address & 1:
+            raise BotoxException("Sorry, hooking Thumb code at 0x%X isn't supported!" % (address & ~1))
+        return super(ARM, self).hook(address, code, trampoline_address)
+
+    def _displace(self, address, code, new_address):
+        word = struct.unpack_from(self._relocation().endianess + "I", code)[0]
+        condition = word >> 28
+        op = (word >> 25) & 7
+
+        # Refuse anything which branches, or which reads or writes the PC; unconditional
+        # and coprocessor/svc instructions are refused outright.
+        if condition == 0xF or op in [0b101, 0b111]:
+            pc_relative = True
+        elif op == 0b100:
+            pc_relative = (((word >> 16) & 0xF) == 15) or bool(word & (1 << 15))
+        else:
+            pc_relative = 15 in [(word >> 16) & 0xF, (word >> 12) & 0xF, word & 0xF]
+
+        if pc_relative == True:
+            raise BotoxException("Don't know how to relocate the instruction at 0x%X (0x%.8X); try hooking a different symbol" % (address, word))
+
+        return (self.HOOK_SIZE, code[:self.HOOK_SIZE])
+
+    def _branch(self, from_address, to_address):
+        offset = (to_address - (from_address + 8)) >> 2
+        if not (-0x800000 <= offset <= 0x7FFFFF):
+            raise BotoxException("Can't branch from 0x%X to 0x%X!" % (from_address, to_address))
+        return self._words([0xEA000000 | (offset & 0xFFFFFF)])     # b to_address
+
+    def _pause(self):
+        return self._words([0xE92D0083] +   # push {r0, r1, r7}
+                           self.SIGSTOP +
+                           [0xE8BD0083])    # pop {r0, r1, r7}
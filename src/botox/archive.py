@@ -0,0 +1,522 @@
+import bz2
+import time
+import zlib
+import fnmatch
+import tarfile
+
+import batch
+import stream
+from exceptions import BotoxException
+
+# Archive formats
+TAR = "tar"
+CPIO = "cpio"
+FORMATS = [TAR, CPIO]
+
+# SVR4 ("newc") cpio archives, as used for Linux initramfs images
+CPIO_MAGICS = ["070701", "070702"]
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = "TRAILER!!!"
+CPIO_FIELDS = ["ino", "mode", "uid", "gid", "nlink", "mtime", "filesize",
+               "devmajor", "devminor", "rdevmajor", "rdevminor", "namesize", "check"]
+# Offsets of the hex fields rewritten for patched members
+CPIO_FILESIZE_OFFSET = 6 + (8 * CPIO_FIELDS.index("filesize"))
+CPIO_CHECK_OFFSET = 6 + (8 * CPIO_FIELDS.index("check"))
+
+# tar archives, handled a 512 byte block at a time
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+# Pseudo-headers which describe the member that follows them
+TAR_EXTENSION_TYPES = [tarfile.XHDTYPE, tarfile.SOLARIS_XHDTYPE, tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK]
+TAR_REGULAR_TYPES = [tarfile.REGTYPE, tarfile.AREGTYPE, tarfile.CONTTYPE]
+# Offsets of the header fields rewritten for patched members
+TAR_SIZE_OFFSET = 124
+TAR_SIZE_LENGTH = 12
+TAR_CHECKSUM_OFFSET = 148
+TAR_CHECKSUM_LENGTH = 8
+# Offsets of the isextended flags in GNU sparse headers, and in the sparse extension blocks after them
+TAR_SPARSE_EXTENDED_OFFSET = 482
+TAR_SPARSE_EXTENSION_EXTENDED_OFFSET = 504
+
+# Compressed tar archives
+GZIP = "gzip"
+BZIP2 = "bzip2"
+GZIP_MAGIC = "\x1F\x8B"
+BZIP2_MAGIC = "BZh"
+COMPRESSION_MAGICS = {GZIP_MAGIC : GZIP, BZIP2_MAGIC : BZIP2}
+
+S_IFMT = 0170000
+S_IFREG = 0100000
+
+class _Reader(object):
+    '''
+    Wraps a (possibly unseekable) input stream, so that bytes read while
+    sniffing the archive format can be pushed back and read again.
+    '''
+
+    def __init__(self, source):
+        self.source = source
+        self.pending = ""
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+    def read(self, size):
+        '''
+        Reads up to size bytes; fewer are only returned at the end of the stream.
+        '''
+        chunks = []
+        if self.pending:
+            chunks.append(self.pending[0:size])
+            self.pending = self.pending[size:]
+            size -= len(chunks[0])
+
+        while size > 0:
+            chunk = self.source.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+
+        return "".join(chunks)
+
+    def read_exactly(self, size):
+        data = self.read(size)
+        if len(data) != size:
+            raise BotoxException("Truncated archive!")
+        return data
+
+class _Decompressor(object):
+    '''
+    Wraps a _Reader over a gzip or bzip2 compressed stream, decompressing it as
+    it's read. Concatenated compressed streams (as written by pigz, pbzip2, etc)
+    are decompressed one after the other.
+    '''
+
+    def __init__(self, source, compression):
+        self.source = source
+        self.compression = compression
+        self.decompressor = self._decompressor()
+        self.pending = ""
+        self.ended = False
+
+        if compression == GZIP:
+            self.magic = GZIP_MAGIC
+        else:
+            self.magic = BZIP2_MAGIC
+
+    def _decompressor(self):
+        if self.compression == GZIP:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return bz2.BZ2Decompressor()
+
+    def read(self, size):
+        '''
+        Reads up to size decompressed bytes; returns "" at the end of the stream.
+        '''
+        while len(self.pending) < size and self.ended == False:
+            data = self.source.read(stream.CHUNK_SIZE)
+            if not data:
+                break
+
+            try:
+                self.pending += self.decompressor.decompress(data)
+                unused = self.decompressor.unused_data
+            # bz2 decompressors refuse any data after the end of their stream
+            except EOFError:
+                unused = data
+            except (zlib.error, IOError) as e:
+                raise BotoxException("Invalid %s data: %s" % (self.compression, str(e)))
+
+            # Data after the end of a stream is either another stream, or padding which is ignored
+            if unused:
+                if not unused.startswith(self.magic):
+                    self.ended = True
+                    break
+                self.source.unread(unused)
+                self.decompressor = self._decompressor()
+
+        data = self.pending[0:size]
+        self.pending = self.pending[size:]
+        return data
+
+class _Compressor(object):
+    '''
+    Wraps an output file object, compressing everything written to it with gzip or bzip2.
+    '''
+
+    def __init__(self, destination, compression):
+        self.destination = destination
+        if compression == GZIP:
+            self.compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            self.compressor = bz2.BZ2Compressor(9)
+
+    def write(self, data):
+        self.destination.write(self.compressor.compress(data))
+
+    def close(self):
+        '''
+        Writes out the end of the compressed stream. The destination is left open.
+        '''
+        self.destination.write(self.compressor.flush())
+
+def detect_format(head):
+    '''
+    Identifies an archive from its first bytes.
+
+    @head - The first 6 (or more) bytes of the archive.
+
+    Returns CPIO for newc cpio archives, otherwise TAR (_patch_tar() does its own
+    checks, and handles compressed tar archives).
+    '''
+    if head[0:6] in CPIO_MAGICS:
+        return CPIO
+    return TAR
+
+def member_matches(name, patterns):
+    '''
+    Checks an archive member's name against glob patterns. Leading "./" and "/"
+    are ignored, so "usr/sbin/*" matches "./usr/sbin/httpd".
+
+    @name     - The member's name.
+    @patterns - List of glob patterns.
+
+    Returns True if any pattern matches.
+    '''
+    normalized = name
+    while normalized.startswith("./") or normalized.startswith("/"):
+        normalized = normalized[normalized.index("/")+1:]
+
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(normalized, pattern):
+            return True
+    return False
+
+def _patch_member(name, data, patcher, summary, dry_run, options):
+    '''
+    Patches the contents of one matching archive member in memory.
+
+    @name    - The member's name.
+    @data    - The member's contents.
+    @patcher - The Botox instance to patch with.
+    @summary - The patch_archive() summary to record the result in.
+    @dry_run - Set to True to only plan the patch.
+    @options - Keyword arguments for Botox.patch_bytes().
+
+    Returns the contents to write to the output archive: the patched ELF file,
+    or data if the member isn't patched.
+    '''
+    if not data.startswith(batch.ELF_MAGIC):
+        summary["skipped"].append({"name" : name, "reason" : "not an ELF file"})
+        return data
+
+    try:
+        if dry_run == True:
+            entry_point = patcher.plan(data=data, **options).entry_point
+            patched = data
+        else:
+            patched = patcher.patch_bytes(data, **options)
+            entry_point = None
+    except KeyboardInterrupt as e:
+        raise e
+    # Botox declined to patch the file (already patched, unsupported architecture, etc)
+    except BotoxException as e:
+        summary["skipped"].append({"name" : name, "reason" : str(e)})
+        return data
+    except Exception as e:
+        summary["failed"].append({"name" : name, "error" : "%s: %s" % (e.__class__.__name__, str(e))})
+        return data
+
+    result = {"name" : name, "size" : len(patched)}
+    if entry_point is not None:
+        result["entry_point"] = entry_point
+    summary["patched"].append(result)
+
+    return patched
+
+def _copy(reader, destination, size):
+    '''
+    Copies size bytes from reader to destination (if not None) in chunks.
+    '''
+    while size > 0:
+        chunk = reader.read_exactly(min(size, stream.CHUNK_SIZE))
+        if destination is not None:
+            destination.write(chunk)
+        size -= len(chunk)
+
+def _write(destination, data):
+    '''
+    Writes data to destination, if it isn't None.
+    '''
+    if destination is not None:
+        destination.write(data)
+
+def _tar_padding(size):
+    '''
+    Returns the number of bytes padding size bytes of tar member data out to a whole block.
+    '''
+    return (TAR_BLOCK_SIZE - (size % TAR_BLOCK_SIZE)) % TAR_BLOCK_SIZE
+
+def _parse_pax(data):
+    '''
+    Parses the newline terminated "<length> <keyword>=<value>" records of a pax extended header.
+
+    Returns a dictionary of the records.
+    '''
+    records = {}
+    offset = 0
+    while offset < len(data) and data[offset] != "\x00":
+        try:
+            space = data.index(" ", offset)
+            length = int(data[offset:space])
+            (keyword, value) = data[space+1:offset+length-1].split("=", 1)
+        except ValueError:
+            raise BotoxException("Invalid pax header!")
+        if length <= 0:
+            raise BotoxException("Invalid pax header!")
+        records[keyword] = value
+        offset += length
+    return records
+
+def _patch_tar(reader, destination, patterns, patcher, summary, dry_run, options):
+    '''
+    Does the work of patch_archive() for tar archives, which may be gzip or bzip2
+    compressed. Members are copied through block for block, headers (including pax
+    and GNU long name headers) and all, as is anything after the end of the archive;
+    only the size and checksum fields of patched members' headers are rewritten.
+    '''
+    head = reader.read(len(BZIP2_MAGIC))
+    reader.unread(head)
+    compression = COMPRESSION_MAGICS.get(head[0:len(GZIP_MAGIC)], COMPRESSION_MAGICS.get(head))
+
+    if compression is not None:
+        reader = _Reader(_Decompressor(reader, compression))
+        if destination is not None:
+            destination = _Compressor(destination, compression)
+
+    _patch_tar_members(reader, destination, patterns, patcher, summary, dry_run, options)
+
+    if compression is not None and destination is not None:
+        destination.close()
+
+def _patch_tar_members(reader, destination, patterns, patcher, summary, dry_run, options):
+    '''
+    Patches the members of an uncompressed tar archive, until the end of the archive.
+    '''
+    # Header blocks of the current member, starting with any pseudo-headers
+    headers = []
+    # pax records from the current member's extended headers, and from global headers
+    records = {}
+    global_records = {}
+    started = False
+
+    while True:
+        block = reader.read(TAR_BLOCK_SIZE)
+        if not block and started == True and not headers:
+            # No end of archive marker
+            return
+
+        try:
+            info = tarfile.TarInfo.frombuf(block)
+        except tarfile.EOFHeaderError:
+            if headers:
+                raise BotoxException("Invalid tar archive: missing member header")
+            _write(destination, block)
+            _copy_rest(reader, destination)
+            return
+        except tarfile.HeaderError as e:
+            if started == False:
+                raise BotoxException("Unsupported archive format: %s" % str(e))
+            raise BotoxException("Invalid tar archive: %s" % str(e))
+
+        started = True
+        headers.append(block)
+
+        if info.type in TAR_EXTENSION_TYPES or info.type == tarfile.XGLTYPE:
+            data = reader.read_exactly(info.size + _tar_padding(info.size))
+            headers.append(data)
+
+            if info.type == tarfile.GNUTYPE_LONGNAME:
+                records["path"] = tarfile.nts(data[0:info.size])
+            elif info.type == tarfile.XGLTYPE:
+                global_records.update(_parse_pax(data[0:info.size]))
+            elif info.type != tarfile.GNUTYPE_LONGLINK:
+                records.update(_parse_pax(data[0:info.size]))
+            continue
+
+        # GNU sparse headers may be followed by more blocks of the sparse map
+        if info.type == tarfile.GNUTYPE_SPARSE:
+            extended = block[TAR_SPARSE_EXTENDED_OFFSET]
+            while extended != "\x00":
+                block = reader.read_exactly(TAR_BLOCK_SIZE)
+                headers.append(block)
+                extended = block[TAR_SPARSE_EXTENSION_EXTENDED_OFFSET]
+
+        member_records = dict(global_records)
+        member_records.update(records)
+        name = member_records.get("path", info.name)
+        size = info.size
+        if "size" in member_records:
+            size = int(member_records["size"])
+
+        summary["members"] += 1
+
+        sparse = (info.type == tarfile.GNUTYPE_SPARSE or any(keyword.startswith("GNU.sparse.") for keyword in member_records))
+        if info.type not in TAR_REGULAR_TYPES or sparse or size == 0 or not member_matches(name, patterns):
+            _write(destination, "".join(headers))
+            _copy(reader, destination, size + _tar_padding(size))
+        elif "size" in member_records:
+            summary["skipped"].append({"name" : name, "reason" : "size is stored in a pax header"})
+            _write(destination, "".join(headers))
+            _copy(reader, destination, size + _tar_padding(size))
+        else:
+            data = reader.read_exactly(size)
+            padding = reader.read_exactly(_tar_padding(size))
+            patched = _patch_member(name, data, patcher, summary, dry_run, options)
+
+            if patched is not data:
+                header = headers[-1]
+                header = header[0:TAR_SIZE_OFFSET] + tarfile.itn(len(patched), TAR_SIZE_LENGTH, tarfile.GNU_FORMAT) + header[TAR_SIZE_OFFSET+TAR_SIZE_LENGTH:]
+                header = header[0:TAR_CHECKSUM_OFFSET] + ("%06o\x00 " % tarfile.calc_chksums(header)[0]) + header[TAR_CHECKSUM_OFFSET+TAR_CHECKSUM_LENGTH:]
+                headers[-1] = header
+                padding = "\x00" * _tar_padding(len(patched))
+
+            _write(destination, "".join(headers))
+            _write(destination, patched)
+            _write(destination, padding)
+
+        headers = []
+        records = {}
+
+def _patch_cpio(reader, destination, patterns, patcher, summary, dry_run, options):
+    '''
+    Does the work of patch_archive() for newc cpio archives. Unmodified members
+    (headers included) are copied through byte for byte, as is anything after the
+    trailer; concatenated archives, as found in initramfs images, are all patched.
+    '''
+    while True:
+        header = reader.read_exactly(CPIO_HEADER_SIZE)
+        if header[0:6] not in CPIO_MAGICS:
+            raise BotoxException("Invalid cpio header!")
+
+        try:
+            fields = dict(zip(CPIO_FIELDS, [int(header[6+(8*n):6+(8*(n+1))], 16) for n in range(0, len(CPIO_FIELDS))]))
+        except ValueError:
+            raise BotoxException("Invalid cpio header!")
+
+        name_size = fields["namesize"] + ((4 - ((CPIO_HEADER_SIZE + fields["namesize"]) % 4)) % 4)
+        name_field = reader.read_exactly(name_size)
+        name = name_field[0:fields["namesize"]].rstrip("\x00")
+        data_padding = (4 - (fields["filesize"] % 4)) % 4
+
+        if name == CPIO_TRAILER:
+            if destination is not None:
+                destination.write(header + name_field)
+            _patch_cpio_trailer(reader, destination, patterns, patcher, summary, dry_run, options)
+            return
+
+        summary["members"] += 1
+
+        # Hard linked files have their contents stored with the last link only
+        if (fields["mode"] & S_IFMT) != S_IFREG or fields["filesize"] == 0 or not member_matches(name, patterns):
+            if destination is not None:
+                destination.write(header + name_field)
+            _copy(reader, destination, fields["filesize"] + data_padding)
+            continue
+
+        data = reader.read_exactly(fields["filesize"])
+        reader.read_exactly(data_padding)
+        patched = _patch_member(name, data, patcher, summary, dry_run, options)
+
+        if patched is not data:
+            header = header[0:CPIO_FILESIZE_OFFSET] + ("%08X" % len(patched)) + header[CPIO_FILESIZE_OFFSET+8:]
+            # 070702 archives carry a checksum of the file's contents
+            if header[0:6] == "070702":
+                header = header[0:CPIO_CHECK_OFFSET] + ("%08X" % (sum(bytearray(patched)) & 0xFFFFFFFF)) + header[CPIO_CHECK_OFFSET+8:]
+
+        if destination is not None:
+            destination.write(header + name_field)
+            destination.write(patched)
+            destination.write("\x00" * ((4 - (len(patched) % 4)) % 4))
+
+def _patch_cpio_trailer(reader, destination, patterns, patcher, summary, dry_run, options):
+    '''
+    Copies the padding after a cpio trailer, then patches the next archive, if there is one.
+    '''
+    while True:
+        chunk = reader.read(stream.CHUNK_SIZE)
+        if not chunk:
+            return
+
+        data = chunk.lstrip("\x00")
+        if destination is not None:
+            destination.write(chunk[0:len(chunk)-len(data)])
+        if not data:
+            continue
+
+        if len(data) < 6:
+            data += reader.read(6 - len(data))
+        reader.unread(data)
+
+        if detect_format(data) != CPIO:
+            _copy_rest(reader, destination)
+            return
+
+        _patch_cpio(reader, destination, patterns, patcher, summary, dry_run, options)
+        return
+
+def _copy_rest(reader, destination):
+    '''
+    Copies everything left in reader to destination (if not None).
+    '''
+    while True:
+        chunk = reader.read(stream.CHUNK_SIZE)
+        if not chunk:
+            break
+        if destination is not None:
+            destination.write(chunk)
+
+def patch_archive(source, destination, patterns, patcher, dry_run=False, **options):
+    '''
+    Streams a tar or newc cpio archive from source to destination, patching the ELF
+    files among the members whose names match any of the glob patterns in memory
+    (see Botox.patch_bytes()). All other members are copied through unmodified,
+    without being extracted. Only one matching member is held in memory at a time.
+
+    Matching members that Botox declines to patch (non-ELF files, already patched
+    files, unsupported architectures, etc) or fails to patch are copied through
+    unmodified too.
+
+    gzip and bzip2 compressed tar archives are written with the same compression.
+    Compressed cpio archives must be decompressed first (e.g., with gzip -dc).
+
+    @source      - The file object to read the archive from.
+    @destination - The file object to write the patched archive to, or None.
+    @patterns    - List of glob patterns for the names of the members to patch.
+    @patcher     - The Botox instance to patch with.
+    @dry_run     - Set to True to only plan the patches, and not write anything.
+    @options     - Keyword arguments for Botox.patch_bytes() (target, placement, padding, etc).
+
+    Returns a summary dictionary, with the format, the number of members, and
+    lists of the patched (or, with dry_run, patchable), skipped and failed members.
+    '''
+    summary = {"members" : 0, "patched" : [], "skipped" : [], "failed" : []}
+    start = time.time()
+
+    if dry_run == True:
+        destination = None
+
+    reader = _Reader(source)
+    head = reader.read(6)
+    reader.unread(head)
+
+    summary["format"] = detect_format(head)
+    if summary["format"] == CPIO:
+        _patch_cpio(reader, destination, patterns, patcher, summary, dry_run, options)
+    else:
+        _patch_tar(reader, destination, patterns, patcher, summary, dry_run, options)
+
+    summary["counts"] = dict((status, len(summary[status])) for status in ["patched", "skipped", "failed"])
+    summary["seconds"] = time.time() - start
+
+    return summary
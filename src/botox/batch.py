@@ -0,0 +1,239 @@
+import os
+import time
+import json
+import multiprocessing
+
+import scan
+import cache
+import botox
+from stats import Stats
+from exceptions import BotoxException
+
+ELF_MAGIC = "\x7FELF"
+
+# Number of files handed to a worker process at a time
+CHUNK_SIZE = 16
+
+# Per-process state of the worker processes; see _init_worker()
+_options = None
+_architectures = None
+_store = None
+
+def is_elf(path):
+    '''
+    Checks if a file is an ELF file, reading only the magic bytes of its e_ident.
+
+    @path - Path to the file.
+
+    Returns True if the file is an ELF file.
+    '''
+    try:
+        with open(path, "rb") as fp:
+            return fp.read(len(ELF_MAGIC)) == ELF_MAGIC
+    except (IOError, OSError):
+        return False
+
+def find_files(paths, recursive=False):
+    '''
+    Lists the regular files to be patched. Symbolic links are not followed,
+    so that no file is patched twice.
+
+    @paths     - List of file and directory paths.
+    @recursive - Set to True to include all files in directory trees.
+
+    Yields a (path, reason) tuple for each file, where reason is None if the
+    file should be patched, and otherwise explains why it is skipped.
+    '''
+    for path in paths:
+        if os.path.islink(path):
+            yield (path, "symbolic link")
+        elif os.path.isdir(path):
+            if recursive == False:
+                yield (path, "directory")
+                continue
+
+            for (root, dirs, files) in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    if os.path.islink(file_path):
+                        yield (file_path, "symbolic link")
+                    elif not os.path.isfile(file_path):
+                        yield (file_path, "not a regular file")
+                    else:
+                        yield (file_path, None)
+        elif not os.path.isfile(path):
+            yield (path, "not a regular file")
+        else:
+            yield (path, None)
+
+def _init_worker(options, store=None):
+    '''
+    Initializes a worker process.
+
+    @options - Dictionary of keyword arguments for Botox.patch().
+    @store   - An instance of store.PatchStore, or None.
+
+    Returns None.
+    '''
+    global _options
+    global _architectures
+    global _store
+
+    _options = options
+    _architectures = {}
+    _store = store
+
+def _summarize(result, options=None):
+    '''
+    Adds the file's summary for the parse cache to a _patch_file() result.
+
+    @result  - The result dictionary.
+    @options - The Botox.patch() options, if the summary's patchable and reason
+               depend on them (i.e., Botox declined to patch the file).
+
+    Returns result.
+    '''
+    key = cache.file_key(result["path"])
+    summary = scan.scan_file(result["path"])
+
+    if result["status"] == "patched":
+        summary["placement"] = _options.get("placement", botox.INSERT)
+    elif options is not None:
+        summary["patchable"] = False
+        summary["reason"] = result["reason"]
+        summary["options"] = options
+
+    result["cache"] = (key, summary)
+    return result
+
+def _patch_file(item):
+    '''
+    Patches one file in a worker process.
+
+    @item - A (path, reason, cached) tuple: reason is as yielded by find_files(),
+            and cached is True if the parent process has a parse cache.
+
+    Returns a dictionary describing the result.
+    '''
+    (path, reason, cached) = item
+
+    if reason is None and is_elf(path) == False:
+        reason = "not an ELF file"
+    if reason is not None:
+        result = {"path" : path, "status" : "skipped", "reason" : reason}
+        if cached == True and reason == "not an ELF file":
+            _summarize(result)
+        return result
+
+    patcher = botox.Botox(path, architectures=_architectures, store=_store)
+    try:
+        entry_point = patcher.patch(**_options)
+        result = {"path" : path, "status" : "patched", "entry_point" : entry_point, "stats" : patcher.stats.to_dict()}
+        options = None
+    except KeyboardInterrupt as e:
+        raise e
+    # Botox declined to patch the file (already patched, unsupported architecture, etc)
+    except BotoxException as e:
+        result = {"path" : path, "status" : "skipped", "reason" : str(e), "stats" : patcher.stats.to_dict()}
+        options = _options
+    except Exception as e:
+        return {"path" : path, "status" : "failed", "error" : "%s: %s" % (e.__class__.__name__, str(e))}
+
+    if cached == True:
+        _summarize(result, options)
+    return result
+
+def _cached_skip(path, parse_cache, options):
+    '''
+    Looks up a file in the parse cache.
+
+    @path        - Path to the file.
+    @parse_cache - An instance of cache.ParseCache.
+    @options     - The Botox.patch() options.
+
+    Returns a skipped result if the file is unchanged since it was last found to
+    be unpatchable, otherwise None.
+    '''
+    summary = parse_cache.get(cache.file_key(path))
+    if summary is None or summary["patchable"] == True:
+        return None
+
+    # Botox's reasons for declining may not apply with different options
+    if summary.get("options") not in [None, options]:
+        return None
+
+    return {"path" : path, "status" : "skipped", "reason" : summary["reason"], "cached" : True}
+
+def patch_files(paths, jobs=None, recursive=False, stats=None, parse_cache=None, store=None, **options):
+    '''
+    Patches many ELF files in place, in parallel. Non-ELF files are skipped, as are
+    ELF files which Botox declines to patch (e.g., ones which are already patched).
+
+    @paths       - List of file and directory paths.
+    @jobs        - Number of worker processes; defaults to the number of CPUs.
+                   With 1 job, files are patched in this process.
+    @recursive   - Set to True to patch all files in directory trees.
+    @stats       - An instance of stats.Stats to add each file's statistics to, or None.
+    @parse_cache - An instance of cache.ParseCache, or None. Files which haven't changed
+                   since they were found to be unpatchable (e.g., already patched) are
+                   skipped without being opened. Only this process uses it.
+    @store       - An instance of store.PatchStore to look patched files up in, or None.
+    @options     - Keyword arguments for Botox.patch() (target, placement, padding, etc).
+
+    Returns a summary dictionary, with lists of the patched, skipped and failed files.
+    '''
+    summary = {"patched" : [], "skipped" : [], "failed" : []}
+    start = time.time()
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    # Options are compared with cached (JSON) ones
+    cached_options = json.loads(json.dumps(options))
+
+    def items():
+        for (path, reason) in find_files(paths, recursive):
+            if reason is None and parse_cache is not None:
+                result = _cached_skip(path, parse_cache, cached_options)
+                if result is not None:
+                    summary[result.pop("status")].append(result)
+                    continue
+            yield (path, reason, (parse_cache is not None))
+    items = items()
+
+    if jobs <= 1:
+        _init_worker(options, store)
+        results = (_patch_file(item) for item in items)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(options, store))
+        results = pool.imap_unordered(_patch_file, items, CHUNK_SIZE)
+
+    try:
+        for result in results:
+            status = result.pop("status")
+            file_stats = result.pop("stats", None)
+            if stats is not None and file_stats is not None:
+                stats.merge(file_stats)
+            if "cache" in result:
+                parse_cache.put(*result.pop("cache"))
+            summary[status].append(result)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    for status in ["patched", "skipped", "failed"]:
+        summary[status].sort(key=lambda result: result["path"])
+
+    summary["counts"] = dict((status, len(summary[status])) for status in ["patched", "skipped", "failed"])
+    summary["seconds"] = time.time() - start
+
+    return summary
+
+def to_json(summary):
+    '''
+    Returns a patch_files() summary as a JSON string.
+    '''
+    return json.dumps(summary, indent=4, sort_keys=True)
@@ -0,0 +1,121 @@
+import os
+import json
+import sqlite3
+import threading
+
+# Bumped whenever the format of the cached summaries changes; older caches are discarded
+CACHE_VERSION = 2
+
+# Number of new summaries written before they are committed to disk
+COMMIT_INTERVAL = 1000
+
+def file_key(path):
+    '''
+    Returns the key a file's summary is cached under: its (device, inode, size,
+    mtime in nanoseconds), or None if the file can't be stat'd. Any change to the
+    file's contents changes its size or mtime, so stale entries are never hit.
+
+    @path - Path to the file.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1000000000))
+
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+class ParseCache(object):
+    '''
+    On-disk (SQLite) cache of per-file ELF summaries, as produced by scan.scan_file(),
+    keyed by file_key(). The scanner and batch patching use it to skip files which
+    haven't changed since they were last looked at.
+
+    Instances may be shared between threads, but not between processes.
+    '''
+
+    def __init__(self, path):
+        '''
+        Class constructor.
+
+        @path - Path to the SQLite database; it is created if it doesn't exist.
+
+        Returns None.
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = 0
+
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS summaries")
+            self.db.execute("PRAGMA user_version=%d" % CACHE_VERSION)
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS summaries ("
+                        "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, summary TEXT, "
+                        "PRIMARY KEY (dev, ino, size, mtime_ns))")
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, b):
+        self.close()
+        return None
+
+    def get(self, key):
+        '''
+        Looks up a cached summary.
+
+        @key - The file's key, as returned by file_key().
+
+        Returns the summary dictionary, or None if there is no entry for the key.
+        '''
+        if key is None:
+            return None
+
+        with self.lock:
+            row = self.db.execute("SELECT summary FROM summaries WHERE dev=? AND ino=? AND size=? AND mtime_ns=?", key).fetchone()
+
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, summary):
+        '''
+        Caches a summary. Any older entries for the same file are replaced.
+
+        @key     - The file's key, as returned by file_key() *before* the file was read.
+        @summary - The summary dictionary.
+
+        Returns None.
+        '''
+        if key is None:
+            return None
+
+        with self.lock:
+            self.db.execute("DELETE FROM summaries WHERE dev=? AND ino=?", key[0:2])
+            self.db.execute("INSERT INTO summaries VALUES (?, ?, ?, ?, ?)", tuple(key) + (json.dumps(summary, sort_keys=True),))
+
+            self.pending += 1
+            if self.pending >= COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending = 0
+
+    def close(self):
+        '''
+        Commits any pending entries and closes the database.
+
+        Returns None.
+        '''
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
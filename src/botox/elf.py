@@ -1,7 +1,529 @@
 # http://www.skyfree.org/linux/references/ELF_Format.pdf
 # https://www.uclibc.org/docs/elf-64-gen.pdf
 import os
+import mmap
+import array
+import bisect
 import struct
+import collections
+
+# Declarative layouts of the ELF records, as (field name, struct format) pairs
+# listed in file order. Fields with a name of None are padding.
+ELF_IDENT = [
+                ("ei_magic",        "4s"),
+                ("ei_class",        "B"),
+                ("ei_encoding",     "B"),
+                ("ei_version",      "B"),
+            ]
+
+ELF32_EHDR = [
+                (None,              "16x"),     # e_ident, see ELF_IDENT
+                ("e_type",          "H"),
+                ("e_machine",       "H"),
+                ("e_version",       "I"),
+                ("e_entry",         "I"),
+                ("e_phoff",         "I"),
+                ("e_shoff",         "I"),
+                ("e_flags",         "I"),
+                ("e_ehsize",        "H"),
+                ("e_phentsize",     "H"),
+                ("e_phnum",         "H"),
+                ("e_shentsize",     "H"),
+                ("e_shnum",         "H"),
+                ("e_shstrndx",      "H"),
+             ]
+
+ELF64_EHDR = [
+                (None,              "16x"),     # e_ident, see ELF_IDENT
+                ("e_type",          "H"),
+                ("e_machine",       "H"),
+                ("e_version",       "I"),
+                ("e_entry",         "Q"),
+                ("e_phoff",         "Q"),
+                ("e_shoff",         "Q"),
+                ("e_flags",         "I"),
+                ("e_ehsize",        "H"),
+                ("e_phentsize",     "H"),
+                ("e_phnum",         "H"),
+                ("e_shentsize",     "H"),
+                ("e_shnum",         "H"),
+                ("e_shstrndx",      "H"),
+             ]
+
+ELF32_PHDR = [
+                ("p_type",          "I"),
+                ("p_offset",        "I"),
+                ("p_vaddr",         "I"),
+                ("p_paddr",         "I"),
+                ("p_filesz",        "I"),
+                ("p_memsz",         "I"),
+                ("p_flags",         "I"),
+                ("p_align",         "I"),
+             ]
+
+ELF64_PHDR = [
+                ("p_type",          "I"),
+                ("p_flags",         "I"),
+                ("p_offset",        "Q"),
+                ("p_vaddr",         "Q"),
+                ("p_paddr",         "Q"),
+                ("p_filesz",        "Q"),
+                ("p_memsz",         "Q"),
+                ("p_align",         "Q"),
+             ]
+
+ELF32_SHDR = [
+                ("sh_name",         "I"),
+                ("sh_type",         "I"),
+                ("sh_flags",        "I"),
+                ("sh_addr",         "I"),
+                ("sh_offset",       "I"),
+                ("sh_size",         "I"),
+                ("sh_link",         "I"),
+                ("sh_info",         "I"),
+                ("sh_addralign",    "I"),
+                ("sh_entsize",      "I"),
+             ]
+
+ELF64_SHDR = [
+                ("sh_name",         "I"),
+                ("sh_type",         "I"),
+                ("sh_flags",        "Q"),
+                ("sh_addr",         "Q"),
+                ("sh_offset",       "Q"),
+                ("sh_size",         "Q"),
+                ("sh_link",         "I"),
+                ("sh_info",         "I"),
+                ("sh_addralign",    "Q"),
+                ("sh_entsize",      "Q"),
+             ]
+
+ELF32_SYM = [
+                ("st_name",         "I"),
+                ("st_value",        "I"),
+                ("st_size",         "I"),
+                ("st_info",         "B"),
+                ("st_other",        "B"),
+                ("st_shndx",        "H"),
+            ]
+
+ELF64_SYM = [
+                ("st_name",         "I"),
+                ("st_info",         "B"),
+                ("st_other",        "B"),
+                ("st_shndx",        "H"),
+                ("st_value",        "Q"),
+                ("st_size",         "Q"),
+            ]
+
+# Record type : (ELFCLASS32 layout, ELFCLASS64 layout)
+LAYOUTS = {
+            "ident" : (ELF_IDENT, ELF_IDENT),
+            "ehdr"  : (ELF32_EHDR, ELF64_EHDR),
+            "phdr"  : (ELF32_PHDR, ELF64_PHDR),
+            "shdr"  : (ELF32_SHDR, ELF64_SHDR),
+            "sym"   : (ELF32_SYM, ELF64_SYM),
+          }
+
+class Elf_Layout(object):
+    '''
+    A record layout compiled for a specific ELF class and endianess.
+    Use Elf_Layout.get() rather than instantiating this class directly.
+    '''
+
+    # Compiled layouts, keyed by (record type, ELFCLASS64?, endianess)
+    _cache = {}
+
+    def __init__(self, fields, endianess):
+        '''
+        Class constructor.
+
+        @fields    - A list of (field name, struct format) pairs, as in LAYOUTS.
+        @endianess - The struct module endianess character, '<' or '>'.
+
+        Returns None.
+        '''
+        self.endianess = endianess
+        self.names = []
+        self.fields = {}
+
+        offset = 0
+        for (name, fmt) in fields:
+            field = struct.Struct(endianess + fmt)
+            if name is not None:
+                self.names.append(name)
+                self.fields[name] = (offset, field)
+            offset += field.size
+
+        # Decodes/encodes the whole record in one call
+        self.struct = struct.Struct(endianess + ''.join([fmt for (name, fmt) in fields]))
+        self.size = self.struct.size
+
+    @classmethod
+    def get(cls, record, elf64, endianess):
+        '''
+        Returns the compiled Elf_Layout for a record type.
+
+        @record    - The record type, one of the keys of LAYOUTS.
+        @elf64     - Set to True for ELFCLASS64 files.
+        @endianess - The struct module endianess character, '<' or '>'.
+
+        Returns an instance of Elf_Layout.
+        '''
+        key = (record, elf64, endianess)
+        try:
+            return cls._cache[key]
+        except KeyError:
+            layout = cls(LAYOUTS[record][int(elf64)], endianess)
+            cls._cache[key] = layout
+            return layout
+
+class Elf_Field(object):
+    '''
+    Descriptor for a record field; the field's offset and encoding are looked
+    up in the record's layout at access time.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, record, owner):
+        if record is None:
+            return self
+        return record.get_field(self.name)
+
+    def __set__(self, record, value):
+        record.set_field(self.name, value)
+
+def is_buffer(elfile):
+    '''
+    Returns True if elfile holds the contents of an ELF file, rather than its path.
+    '''
+    if isinstance(elfile, (bytearray, memoryview, buffer)):
+        return True
+    return isinstance(elfile, str) and "\x00" in elfile
+
+def elf_record(record):
+    '''
+    Class decorator which generates Elf_Field accessors for every field
+    of the given record type.
+
+    @record - The record type, one of the keys of LAYOUTS.
+
+    Returns the decorated class.
+    '''
+    def decorator(cls):
+        cls.RECORD = record
+        for layout in LAYOUTS[record]:
+            for (name, fmt) in layout:
+                if name is not None:
+                    setattr(cls, name, Elf_Field(name))
+        return cls
+    return decorator
+
+class Elf_Accessor(object):
+    '''
+    Mixin providing typed field accessors on top of a read(offset, size) /
+    write(offset, data) pair and an endianess property.
+    '''
+
+    def read_byte(self, offset):
+        return ord(self.read(offset, 1))
+    def write_byte(self, offset, value):
+        self.write(offset, chr(value))
+
+    def read_half(self, offset):
+        return struct.unpack("%sH" % self.endianess, self.read(offset, 2))[0]
+    def write_half(self, offset, value):
+        self.write(offset, struct.pack("%sH" % self.endianess, value))
+
+    def read_word(self, offset):
+        return struct.unpack("%sL" % self.endianess, self.read(offset, 4))[0]
+    def write_word(self, offset, value):
+        self.write(offset, struct.pack("%sL" % self.endianess, value))
+
+    def read_double(self, offset):
+        return struct.unpack("%sQ" % self.endianess, self.read(offset, 8))[0]
+    def write_double(self, offset, value):
+        self.write(offset, struct.pack("%sQ" % self.endianess, value))
+
+class Elf_Table(object):
+    '''
+    In-memory copy of one of the ELF header tables (the ELF header, the program
+    header table or the section header table). Writes only mark the table as
+    dirty; see ELF.commit().
+    '''
+
+    def __init__(self, data):
+        '''
+        Class constructor.
+
+        @data - The raw contents of the table, as read from the ELF file.
+
+        Returns None.
+        '''
+        self.data = bytearray(data)
+        self.dirty = False
+
+    def read(self, offset, size):
+        return str(self.data[offset:offset+size])
+
+    def write(self, offset, data):
+        self.data[offset:offset+len(data)] = data
+        self.dirty = True
+
+class Elf_Strtab(object):
+    '''
+    Class for reading/writing the contents of a string table section (.shstrtab,
+    .strtab, .dynstr, etc). The whole section is read in one go, and each string
+    is decoded only once.
+    '''
+
+    def __init__(self, elf, offset, size):
+        '''
+        Class constructor.
+
+        @elf    - Instance of the ELF class.
+        @offset - File offset of the string table.
+        @size   - Size of the string table, in bytes.
+
+        Returns None.
+        '''
+        self.elf = elf
+        self.offset = offset
+        self.size = size
+        self.data = elf.read(offset, size)
+        self.strings = {}
+
+    def get(self, index):
+        '''
+        Returns the NULL terminated string at the given index into the table.
+        '''
+        try:
+            return self.strings[index]
+        except KeyError:
+            end = self.data.find("\x00", index)
+            if end == -1:
+                # Unterminated, or runs past the end of the section; let the
+                # file decide where it ends.
+                string = self.elf.read_string(self.offset + index)
+            else:
+                string = self.data[index:end]
+
+            self.strings[index] = string
+            return string
+
+    def overlaps(self, offset, size):
+        '''
+        Returns True if the given file range overlaps this string table.
+        '''
+        return offset < (self.offset + self.size) and (offset + size) > self.offset
+
+# A single entry from a symbol table; type and bind are decoded from st_info.
+Elf_Symbol = collections.namedtuple("Elf_Symbol", ["name", "value", "size", "type", "bind", "shndx"])
+
+class Elf_Symbols(object):
+    '''
+    Index of the defined symbols in an ELF file's .symtab and .dynsym sections.
+
+    Names are looked up in a dictionary; addresses are looked up by bisecting
+    a sorted array of symbol addresses. Each symbol table section is read in
+    one go, and only symbols which name code or data are indexed.
+    '''
+
+    def __init__(self, elf):
+        '''
+        Class constructor.
+
+        @elf - Instance of the ELF class.
+
+        Returns None.
+        '''
+        self.by_name = {}
+        symbols = []
+
+        # .symtab is a superset of .dynsym, so index it first; the first
+        # symbol seen with any given name wins.
+        for sh_type in [ELF.SHT_SYMTAB, ELF.SHT_DYNSYM]:
+            for shdr in elf.section_headers:
+                if shdr.sh_type == sh_type:
+                    for symbol in self._load(elf, shdr):
+                        if symbol.name not in self.by_name:
+                            self.by_name[symbol.name] = symbol
+                        symbols.append(symbol)
+
+        # TLS symbol values are offsets into the TLS segment, not addresses
+        symbols = [symbol for symbol in symbols if symbol.type != ELF.STT_TLS]
+        symbols.sort(key=lambda symbol: symbol.value)
+        self.symbols = symbols
+
+        # Addresses are kept in an array rather than a list of Python ints,
+        # unless they won't fit in the platform's unsigned long.
+        addresses = [symbol.value for symbol in symbols]
+        try:
+            self.addresses = array.array('L', addresses)
+        except OverflowError:
+            self.addresses = addresses
+
+    def _load(self, elf, shdr):
+        '''
+        Reads the defined symbols from a symbol table section.
+
+        @elf  - Instance of the ELF class.
+        @shdr - The symbol table's section header.
+
+        Returns a list of Elf_Symbol tuples.
+        '''
+        layout = elf.layout("sym")
+        entsize = shdr.sh_entsize or layout.size
+        strtab = elf.string_table(shdr.sh_link)
+        data = elf.read(shdr.sh_offset, shdr.sh_size)
+
+        st_name = layout.names.index("st_name")
+        st_value = layout.names.index("st_value")
+        st_size = layout.names.index("st_size")
+        st_info = layout.names.index("st_info")
+        st_shndx = layout.names.index("st_shndx")
+
+        symbols = []
+        for offset in range(0, len(data) - layout.size + 1, entsize):
+            values = layout.struct.unpack_from(data, offset)
+
+            sym_type = values[st_info] & 0xF
+            if values[st_shndx] in [ELF.SHN_UNDEF, ELF.SHN_ABS] or sym_type in [ELF.STT_SECTION, ELF.STT_FILE]:
+                continue
+
+            name = strtab.get(values[st_name])
+            if name:
+                symbols.append(Elf_Symbol(name, values[st_value], values[st_size], sym_type, values[st_info] >> 4, values[st_shndx]))
+
+        return symbols
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def get(self, name):
+        '''
+        Returns the Elf_Symbol with the given name, or None if there isn't one.
+        '''
+        return self.by_name.get(name)
+
+    def at(self, address):
+        '''
+        Returns the Elf_Symbol whose address range contains the given address
+        (or which starts at it, for symbols with no size), or None if there isn't one.
+        '''
+        index = bisect.bisect_right(self.addresses, address) - 1
+        if index < 0:
+            return None
+
+        symbol = self.symbols[index]
+        if address < (symbol.value + max(symbol.size, 1)):
+            return symbol
+
+        return None
+
+class Elf_Record(Elf_Accessor):
+    '''
+    Base class for the ELF header and program/section header entries.
+
+    Field offsets passed to read/write are relative to the start of the record.
+    If the ELF class has loaded its header tables into memory, fields are read
+    from and written to the in-memory table; otherwise they go straight to disk.
+
+    Subclasses are decorated with elf_record(), which generates an accessor for
+    each field in the record's layout.
+    '''
+
+    # The record type, one of the keys of LAYOUTS. Set by elf_record().
+    RECORD = None
+
+    def _table(self):
+        '''
+        Returns the Elf_Table this record lives in, or None if the header tables are not cached.
+        '''
+        return None
+
+    def _table_offset(self):
+        '''
+        Returns the offset of this record from the start of its Elf_Table.
+        '''
+        return 0
+
+    def _file_offset(self):
+        '''
+        Returns the offset of this record from the start of the ELF file.
+        '''
+        return 0
+
+    @property
+    def endianess(self):
+        return self.elf.endianess
+
+    @property
+    def layout(self):
+        return self.elf.layout(self.RECORD)
+
+    def read(self, offset, size):
+        table = self._table()
+        if table is None:
+            return self.elf.read(self._file_offset() + offset, size)
+        return table.read(self._table_offset() + offset, size)
+
+    def write(self, offset, data):
+        table = self._table()
+        if table is None:
+            return self.elf.write(self._file_offset() + offset, data)
+        return table.write(self._table_offset() + offset, data)
+
+    def get_field(self, name):
+        '''
+        Reads a field from the record.
+
+        @name - The field name, as listed in the record's layout.
+
+        Returns the field value.
+        '''
+        (offset, field) = self.layout.fields[name]
+
+        table = self._table()
+        if table is None:
+            return field.unpack(self.elf.read(self._file_offset() + offset, field.size))[0]
+        return field.unpack_from(table.data, self._table_offset() + offset)[0]
+
+    def set_field(self, name, value):
+        '''
+        Writes a field to the record.
+
+        @name  - The field name, as listed in the record's layout.
+        @value - The new field value.
+
+        Returns None.
+        '''
+        (offset, field) = self.layout.fields[name]
+
+        table = self._table()
+        if table is None:
+            self.elf.write(self._file_offset() + offset, field.pack(value))
+        else:
+            field.pack_into(table.data, self._table_offset() + offset, value)
+            table.dirty = True
+
+    def unpack(self):
+        '''
+        Decodes the entire record in one call.
+
+        Returns a dictionary of field names and values.
+        '''
+        layout = self.layout
+
+        table = self._table()
+        if table is None:
+            values = layout.struct.unpack(self.elf.read(self._file_offset(), layout.size))
+        else:
+            values = layout.struct.unpack_from(table.data, self._table_offset())
+
+        return dict(zip(layout.names, values))
 
 class Elf_Shdr_Flags(object):
     '''
@@ -54,7 +576,8 @@ class Elf_Shdr_Flags(object):
         else:
             self.shdr.sh_flags &= ~4
 
-class Elf_Shdr(object):
+@elf_record("shdr")
+class Elf_Shdr(Elf_Record):
     '''
     Class for reading/writing the contents of an ELF section header entry.
     '''
@@ -71,147 +594,44 @@ class Elf_Shdr(object):
         self.elf = elf
         self.index = n
 
-        if self.elf.header.e_shstrndx != self.index:
+        if self.elf.shstrndx == self.index:
             self._name = ".shstrtab"
         else:
             self._name = None
 
         self.flags = Elf_Shdr_Flags(self)
 
+    def _table(self):
+        return self.elf._shdr_table
+
+    def _table_offset(self):
+        return self.elf.header.e_shentsize * self.index
+
+    def _file_offset(self):
+        return self.elf.header.e_shoff + (self.elf.header.e_shentsize * self.index)
+
+    def __str__(self):
+        # Lets callers pass section headers as format arguments, deferring
+        # the name lookup until the string is actually formatted.
+        return self.name
+
     @property
     def name(self):
-        if self.index != self.elf.header.e_shstrndx:
-            return self.elf.read_string(self.elf.shstrtab.sh_offset + self.sh_name)
+        if self.index != self.elf.shstrndx:
+            return self.elf.string_table(self.elf.shstrndx).get(self.sh_name)
         else:
             return self._name
     @name.setter
     def name(self, value):
-        if self.index != self.elf.header.e_shstrndx:
+        if self.index != self.elf.shstrndx:
             current_name = self.name
-            if len(current_name) > len(value):
+            if len(value) > len(current_name):
                 raise Exception("New section header name must be of equal of lesser length than the current name (%s)!" % current_name)
             else:
                 self.elf.write_string(self.elf.shstrtab.sh_offset + self.sh_name, value)
         else:
             self._name = value
-
-    @property
-    def sh_name(self):
-        return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+0)
-    @sh_name.setter
-    def sh_name(self, value):
-        self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+0, value)
-
-    @property
-    def sh_type(self):
-        return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+4)
-    @sh_type.setter
-    def sh_type(self, value):
-        self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+4, value)
-
-    @property
-    def sh_flags(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+8)
-        else:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+8)
-    @sh_flags.setter
-    def sh_flags(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+8, value)
-        else:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+8, value)
-
-    @property
-    def sh_addr(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+16)
-        else:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+12)
-    @sh_addr.setter
-    def sh_addr(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+16, value)
-        else:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+12, value)
-
-    @property
-    def sh_offset(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+24)
-        else:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+16)
-    @sh_offset.setter
-    def sh_offset(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+24, value)
-        else:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+16, value)
-
-    @property
-    def sh_size(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+32)
-        else:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+20)
-    @sh_size.setter
-    def sh_size(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+32, value)
-        else:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+20, value)
-
-    @property
-    def sh_link(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+40)
-        else:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+24)
-    @sh_link.setter
-    def sh_link(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+40, value)
-        else:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+24, value)
-
-    @property
-    def sh_info(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+44)
-        else:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+28)
-    @sh_info.setter
-    def sh_info(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+44, value)
-        else:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+28, value)
-
-    @property
-    def sh_addralign(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+48)
-        else:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+32)
-    @sh_addralign.setter
-    def sh_addralign(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+48, value)
-        else:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+32, value)
-
-    @property
-    def sh_entsize(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+56)
-        else:
-            return self.elf.read_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+36)
-    @sh_entsize.setter
-    def sh_entsize(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+56, value)
-        else:
-            self.elf.write_word(self.elf.header.e_shoff+(self.elf.header.e_shentsize*self.index)+36, value)
+        self.elf._section_index = None
 
 class Elf_Phdr_Flags(object):
     '''
@@ -264,7 +684,8 @@ class Elf_Phdr_Flags(object):
         else:
             self.phdr.p_flags &= ~0b001
 
-class Elf_Phdr(object):
+@elf_record("phdr")
+class Elf_Phdr(Elf_Record):
     '''
     Class for reading/writing the contents of an ELF program header entry.
     '''
@@ -282,105 +703,17 @@ class Elf_Phdr(object):
         self.index = n
         self.flags = Elf_Phdr_Flags(self)
 
-    @property
-    def p_type(self):
-        return self.elf.read_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+0)
-    @p_type.setter
-    def p_type(self, value):
-        self.elf.write_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+0, value)
-
-    @property
-    def p_offset(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+8)
-        else:
-            return self.elf.read_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+4)
-    @p_offset.setter
-    def p_offset(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+8, value)
-        else:
-            self.elf.write_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+4, value)
-
-    @property
-    def p_vaddr(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+16)
-        else:
-            return self.elf.read_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+8)
-    @p_vaddr.setter
-    def p_vaddr(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+16, value)
-        else:
-            self.elf.write_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+8, value)
-
-    @property
-    def p_paddr(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+24)
-        else:
-            return self.elf.read_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+12)
-    @p_paddr.setter
-    def p_paddr(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+24, value)
-        else:
-            self.elf.write_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+12, value)
-
-    @property
-    def p_filesz(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+32)
-        else:
-            return self.elf.read_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+16)
-    @p_filesz.setter
-    def p_filesz(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+32, value)
-        else:
-            self.elf.write_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+16, value)
+    def _table(self):
+        return self.elf._phdr_table
 
-    @property
-    def p_memsz(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+40)
-        else:
-            return self.elf.read_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+20)
-    @p_memsz.setter
-    def p_memsz(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+40, value)
-        else:
-            self.elf.write_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+20, value)
+    def _table_offset(self):
+        return self.elf.header.e_phentsize * self.index
 
-    @property
-    def p_flags(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+4)
-        else:
-            return self.elf.read_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+24)
-    @p_flags.setter
-    def p_flags(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+4, value)
-        else:
-            self.elf.write_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+24, value)
-
-    @property
-    def p_align(self):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            return self.elf.read_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+48)
-        else:
-            return self.elf.read_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+28)
-    @p_align.setter
-    def p_align(self, value):
-        if self.elf.ELFCLASS64 == self.elf.header.e_ident.ei_class:
-            self.elf.write_double(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+48, value)
-        else:
-            self.elf.write_word(self.elf.header.e_phoff+(self.elf.header.e_phentsize*self.index)+28, value)
+    def _file_offset(self):
+        return self.elf.header.e_phoff + (self.elf.header.e_phentsize * self.index)
 
-class Elf_Ident(object):
+@elf_record("ident")
+class Elf_Ident(Elf_Record):
     '''
     Class for reading/writing the contents of the e_ident section of the ELF header.
     '''
@@ -395,35 +728,21 @@ class Elf_Ident(object):
         '''
         self.elf = elf
 
-    @property
-    def ei_magic(self):
-        return self.elf.read(0, 4)
-    @ei_magic.setter
-    def ei_magic(self, value):
-        self.elf.write(0, value[0:3])
-
-    @property
-    def ei_class(self):
-        return self.elf.read_byte(4)
-    @ei_class.setter
-    def ei_class(self, value):
-        self.elf.write_byte(4, value)
+    def _table(self):
+        return self.elf._ehdr_table
 
     @property
-    def ei_encoding(self):
-        return self.elf.read_byte(5)
-    @ei_encoding.setter
-    def ei_encoding(self, value):
-        return self.elf.write_byte(5, value)
+    def layout(self):
+        # e_ident is independent of the ELF class and endianess
+        return Elf_Layout.get(self.RECORD, False, '<')
 
-    @property
-    def ei_version(self):
-        return self.elf.read_byte(6)
-    @ei_version.setter
-    def ei_version(self, value):
-        return self.elf.write_byte(6, value)
+    def set_field(self, name, value):
+        Elf_Record.set_field(self, name, value)
+        # Changing the class or endianess changes the layout of every other record
+        self.elf.reset_layouts()
 
-class Elf_Header(object):
+@elf_record("ehdr")
+class Elf_Header(Elf_Record):
     '''
     Class for reading/writing the contents of an ELF header.
     '''
@@ -439,158 +758,10 @@ class Elf_Header(object):
         self.elf = elf
         self.e_ident = Elf_Ident(self.elf)
 
-    @property
-    def e_type(self):
-        return self.elf.read_half(16)
-    @e_type.setter
-    def e_type(self, value):
-        self.elf.write_half(16, value)
-
-    @property
-    def e_machine(self):
-        return self.elf.read_half(18)
-    @e_machine.setter
-    def e_machine(self, value):
-        self.elf.write_half(18, value)
+    def _table(self):
+        return self.elf._ehdr_table
 
-    @property
-    def e_version(self):
-        return self.elf.read_word(20)
-    @e_version.setter
-    def e_version(self, value):
-        self.elf.write_word(20, value)
-
-    @property
-    def e_entry(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf.read_double(24)
-        else:
-            return self.elf.read_word(24)
-    @e_entry.setter
-    def e_entry(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_double(24, value)
-        else:
-            self.elf.write_word(24, value)
-
-    @property
-    def e_phoff(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf.read_double(32)
-        else:
-            return self.elf.read_word(28)
-    @e_phoff.setter
-    def e_phoff(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_double(32)
-        else:
-            self.elf.write_word(28, value)
-
-    @property
-    def e_shoff(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf.read_double(40)
-        else:
-            return self.elf.read_word(32)
-    @e_shoff.setter
-    def e_shoff(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_double(40, value)
-        else:
-            self.elf.write_word(32, value)
-
-    @property
-    def e_flags(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf_read_word(48)
-        else:
-            return self.elf.read_word(36)
-    @e_flags.setter
-    def e_flags(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_word(48, value)
-        else:
-            self.elf.write_word(36, value)
-
-    @property
-    def e_ehsize(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf.read_half(52)
-        else:
-            return self.elf.read_half(40)
-    @e_ehsize.setter
-    def e_ehsize(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_half(52, value)
-        else:
-            self.elf.write_half(40, value)
-
-    @property
-    def e_phentsize(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf.read_half(54)
-        else:
-            return self.elf.read_half(42)
-    @e_phentsize.setter
-    def e_phentsize(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_half(54, value)
-        else:
-            self.elf.write_half(42, value)
-
-    @property
-    def e_phnum(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf.read_half(56)
-        else:
-            return self.elf.read_half(44)
-    @e_phnum.setter
-    def e_phnum(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_half(56, value)
-        else:
-            self.elf.write_half(44, value)
-
-    @property
-    def e_shentsize(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf.read_half(58)
-        else:
-            return self.elf.read_half(46)
-    @e_shentsize.setter
-    def e_shentsize(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_half(58, value)
-        else:
-            self.elf.write_half(46, value)
-
-    @property
-    def e_shnum(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf.read_half(60)
-        else:
-            return self.elf.read_half(48)
-    @e_shnum.setter
-    def e_shnum(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_half(60, value)
-        else:
-            self.elf.write_half(48, value)
-
-    @property
-    def e_shstrndx(self):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            return self.elf.read_half(62)
-        else:
-            return self.elf.read_half(50)
-    @e_shstrndx.setter
-    def e_shstrndx(self, value):
-        if self.elf.ELFCLASS64 == self.e_ident.ei_class:
-            self.elf.write_half(62, value)
-        else:
-            self.elf.write_half(50, value)
-
-class ELF(object):
+class ELF(Elf_Accessor):
     '''
     Primary class for accessing and manipulating ELF files.
     Most other classes consist primarily of setters/getters.
@@ -609,6 +780,18 @@ class ELF(object):
 
     If you want to make *sure* nothing gets accidentally written to disk, instantiate this class with
     read_only=True.
+
+    Instantiate this class with use_mmap=True to access the file through a memory mapping rather
+    than through seek/read/write calls.
+
+    Instead of a path, the ELF file may be given as a bytearray, memoryview or buffer (or a str
+    holding the file's contents, which is told apart from a path by the NUL bytes that every ELF
+    file has and no path can). The file is then patched in memory without touching the file system;
+    use getvalue() to get the patched contents.
+
+    Alternatively, instantiate this class with cache_headers=True to read the ELF header, program header
+    table and section header table into memory in one go. In this mode, reads and writes of header fields
+    only touch the in-memory copies; nothing is written back to disk until ELF.commit() is called.
     '''
 
     ELFDATA2LSB = 1
@@ -634,6 +817,10 @@ class ELF(object):
     PT_LOPROC = 0x70000000
     PT_HIPROC = 0x7FFFFFFF
 
+    PF_X = 0x1
+    PF_W = 0x2
+    PF_R = 0x4
+
     EM_NONE = 0
     EM_SPARC = 2
     EM_386 = 3
@@ -641,31 +828,82 @@ class ELF(object):
     EM_ARM = 40
     EM_X86_64 = 62
 
+    ELFMAG = "\x7FELF"
+    EI_NIDENT = 16
+
     ELFCLASSNONE = 0
     ELFCLASS32 = 1
     ELFCLASS64 = 2
 
+    SHT_NULL = 0
     SHT_SYMTAB = 2
+    SHT_NOBITS = 8
     SHT_DYNSYM = 11
 
-    def __init__(self, elfile, read_only=False):
+    SHN_UNDEF = 0
+    SHN_LORESERVE = 0xFF00
+    SHN_ABS = 0xFFF1
+    SHN_XINDEX = 0xFFFF
+
+    STT_NOTYPE = 0
+    STT_OBJECT = 1
+    STT_FUNC = 2
+    STT_SECTION = 3
+    STT_FILE = 4
+    STT_TLS = 6
+
+    SHF_WRITE = 0x1
+    SHF_ALLOC = 0x2
+    SHF_EXECINSTR = 0x4
+
+    # Default size of the buffer used to shift file contents in insert()/delete()
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, elfile, read_only=False, cache_headers=False, use_mmap=False, buffer_size=DEFAULT_BUFFER_SIZE, stats=None):
         '''
         Class constructor.
 
-        @elfile    - The ELF file to load.
-        @read_only - Set to True for read-only access to the file.
+        @elfile        - The ELF file to load: a path, or the file's contents.
+        @read_only     - Set to True for read-only access to the file.
+        @cache_headers - Set to True to keep the header tables in memory until commit() is called.
+        @use_mmap      - Set to True to access the file through a memory mapping.
+        @buffer_size   - Maximum number of bytes held in memory while shifting file contents.
+        @stats         - An instance of stats.Stats to count file I/O with, or None.
 
         Returns None.
         '''
         self.read_only = read_only
+        self.stats = stats
+        self.buffer_size = buffer_size
+        self.cache_headers = cache_headers
+        self.use_mmap = use_mmap
+        self.map = None
+        self.buffer = None
+        self._layouts = {}
+
+        self._ehdr_table = None
+        self._phdr_table = None
+        self._shdr_table = None
+
+        self._string_tables = {}
+        self._section_index = None
+        self._symbols = None
 
         if self.read_only == True:
             self.file_mode = 'rb'
         else:
             self.file_mode = 'r+b'
 
-        # Get absolute path to the file
-        self.elfile = os.path.abspath(elfile)
+        if is_buffer(elfile):
+            self.elfile = None
+            if self.read_only == True and isinstance(elfile, str):
+                self.buffer = elfile
+            else:
+                # The contents are copied, so that the caller's buffer isn't modified
+                self.buffer = bytearray(elfile)
+        else:
+            # Get absolute path to the file
+            self.elfile = os.path.abspath(elfile)
 
         # Process the ELF header, along with program and section headers
         self._load_elf_file()
@@ -674,7 +912,7 @@ class ELF(object):
         return self
 
     def __exit__(self, t, v, b):
-        self.fp.close()
+        self._close_file()
         return None
 
     def _load_elf_file(self):
@@ -685,10 +923,37 @@ class ELF(object):
         '''
         # Open the ELF file
         self._open_file()
+        self._load_headers()
+
+    def _load_headers(self):
+        '''
+        Loads the ELF header, program headers and section headers.
+
+        Returns None.
+        '''
+        self.reset_layouts()
+        self._string_tables = {}
+        self._section_index = None
+        self._symbols = None
 
         # Create a ELF header object
         self.header = Elf_Header(self)
 
+        self.shnum = self.header.e_shnum
+        self.shstrndx = self.header.e_shstrndx
+
+        if self.cache_headers == True:
+            self._load_tables()
+
+        # Files with SHN_LORESERVE or more sections keep the real section count
+        # and string table index in the first section header.
+        if self.header.e_shoff != 0 and (self.shnum == 0 or self.shstrndx == self.SHN_XINDEX):
+            first = Elf_Shdr(self, 0)
+            if self.shnum == 0:
+                self.shnum = first.sh_size
+            if self.shstrndx == self.SHN_XINDEX:
+                self.shstrndx = first.sh_link
+
         # Grab all the program headers
         self.program_headers = []
         for n in range(0, self.header.e_phnum):
@@ -697,24 +962,135 @@ class ELF(object):
 
         # Get the strings section header so that subsequent section
         # headers can resolve their section names.
-        self.shstrtab = Elf_Shdr(self, self.header.e_shstrndx)
+        self.shstrtab = Elf_Shdr(self, self.shstrndx)
 
         # Grab all the section headers
         self.section_headers = []
-        for n in range(0, self.header.e_shnum):
+        for n in range(0, self.shnum):
             shdr = Elf_Shdr(self, n)
             self.section_headers.append(shdr)
 
-    # The below methods are the only ones that should touch self.fp
-    # directly! All others should be wrappers around these.
+    def _load_tables(self):
+        '''
+        Reads the ELF header, program header table and section header table
+        into memory, one read per table.
+
+        Returns None.
+        '''
+        self._ehdr_table = None
+        self._phdr_table = None
+        self._shdr_table = None
+
+        if self.ELFCLASS64 == self.header.e_ident.ei_class:
+            ehdr_size = 64
+        else:
+            ehdr_size = 52
+
+        # Load the ELF header first, so that the offsets and sizes of the
+        # other two tables are read from memory.
+        self._ehdr_table = Elf_Table(self.read(0, ehdr_size))
+        self._phdr_table = Elf_Table(self.read(self.header.e_phoff, self.header.e_phentsize * self.header.e_phnum))
+
+        shnum = self.header.e_shnum
+        if shnum == 0 and self.header.e_shoff != 0:
+            shnum = Elf_Shdr(self, 0).sh_size
+        self._shdr_table = Elf_Table(self.read(self.header.e_shoff, self.header.e_shentsize * shnum))
+
+    def commit(self):
+        '''
+        Writes any modified in-memory header tables back to the ELF file, one
+        write per table. The program and section header tables are written to
+        the offsets currently specified by e_phoff and e_shoff.
+
+        Only meaningful if the class was instantiated with cache_headers=True.
+
+        Returns None.
+        '''
+        for (offset, data) in self.dirty_tables():
+            self.write(offset, data)
+
+        for table in [self._phdr_table, self._shdr_table, self._ehdr_table]:
+            if table is not None:
+                table.dirty = False
+
+    def dirty_tables(self):
+        '''
+        Returns a list of (file offset, data) tuples for each of the in-memory header
+        tables that has been modified, in the order commit() writes them. The offsets
+        are those currently specified by e_phoff and e_shoff.
+
+        Only meaningful if the class was instantiated with cache_headers=True.
+        '''
+        if self._ehdr_table is None:
+            return []
+
+        return [(offset, str(table.data)) for (table, offset) in [(self._phdr_table, self.header.e_phoff),
+                                                                   (self._shdr_table, self.header.e_shoff),
+                                                                   (self._ehdr_table, 0)]
+                if table.dirty == True]
+
+    def getvalue(self):
+        '''
+        Returns the contents of the ELF file as a string.
+        '''
+        if self.buffer is not None:
+            return str(self.buffer)
+        return self.read(0, self.size)
+
+    # The below methods are the only ones that should touch self.fp, self.map
+    # and self.buffer directly! All others should be wrappers around these.
     def _open_file(self):
         '''
         Opens the ELF file whose path is listed in self.elfile.
 
         Returns None.
         '''
+        # In-memory files are always open
+        if self.buffer is not None:
+            self.fp = None
+            return None
+
         # Open the file in unbuffered mode
         self.fp = open(self.elfile, self.file_mode, 0)
+        self.map = None
+
+        if self.use_mmap == True:
+            self._map_file()
+    def _map_file(self):
+        '''
+        Maps the currently open ELF file into memory.
+
+        Returns None.
+        '''
+        if self.buffer is not None:
+            return None
+
+        if self.read_only == True:
+            access = mmap.ACCESS_READ
+        else:
+            access = mmap.ACCESS_WRITE
+
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=access)
+    def _unmap_file(self):
+        '''
+        Flushes and unmaps the ELF file, if it is mapped.
+
+        Returns None.
+        '''
+        if self.map is not None:
+            if self.read_only == False:
+                self.map.flush()
+            self.map.close()
+            self.map = None
+    def _close_file(self):
+        '''
+        Closes the ELF file.
+
+        Returns None.
+        '''
+        self._unmap_file()
+        if self.fp is not None:
+            self.fp.close()
     def _read_from_file(self, offset, size):
         '''
         Read data from the ELF file.
@@ -724,8 +1100,21 @@ class ELF(object):
 
         Returns a string of data read from the file.
         '''
-        self.fp.seek(offset)
-        return self.fp.read(size)
+        if self.buffer is not None:
+            data = str(self.buffer[offset:offset+size])
+        elif self.map is not None:
+            data = self.map[offset:offset+size]
+        else:
+            self.fp.seek(offset)
+            data = self.fp.read(size)
+            if self.stats is not None:
+                self.stats.count("seeks")
+
+        if self.stats is not None:
+            self.stats.count("reads")
+            self.stats.count("bytes_read", len(data))
+
+        return data
     def _write_to_file(self, offset, data):
         '''
         Write data to the ELF file.
@@ -735,6 +1124,33 @@ class ELF(object):
 
         Returns None.
         '''
+        if self.stats is not None:
+            self.stats.count("writes")
+            self.stats.count("bytes_written", len(data))
+            if self.buffer is None and (self.map is None or (offset + len(data)) > len(self.map)):
+                self.stats.count("seeks")
+
+        if self.buffer is not None:
+            # Writing past the end grows the file, with any gap filled with zeros
+            if offset > len(self.buffer):
+                self.buffer.extend("\x00" * (offset - len(self.buffer)))
+            self.buffer[offset:offset+len(data)] = data
+            return None
+
+        if self.map is not None:
+            if (offset + len(data)) <= len(self.map):
+                self.map[offset:offset+len(data)] = str(data)
+                return None
+
+            # Writing past the end of the mapping grows the file;
+            # write through the file object and map it again.
+            self._unmap_file()
+            self.fp.seek(offset)
+            self.fp.write(data)
+            self.fp.flush()
+            self._map_file()
+            return None
+
         self.fp.seek(offset)
         self.fp.write(data)
         # Shouldn't need the flush since the file is opened
@@ -751,66 +1167,275 @@ class ELF(object):
         '''
         # TODO: Should raise an exception if self.read_only is True?
         if self.read_only == False:
-            self.fp.close()
-            fp = open(self.elfile, "wb")
-            fp.write(data)
-            fp.close()
-            self._load_elf_file()
+            if self.stats is not None:
+                self.stats.count("writes")
+                self.stats.count("bytes_written", len(data))
+
+            if self.buffer is not None:
+                self.buffer = bytearray(data)
+            else:
+                self._close_file()
+                fp = open(self.elfile, "wb")
+                fp.write(data)
+                fp.close()
+                self._open_file()
+            # In-memory header tables describe the intended state of the
+            # file, so they must survive the overwrite until commit().
+            if self.cache_headers == False:
+                self._load_headers()
+    def _truncate_file(self, size):
+        '''
+        Truncates or extends the ELF file on disk.
+
+        @size - The new size of the file, in bytes.
+
+        Returns None.
+        '''
+        mapped = (self.map is not None)
+
+        if self.stats is not None:
+            self.stats.count("truncates")
+
+        if self.buffer is not None:
+            if size < len(self.buffer):
+                del self.buffer[size:]
+            else:
+                self.buffer.extend("\x00" * (size - len(self.buffer)))
+            return None
+
+        self._unmap_file()
+        self.fp.truncate(size)
+        if mapped == True:
+            self._map_file()
+    def _insert_range(self, offset, size):
+        '''
+        Inserts size bytes of unspecified data at the given offset without
+        moving the rest of the file's contents through user space, using
+        fallocate(FALLOC_FL_INSERT_RANGE). This requires size to be a multiple
+        of the file system block size; offset need not be aligned.
+
+        @offset - File offset to insert at.
+        @size   - Number of bytes to insert.
+
+        Returns True on success.
+        Returns False if the file system can't do this, in which case the file is unmodified.
+        '''
+        # In memory, inserting the data is a single memmove
+        if self.buffer is not None:
+            if size == 0 or offset > len(self.buffer):
+                return False
+            self.buffer[offset:offset] = "\x00" * size
+            return True
+
+        block = self._block_size()
+        if size == 0 or (size % block) != 0:
+            return False
+
+        # The inserted range must start on a block boundary, so insert at the
+        # start of offset's block. The bytes between there and offset are then
+        # shifted up along with the rest of the file and must be moved back.
+        start = offset - (offset % block)
+        if start >= self.size:
+            return False
+        head = self.read(start, offset - start)
+
+        mapped = (self.map is not None)
+
+        if self.stats is not None:
+            self.stats.count("fallocates")
+
+        import fsutil
+        self._unmap_file()
+        inserted = fsutil.fallocate(self.fp.fileno(), fsutil.FALLOC_FL_INSERT_RANGE, start, size)
+        if mapped == True:
+            self._map_file()
+
+        if inserted == True:
+            self.write(start, head)
+
+        return inserted
+    def _punch_hole(self, offset, size):
+        '''
+        Deallocates a range of the file, which then reads back as zeros, using
+        fallocate(FALLOC_FL_PUNCH_HOLE). The file size is not changed.
+
+        @offset - File offset of the range.
+        @size   - Number of bytes in the range.
+
+        Returns True on success.
+        Returns False if the file system can't do this, in which case the file is unmodified.
+        '''
+        if self.buffer is not None:
+            return False
+
+        mapped = (self.map is not None)
+
+        if self.stats is not None:
+            self.stats.count("fallocates")
+
+        import fsutil
+        self._unmap_file()
+        punched = fsutil.fallocate(self.fp.fileno(), fsutil.FALLOC_FL_PUNCH_HOLE | fsutil.FALLOC_FL_KEEP_SIZE, offset, size)
+        if mapped == True:
+            self._map_file()
+
+        return punched
+    def _block_size(self):
+        '''
+        Returns the file system block size for the ELF file.
+        '''
+        if self.buffer is not None:
+            return 1
+        import fsutil
+        return fsutil.block_size(self.fp.fileno())
     @property
     def size(self):
+        if self.buffer is not None:
+            return len(self.buffer)
+        if self.map is not None:
+            return len(self.map)
+
+        if self.stats is not None:
+            self.stats.count("seeks")
+
         self.fp.seek(0, 2)
         return self.fp.tell()
     @size.setter
     def size(self):
         return None
-    # End of methods that should be directly accessing self.fp!
+    # End of methods that should be directly accessing self.fp, self.map and self.buffer!
 
     # These two methods are the only ones that should be accessing
     # the internal _read_from_file and _write_to_file methods!
     def read(self, offset, size):
         return self._read_from_file(offset, size)
     def write(self, offset, data):
+        if self._string_tables:
+            self._invalidate_string_tables(offset, len(data))
         return self._write_to_file(offset, data)
 
-    # These three methods are the only ones that should be accessing
-    # the internal _file_overwrite method!
+    # The below methods shift the file contents in place, holding at most
+    # self.buffer_size bytes of the file in memory at any one time.
     def insert(self, offset, data):
         '''
         Insert data into the ELF file.
 
         @offset - Seek to this file offset before writing.
         @data   - Insert this data to file.
+                  If in read-only mode, nothing will happen.
+
+        Returns None.
+        '''
+        if self.read_only == True:
+            return None
+
+        self._invalidate_string_tables()
+
+        size = self.size
+        length = len(data)
+
+        # If the file system supports it, have it shift the end of the file
+        # for us; otherwise, grow the file and move everything after offset
+        # up by the length of the inserted data. Work backwards from the end
+        # of the file so that no chunk is overwritten before it has been moved.
+        if self._insert_range(offset, length) == False:
+            self._truncate_file(size + length)
+
+            end = size
+            while end > offset:
+                start = max(offset, end - self.buffer_size)
+                self._write_sparse(start + length, self.read(start, end - start))
+                end = start
+
+        # The payload's padding is left as a hole where possible
+        self._write_sparse(offset, data)
+    def _write_sparse(self, offset, data):
+        '''
+        Writes data, turning any leading and trailing runs of zeros into
+        holes where possible (see self.zero()), so that sparse files stay sparse.
+
+        @offset - Seek to this file offset before writing.
+        @data   - Write this data to file.
+
+        Returns None.
+        '''
+        body = data.lstrip("\x00")
+        head = len(data) - len(body)
+        body = body.rstrip("\x00")
+        tail = head + len(body)
+
+        self.zero(offset, head)
+        if body:
+            self.write(offset + head, body)
+        self.zero(offset + tail, len(data) - tail)
+    def zero(self, offset, size):
+        '''
+        Zero out a range of the ELF file. Whole file system blocks in the range
+        are turned into holes if the file system supports it.
+
+        @offset - Seek to this file offset before zeroing.
+        @size   - Zero this many bytes.
+                  If in read-only mode, nothing will happen.
 
         Returns None.
         '''
-        elf_file_contents = self.read(0, offset)
-        elf_file_contents += data
-        elf_file_contents += self.read(offset, (self.size-offset))
-        self._file_overwrite(elf_file_contents)
+        if self.read_only == True or size <= 0:
+            return None
+
+        block = self._block_size()
+        end = offset + size
+        hole_start = offset + (-offset % block)
+        hole_end = end - (end % block)
+
+        if hole_start < hole_end and self._punch_hole(hole_start, hole_end - hole_start) == True:
+            ranges = [(offset, hole_start), (hole_end, end)]
+        else:
+            ranges = [(offset, end)]
+
+        for (start, stop) in ranges:
+            while start < stop:
+                length = min(self.buffer_size, stop - start)
+                self.write(start, "\x00" * length)
+                start += length
     def append(self, data):
         '''
         Append data to the end of the ELF file.
 
         @data - Data to append.
+                If in read-only mode, nothing will happen.
 
         Returns None.
         '''
-        elf_file_contents = self.read(0, self.size)
-        elf_file_contents += data
-        self.write(0, elf_file_contents)
-        self._file_overwrite(elf_file_contents)
+        if self.read_only == True:
+            return None
+
+        self.write(self.size, data)
     def delete(self, offset, size):
         '''
         Remove data from the ELF file.
 
         @offset - Seek to this file offset before deleting.
         @size   - Delete this many bytes from the file.
+                  If in read-only mode, nothing will happen.
 
         Returns None.
         '''
-        elf_file_contents = self.read(0, offset)
-        elf_file_contents += self.read((offset+size), (self.size - (offset+size)))
-        self._file_overwrite(elf_file_contents)
+        if self.read_only == True:
+            return None
+
+        self._invalidate_string_tables()
+
+        file_size = self.size
+
+        # Move everything after the deleted range down, working forwards
+        # from the start of the range, then chop off the end of the file.
+        start = offset + size
+        while start < file_size:
+            chunk = self.read(start, min(self.buffer_size, file_size - start))
+            self.write(start - size, chunk)
+            start += len(chunk)
+
+        self._truncate_file(max(offset, file_size - size))
 
     def write_string(self, offset, data):
         '''
@@ -833,34 +1458,160 @@ class ELF(object):
 
         Returns the data read from the file.
         '''
-        # Read in blocks of 1024. Better for disk I/O than doing one byte at a time.
-        block_size = 1024
-        i = 0
-        data = ""
-
-        if size is None:
-            while True:
-                chunk = self.read(offset+i, block_size)
-                if "\x00" in chunk:
-                    data += chunk.split("\x00")[0]
-                    break
-                elif not chunk:
-                    break
-                else:
-                    data += chunk
-                    i += block_size
+        if size is not None:
+            return self.read(offset, size)
+
+        # Read in blocks, doubling the block size each time, rather than
+        # one byte at a time.
+        block_size = 256
+        chunks = []
+
+        while True:
+            chunk = self.read(offset, block_size)
+            end = chunk.find("\x00")
+            if end != -1:
+                chunks.append(chunk[:end])
+                break
+            elif not chunk:
+                break
+            else:
+                chunks.append(chunk)
+                offset += len(chunk)
+                block_size = min(block_size * 2, self.buffer_size)
+
+        return "".join(chunks)
+
+    def string_table(self, index):
+        '''
+        Returns the string table stored in a section. The table is read from
+        the file on first use and kept in memory until the file is modified.
+
+        @index - The index of the string table's section header.
+
+        Returns an instance of Elf_Strtab.
+        '''
+        try:
+            return self._string_tables[index]
+        except KeyError:
+            if index == self.shstrndx:
+                shdr = self.shstrtab
+            else:
+                shdr = self.section_headers[index]
+
+            strtab = Elf_Strtab(self, shdr.sh_offset, shdr.sh_size)
+            self._string_tables[index] = strtab
+            return strtab
+
+    def _invalidate_string_tables(self, offset=None, size=None):
+        '''
+        Discards cached string tables.
+
+        @offset - If specified, only discard tables overlapping this file offset...
+        @size   - ...and this many bytes after it.
+
+        Returns None.
+        '''
+        if offset is None:
+            self._string_tables = {}
         else:
-            data = self.read(offset, size)
+            for (index, strtab) in self._string_tables.items():
+                if strtab.overlaps(offset, size):
+                    del self._string_tables[index]
+                    self._section_index = None
 
-        return data
+    def section_by_name(self, name):
+        '''
+        Looks up a section header by name. If several sections share a name,
+        the first one is returned.
+
+        @name - The section name (e.g., ".text").
+
+        Returns an instance of Elf_Shdr, or None if there is no such section.
+        '''
+        if self._section_index is None:
+            self._section_index = {}
+            for shdr in reversed(self.section_headers):
+                self._section_index[shdr.name] = shdr
+
+        return self._section_index.get(name)
+
+    @property
+    def symbols(self):
+        '''
+        The Elf_Symbols index of this file's .symtab and .dynsym sections, built on first use.
+        '''
+        if self._symbols is None:
+            self._symbols = Elf_Symbols(self)
+        return self._symbols
+
+    def symbol_by_name(self, name):
+        '''
+        Looks up a symbol by name.
+
+        @name - The symbol name (e.g., "main").
+
+        Returns an Elf_Symbol, or None if there is no such symbol.
+        '''
+        return self.symbols.get(name)
+
+    def symbol_at(self, address):
+        '''
+        Looks up the symbol containing a virtual address.
+
+        @address - The virtual address.
+
+        Returns an Elf_Symbol, or None if no symbol contains the address.
+        '''
+        return self.symbols.at(address)
+
+    def address_offset(self, address):
+        '''
+        Translates a virtual address to a file offset, using the load segments.
+
+        @address - The virtual address.
+
+        Returns the file offset, or None if the address isn't mapped from the file.
+        '''
+        for phdr in self.program_headers:
+            if self.PT_LOAD == phdr.p_type and phdr.p_vaddr <= address < (phdr.p_vaddr + phdr.p_filesz):
+                return phdr.p_offset + (address - phdr.p_vaddr)
+        return None
+
+    def layout(self, record):
+        '''
+        Returns the Elf_Layout for a record type, compiled for this file's class and endianess.
+
+        @record - The record type, one of the keys of LAYOUTS.
+
+        Returns an instance of Elf_Layout.
+        '''
+        try:
+            return self._layouts[record]
+        except KeyError:
+            ident = self.header.e_ident
+            elf64 = (self.ELFCLASS64 == ident.ei_class)
+            if self.ELFDATA2MSB == ident.ei_encoding:
+                endianess = ">"
+            else:
+                endianess = "<"
+
+            layout = Elf_Layout.get(record, elf64, endianess)
+            self._layouts[record] = layout
+            return layout
+
+    def reset_layouts(self):
+        '''
+        Discards the record layouts resolved for this file, forcing the
+        ELF class and endianess to be re-read on next access.
+
+        Returns None.
+        '''
+        self._layouts = {}
 
     @property
     def endianess(self):
         # Before doing anything else, we need to know what endianess the target is
-        if self.ELFDATA2MSB == self.header.e_ident.ei_encoding:
-            return ">"
-        else:
-            return "<"
+        return self.layout("ehdr").endianess
     @endianess.setter
     def endianess(self, value):
         # This really is for internal use to interface with the struct module.
@@ -868,26 +1619,6 @@ class ELF(object):
         # endianess flag, access it via self.header.e_ident.ei_encoding.
         pass
 
-    def read_byte(self, offset):
-        return ord(self.read(offset, 1))
-    def write_byte(self, offset, value):
-        self.write(offset, chr(value))
-
-    def read_half(self, offset):
-        return struct.unpack("%sH" % self.endianess, self.read(offset, 2))[0]
-    def write_half(self, offset, value):
-        self.write(offset, struct.pack("%sH" % self.endianess, value))
-
-    def read_word(self, offset):
-        return struct.unpack("%sL" % self.endianess, self.read(offset, 4))[0]
-    def write_word(self, offset, value):
-        self.write(offset, struct.pack("%sL" % self.endianess, value))
-
-    def read_double(self, offset):
-        return struct.unpack("%sq" % self.endianess, self.read(offset, 8))[0]
-    def write_double(self, offset, value):
-        self.write(offset, struct.pack("%sq" % self.endianess, value))
-
     def read_address(self, offset):
         if self.ELFCLASS64 == self.header.e_ident.ei_class:
             return self.read_double(offset)
@@ -0,0 +1,322 @@
+import os
+import fcntl
+import errno
+import ctypes
+import shutil
+import tempfile
+
+# Mode flags for fallocate(2), from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_INSERT_RANGE = 0x20
+
+# lseek(2) whence values to find data and holes in sparse files, from linux/fs.h
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# ioctl to reflink one file into another, from linux/fs.h
+FICLONE = 0x40049409
+
+# Maximum number of bytes to request per copy_file_range/sendfile call
+COPY_CHUNK_SIZE = 1024 * 1024 * 1024
+
+# errno values indicating that the file system (or kernel, or platform) simply
+# doesn't support the requested operation, as opposed to a real I/O error.
+UNSUPPORTED_ERRNOS = [errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL, errno.EXDEV, errno.ENOTTY, errno.EBADF]
+
+_libc = None
+
+def _load_libc():
+    '''
+    Returns a ctypes handle to the C library, or None if it can't be loaded.
+    '''
+    global _libc
+
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        except KeyboardInterrupt as e:
+            raise e
+        except Exception:
+            _libc = False
+
+    if _libc == False:
+        return None
+    return _libc
+
+def _libc_function(names, restype, argtypes):
+    '''
+    Looks up a C library function.
+
+    @names    - List of symbol names to try, in order of preference.
+    @restype  - ctypes return type.
+    @argtypes - List of ctypes argument types.
+
+    Returns the ctypes function, or None if none of the symbols exist.
+    '''
+    libc = _load_libc()
+    if libc is None:
+        return None
+
+    for name in names:
+        try:
+            function = getattr(libc, name)
+        except AttributeError:
+            continue
+
+        function.restype = restype
+        function.argtypes = argtypes
+        return function
+
+    return None
+
+def block_size(fd):
+    '''
+    Returns the file system block size for an open file descriptor.
+    '''
+    return os.fstat(fd).st_blksize
+
+def fallocate(fd, mode, offset, length):
+    '''
+    Wrapper around fallocate(2).
+
+    @fd     - Open file descriptor.
+    @mode   - Bitwise OR of the FALLOC_FL_XXX flags.
+    @offset - File offset.
+    @length - Number of bytes.
+
+    Returns True on success.
+    Returns False if the operation is not supported for this file.
+    Raises OSError on any other failure.
+    '''
+    function = _libc_function(["fallocate64", "fallocate"], ctypes.c_int,
+                              [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong])
+    if function is None:
+        return False
+
+    if function(fd, mode, offset, length) != 0:
+        error = ctypes.get_errno()
+        if error in UNSUPPORTED_ERRNOS:
+            return False
+        raise OSError(error, os.strerror(error))
+
+    return True
+
+def fsync(path):
+    '''
+    Flushes a file (or directory) to disk.
+
+    @path - Path to the file or directory.
+
+    Returns None.
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _reflink(src_fd, dst_fd, size):
+    '''
+    Clones a file with the FICLONE ioctl (copy-on-write, no data is copied).
+
+    Returns True on success, False if not supported.
+    '''
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except (IOError, OSError) as e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            return False
+        raise e
+    return True
+
+def _copy_file_range(src_fd, dst_fd, size):
+    '''
+    Copies a file in the kernel with copy_file_range(2).
+
+    Returns True on success, False if not supported.
+    '''
+    function = _libc_function(["copy_file_range"], ctypes.c_ssize_t,
+                              [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+    return _kernel_copy(size, lambda count: function(src_fd, None, dst_fd, None, count, 0), function is not None)
+
+def _sendfile(src_fd, dst_fd, size):
+    '''
+    Copies a file in the kernel with sendfile(2).
+
+    Returns True on success, False if not supported.
+    '''
+    function = _libc_function(["sendfile64", "sendfile"], ctypes.c_ssize_t,
+                              [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+    return _kernel_copy(size, lambda count: function(dst_fd, src_fd, None, count), function is not None)
+
+def _kernel_copy(size, copy, available):
+    '''
+    Drives a copy_file_range/sendfile style copy loop, using (and advancing)
+    the current file offsets of both file descriptors.
+
+    @size      - Number of bytes to copy.
+    @copy      - Function which copies up to the given number of bytes and returns the number copied.
+    @available - False if the underlying C library function doesn't exist.
+
+    Returns True on success, False if not supported.
+    '''
+    if available == False:
+        return False
+
+    copied = 0
+    while copied < size:
+        count = copy(min(COPY_CHUNK_SIZE, size - copied))
+        if count < 0:
+            error = ctypes.get_errno()
+            # Nothing has been copied yet, so it's safe to try something else
+            if copied == 0 and error in UNSUPPORTED_ERRNOS:
+                return False
+            raise OSError(error, os.strerror(error))
+        elif count == 0:
+            break
+        copied += count
+
+    return True
+
+def data_extents(fd, size):
+    '''
+    Finds the ranges of a (possibly sparse) file which hold data, using
+    lseek(SEEK_DATA/SEEK_HOLE). If the file system can't report holes,
+    the whole file is one range.
+
+    @fd   - Open file descriptor.
+    @size - Size of the file.
+
+    Returns a list of (start, end) tuples.
+    '''
+    extents = []
+    offset = 0
+
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                # No data past offset
+                if e.errno == errno.ENXIO:
+                    break
+                raise e
+            end = min(size, os.lseek(fd, start, SEEK_HOLE))
+            extents.append((start, end))
+            offset = end
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise e
+        extents = [(0, size)]
+
+    os.lseek(fd, 0, os.SEEK_SET)
+    return extents
+
+def _sparse_copy(function, src_fd, dst_fd, size):
+    '''
+    Copies only the data extents of a file with an in-kernel copy function,
+    so that holes in the source file stay holes in the destination file.
+
+    Returns True on success, False if not supported.
+    '''
+    for (start, end) in data_extents(src_fd, size):
+        os.lseek(src_fd, start, os.SEEK_SET)
+        os.lseek(dst_fd, start, os.SEEK_SET)
+        if function(src_fd, dst_fd, end - start) == False:
+            return False
+
+    os.ftruncate(dst_fd, size)
+    return True
+
+def clone_file(src, dst):
+    '''
+    Copies src to dst as cheaply as the file system allows: a reflink clone
+    if supported, otherwise an in-kernel copy with copy_file_range or sendfile,
+    otherwise a plain user space copy. The file mode of src is copied to dst.
+    In-kernel copies skip holes, so sparse files stay sparse.
+
+    @src - Path to the source file.
+    @dst - Path to the destination file; it will be created or truncated.
+
+    Returns the name of the method used ("reflink", "copy_file_range", "sendfile" or "copy").
+    '''
+    with open(src, "rb") as src_fp:
+        with open(dst, "wb") as dst_fp:
+            size = os.fstat(src_fp.fileno()).st_size
+
+            if _reflink(src_fp.fileno(), dst_fp.fileno(), size) == True:
+                method = "reflink"
+            else:
+                for (method, function) in [("copy_file_range", _copy_file_range),
+                                           ("sendfile", _sendfile)]:
+                    if _sparse_copy(function, src_fp.fileno(), dst_fp.fileno(), size) == True:
+                        break
+                else:
+                    method = "copy"
+                    os.lseek(src_fp.fileno(), 0, os.SEEK_SET)
+                    os.ftruncate(dst_fp.fileno(), 0)
+                    os.lseek(dst_fp.fileno(), 0, os.SEEK_SET)
+                    shutil.copyfileobj(src_fp, dst_fp)
+
+    shutil.copymode(src, dst)
+    return method
+
+def link_file(src, dst, hardlink=True, mode=None):
+    '''
+    Gives dst the same contents as src as cheaply as the file system allows: a
+    reflink clone if supported, otherwise a hard link (if allowed), otherwise a
+    copy (see clone_file()). dst is replaced atomically.
+
+    Note that if dst ends up hard linked to src, modifying either modifies both.
+
+    @src      - Path to the source file.
+    @dst      - Path to the destination file.
+    @hardlink - Set to False to never hard link dst to src.
+    @mode     - Permission bits to give dst, or None to keep src's. dst is only
+                hard linked to src if src already has these permissions.
+
+    Returns the name of the method used ("reflink", "hardlink", or a clone_file() method).
+    '''
+    (fd, temp_file) = tempfile.mkstemp(prefix=".botox-", dir=os.path.dirname(os.path.abspath(dst)))
+    os.close(fd)
+
+    try:
+        method = None
+
+        with open(src, "rb") as src_fp:
+            with open(temp_file, "wb") as dst_fp:
+                if _reflink(src_fp.fileno(), dst_fp.fileno(), os.fstat(src_fp.fileno()).st_size) == True:
+                    method = "reflink"
+        if method is not None:
+            shutil.copymode(src, temp_file)
+
+        if mode is not None and (os.stat(src).st_mode & 07777) != mode:
+            hardlink = False
+
+        if method is None and hardlink == True:
+            os.unlink(temp_file)
+            try:
+                os.link(src, temp_file)
+                method = "hardlink"
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS + [errno.EPERM, errno.EMLINK]:
+                    raise e
+
+        if method is None:
+            method = clone_file(src, temp_file)
+
+        if mode is not None and method != "hardlink":
+            os.chmod(temp_file, mode)
+
+        os.rename(temp_file, dst)
+    except:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        raise
+
+    # rename() does nothing if dst was already a hard link to src
+    if os.path.exists(temp_file):
+        os.unlink(temp_file)
+
+    return method
@@ -0,0 +1,227 @@
+from elf import ELF
+
+# Page size used when the target architecture's isn't known; see Architecture.PAGE_SIZE
+PAGE_SIZE = 0x1000
+
+# Payloads placed in code caves start on this boundary, which satisfies the
+# instruction alignment requirements of all supported architectures
+CAVE_ALIGNMENT = 16
+
+# Upper bound on the size of a symbol hook's trampoline; see find_payload()
+TRAMPOLINE_SIZE = 256
+
+class Cave(object):
+    '''
+    A run of unused, zero filled bytes in (or just past the end of) an executable segment.
+    '''
+
+    def __init__(self, offset, size, filesz=None):
+        '''
+        Class constructor.
+
+        @offset - File offset of the cave.
+        @size   - Size of the cave, in bytes.
+        @filesz - The segment's new p_filesz/p_memsz, if it must be extended to cover the cave.
+
+        Returns None.
+        '''
+        self.offset = offset
+        self.size = size
+        self.filesz = filesz
+
+def _used_ranges(elf, segment):
+    '''
+    Returns a list of (start, end) file ranges that hold data described by
+    the ELF file's headers, ignoring the given segment itself.
+    '''
+    header = elf.header
+
+    ranges = [(0, header.e_ehsize),
+              (header.e_phoff, header.e_phoff + (header.e_phentsize * header.e_phnum)),
+              (header.e_shoff, header.e_shoff + (header.e_shentsize * elf.shnum))]
+
+    for shdr in elf.section_headers:
+        if shdr.sh_type not in [ELF.SHT_NULL, ELF.SHT_NOBITS] and shdr.sh_size > 0:
+            ranges.append((shdr.sh_offset, shdr.sh_offset + shdr.sh_size))
+
+    for phdr in elf.program_headers:
+        if phdr.index != segment.index and phdr.p_filesz > 0:
+            ranges.append((phdr.p_offset, phdr.p_offset + phdr.p_filesz))
+
+    return sorted(ranges)
+
+def address_limit(elf, segment, page_size=PAGE_SIZE):
+    '''
+    Returns the virtual address up to which a load segment can grow in memory
+    without its last page being mapped over by the next load segment, or None
+    if there is no load segment above it.
+    '''
+    limit = None
+    for phdr in elf.program_headers:
+        if phdr.p_type == ELF.PT_LOAD and phdr.index != segment.index and phdr.p_vaddr > segment.p_vaddr:
+            next_page = phdr.p_vaddr & ~(page_size - 1)
+            if limit is None or next_page < limit:
+                limit = next_page
+    return limit
+
+def _tail_limit(elf, segment, used, page_size=PAGE_SIZE):
+    '''
+    Returns the file offset up to which the segment can be extended without
+    overlapping other data in the file or other segments in memory.
+    '''
+    end = segment.p_offset + segment.p_filesz
+
+    # Segments with a .bss style tail can't be extended in the file
+    if segment.p_memsz != segment.p_filesz:
+        return end
+
+    limit = elf.size
+    for (start, stop) in used:
+        if start >= end:
+            limit = min(limit, start)
+
+    # The extended segment's last page must not be mapped by another segment
+    address = address_limit(elf, segment, page_size)
+    if address is not None:
+        limit = min(limit, address - (segment.p_vaddr - segment.p_offset))
+
+    return max(end, limit)
+
+def _free_ranges(start, end, used):
+    '''
+    Yields the (start, end) ranges between start and end not covered by any used range.
+    '''
+    for (used_start, used_end) in used:
+        if used_end <= start:
+            continue
+        if used_start >= end:
+            break
+        if used_start > start:
+            yield (start, used_start)
+        start = max(start, used_end)
+
+    if start < end:
+        yield (start, end)
+
+def _zero_run(data, size, base, alignment):
+    '''
+    Finds the first aligned run of at least size zero bytes in data.
+
+    @data      - The data to search.
+    @size      - The run length needed.
+    @base      - The file offset of data.
+    @alignment - The required alignment of the run's file offset.
+
+    Returns the file offset of the run, or None.
+    '''
+    offset = 0
+    while offset <= (len(data) - size):
+        aligned = offset + ((alignment - ((base + offset) % alignment)) % alignment)
+        if aligned > (len(data) - size):
+            break
+
+        # Skip past the last non-zero byte in the candidate range, if any
+        nonzero = data[aligned:aligned+size].rstrip("\x00")
+        if not nonzero:
+            return base + aligned
+        offset = aligned + len(nonzero)
+
+    return None
+
+def find_cave(elf, segment, size, alignment=CAVE_ALIGNMENT, page_size=PAGE_SIZE):
+    '''
+    Finds a code cave in an executable load segment: an aligned run of zero
+    bytes which isn't part of any section, segment or header table. Gaps left
+    between sections for alignment are preferred, since using them needs no
+    header changes; otherwise the padding after the end of the segment is used,
+    and the segment is extended just far enough to cover the payload.
+
+    Without section headers, only the padding after the segment is considered.
+
+    @elf       - An instance of elf.ELF.
+    @segment   - The Elf_Phdr of the executable load segment.
+    @size      - The number of bytes needed.
+    @alignment - The required alignment of the cave's file offset.
+    @page_size - The target's page size.
+
+    Returns a Cave, or None if there isn't a big enough cave.
+    '''
+    used = _used_ranges(elf, segment)
+    start = segment.p_offset
+    end = segment.p_offset + segment.p_filesz
+    tail = _tail_limit(elf, segment, used, page_size)
+
+    if elf.shnum > 0:
+        for (gap_start, gap_end) in _free_ranges(start, end, used):
+            if (gap_end - gap_start) >= size:
+                offset = _zero_run(elf.read(gap_start, gap_end - gap_start), size, gap_start, alignment)
+                if offset is not None:
+                    return Cave(offset, size)
+
+    # Gaps that run past the end of the segment are searched from the end of the
+    # segment's last used byte, so that it is extended as little as possible.
+    for (gap_start, gap_end) in _free_ranges(start, tail, used):
+        if elf.shnum == 0:
+            gap_start = max(gap_start, end)
+        if gap_end > end and (gap_end - gap_start) >= size:
+            offset = _zero_run(elf.read(gap_start, gap_end - gap_start), size, gap_start, alignment)
+            if offset is not None:
+                return Cave(offset, size, max(segment.p_filesz, offset + size - segment.p_offset))
+
+    return None
+
+def _last_nonzero(elf, start, end):
+    '''
+    Returns the file offset of the last non-zero byte between start and end, or None.
+    Reads backwards from end in growing chunks, so that only the zeros padding the
+    end of the range are read, along with a little of the data before them.
+    '''
+    size = PAGE_SIZE
+    while end > start:
+        chunk_start = max(start, end - size)
+        data = elf.read(chunk_start, end - chunk_start).rstrip("\x00")
+        if data:
+            return chunk_start + len(data) - 1
+        end = chunk_start
+        size = min(size * 2, ELF.DEFAULT_BUFFER_SIZE)
+    return None
+
+def find_payload(elf, signature):
+    '''
+    Looks for a payload that starts with signature (e.g., a symbol hook's trampoline)
+    everywhere Botox.plan() could have put one, without reading whole segments:
+
+        o At the start of an executable load segment (APPEND).
+        o In the gaps between the sections of an executable load segment (CAVE).
+        o Just before the zeros at the end of an executable load segment (INSERT,
+          or a CAVE past the end of the segment's original contents).
+
+    @elf       - An instance of elf.ELF.
+    @signature - The bytes the payload starts with.
+
+    Returns the file offset of the payload, or None if there isn't one.
+    '''
+    for segment in elf.program_headers:
+        if ELF.PT_LOAD != segment.p_type or segment.flags.execute != True or segment.p_filesz == 0:
+            continue
+
+        start = segment.p_offset
+        end = min(segment.p_offset + segment.p_filesz, elf.size)
+
+        if elf.read(start, len(signature)) == signature:
+            return start
+
+        if elf.shnum > 0:
+            for (gap_start, gap_end) in _free_ranges(start, end, _used_ranges(elf, segment)):
+                index = elf.read(gap_start, gap_end - gap_start).find(signature)
+                if index != -1:
+                    return gap_start + index
+
+        last = _last_nonzero(elf, start, end)
+        if last is not None:
+            window_start = max(start, last + 1 - TRAMPOLINE_SIZE)
+            index = elf.read(window_start, last + 1 - window_start).find(signature)
+            if index != -1:
+                return window_start + index
+
+    return None
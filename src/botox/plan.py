@@ -0,0 +1,182 @@
+import json
+import stats
+from exceptions import BotoxException
+
+class PatchPlan(object):
+    '''
+    Describes every change needed to patch an ELF file, without making any of them:
+    the header field edits, any code patched in place, the payload and where to insert
+    it, and the new entry point.
+
+    Plans are produced by Botox.plan() and carried out by Botox.apply().
+    '''
+
+    def __init__(self, elfile, file_size):
+        '''
+        Class constructor.
+
+        @elfile    - Path to the ELF file the plan was made for.
+        @file_size - Size of the ELF file when the plan was made.
+
+        Returns None.
+        '''
+        self.elfile = elfile
+        self.file_size = file_size
+
+        # List of (record, index, field, old value, new value) tuples, where
+        # record is one of "ehdr", "phdr" or "shdr" and index is the program
+        # or section header index (None for the ELF header).
+        self.edits = []
+
+        # List of (file offset, old data, new data) tuples; code patched in
+        # place, at offsets that aren't moved by the payload insertion.
+        self.writes = []
+
+        # Where to insert the payload; None if the payload is written in place
+        # (e.g., into a code cave), in which case it is also in self.writes.
+        self.insert_offset = None
+        # True if the payload is instead appended to the end of the file
+        self.append = False
+        self.payload = None
+        self.entry_point = None
+
+        # The hooked symbol and address, if the payload is not run from the entry point
+        self.target = None
+        self.hook_address = None
+
+    def edit(self, record, index, field, old, new):
+        '''
+        Adds a header field edit to the plan.
+
+        @record - The record type; "ehdr", "phdr" or "shdr".
+        @index  - The program/section header index, or None for the ELF header.
+        @field  - The field name.
+        @old    - The current value of the field.
+        @new    - The new value of the field.
+
+        Returns None.
+        '''
+        self.edits.append((record, index, field, old, new))
+
+    def write(self, offset, old, new):
+        '''
+        Adds an in-place write of file data to the plan.
+
+        @offset - The file offset of the data.
+        @old    - The current data.
+        @new    - The new data, which must be the same length as old.
+
+        Returns None.
+        '''
+        self.writes.append((offset, old, new))
+
+    def _record(self, elf, record, index):
+        '''
+        Returns the Elf_Header/Elf_Phdr/Elf_Shdr instance an edit refers to.
+        '''
+        if record == "ehdr":
+            return elf.header
+        elif record == "phdr":
+            return elf.program_headers[index]
+        elif record == "shdr":
+            return elf.section_headers[index]
+        raise BotoxException("Unknown record type '%s' in patch plan!" % record)
+
+    def apply_edits(self, elf):
+        '''
+        Applies just the plan's header field edits to an ELF file.
+
+        @elf - An instance of elf.ELF. If it was opened with cache_headers=True,
+               the edits are only made to its in-memory header tables.
+
+        Returns None.
+        '''
+        for (record, index, field, old, new) in self.edits:
+            setattr(self._record(elf, record, index), field, new)
+
+    def verify(self, elf):
+        '''
+        Checks that an ELF file still matches the plan: that it is the same size, and
+        that every header field and every byte of data the plan changes still holds
+        the value recorded when the plan was made.
+
+        @elf - An instance of elf.ELF.
+
+        Returns None.
+        Raises a BotoxException if the plan doesn't match the file.
+        '''
+        if elf.size != self.file_size:
+            raise BotoxException("This patch plan was made for a %d byte file, not a %d byte file!" % (self.file_size, elf.size))
+
+        # A field edited more than once must hold the previous edit's new value
+        expected = {}
+        for (record, index, field, old, new) in self.edits:
+            key = (record, index, field)
+            if key in expected:
+                current = expected[key]
+            else:
+                current = getattr(self._record(elf, record, index), field)
+            if current != old:
+                if index is None:
+                    name = "%s.%s" % (record, field)
+                else:
+                    name = "%s[%d].%s" % (record, index, field)
+                raise BotoxException("This patch plan doesn't match the file: %s is 0x%X, not 0x%X!" % (name, current, old))
+            expected[key] = new
+
+        for (offset, old, new) in self.writes:
+            if elf.read(offset, len(old)) != old:
+                raise BotoxException("This patch plan doesn't match the file: the data at file offset 0x%X has changed!" % offset)
+
+    def apply(self, elf):
+        '''
+        Applies the plan to an ELF file.
+
+        @elf - An instance of elf.ELF, opened for writing. If it was opened with
+               cache_headers=True, the caller must commit() the header edits.
+               If it was opened with stats, the header rewrite, insert and append
+               phases are timed.
+
+        Returns None.
+        Raises a BotoxException, before anything is written, if the file doesn't
+        match the plan; see verify().
+        '''
+        self.verify(elf)
+
+        with stats.phase(elf.stats, "header rewrite"):
+            self.apply_edits(elf)
+
+            for (offset, old, new) in self.writes:
+                elf.write(offset, new)
+
+        if self.insert_offset is not None:
+            with stats.phase(elf.stats, "insert"):
+                elf.insert(self.insert_offset, self.payload)
+        elif self.append == True:
+            with stats.phase(elf.stats, "append"):
+                elf.append(self.payload)
+
+    def to_dict(self):
+        '''
+        Returns the plan as a dictionary of JSON-serializable values.
+        '''
+        return {
+                "elfile"        : self.elfile,
+                "file_size"     : self.file_size,
+                "insert_offset" : self.insert_offset,
+                "append"        : self.append,
+                "payload"       : self.payload.encode("hex"),
+                "entry_point"   : self.entry_point,
+                "target"        : self.target,
+                "hook_address"  : self.hook_address,
+                "edits"         : [{"record" : record, "index" : index, "field" : field, "old" : old, "new" : new}
+                                    for (record, index, field, old, new) in self.edits],
+                "writes"        : [{"offset" : offset, "old" : old.encode("hex"), "new" : new.encode("hex")}
+                                    for (offset, old, new) in self.writes],
+               }
+
+    def to_json(self):
+        '''
+        Returns the plan as a JSON string.
+        '''
+        return json.dumps(self.to_dict(), indent=4, sort_keys=True)
@@ -0,0 +1,223 @@
+import json
+import threading
+import multiprocessing.pool
+
+import cache
+import batch
+import placement
+import architecture
+from elf import ELF, Elf_Layout
+
+# Size of the largest (ELF64) ELF header
+EHDR_SIZE = 64
+
+# Number of bytes at the entry point compared against the payload; see Botox.plan()
+PATCHED_CHECK_SIZE = 16
+
+# Default number of scanner threads; scanning is I/O bound
+DEFAULT_JOBS = 16
+
+_architectures = {}
+_architectures_lock = threading.Lock()
+
+def _architecture(key):
+    '''
+    Returns a shared Architecture instance for (e_machine, ei_class, ei_encoding),
+    or None if the architecture isn't supported.
+    '''
+    with _architectures_lock:
+        if key not in _architectures:
+            arch = architecture.lookup(*key)
+            if arch is not None:
+                arch = arch(key[2])
+            _architectures[key] = arch
+        return _architectures[key]
+
+def _payload_prefix(arch, entry_point):
+    '''
+    Returns the bytes Botox would write at the start of the payload for this entry point.
+    '''
+    with _architectures_lock:
+        return arch.payload(entry_point)[0:PATCHED_CHECK_SIZE]
+
+def scan_file(path):
+    '''
+    Classifies a file without modifying it. Only the ELF header, the program
+    header table and the bytes at the entry point are read; files which aren't
+    patched at the entry point are then loaded with the ELF class, to look for a
+    hooked symbol in the few places its trampoline could be (see
+    placement.find_payload()).
+
+    @path - Path to the file.
+
+    Returns a dictionary with the following keys (all but path and elf are None
+    if the file isn't an ELF file):
+
+        o path         - The path to the file.
+        o elf          - True if the file is an ELF file.
+        o type         - The e_type value.
+        o machine      - The e_machine value.
+        o class        - The e_ident.ei_class value.
+        o endianess    - "little" or "big".
+        o architecture - The name of the matching Architecture subclass, or None.
+        o patched      - True if the entry point already holds the pause payload,
+                         or a symbol is hooked (None if this can't be determined).
+        o patchable    - True if Botox should be able to patch the file.
+        o reason       - Why the file isn't patchable, or None.
+    '''
+    result = {
+                "path"          : path,
+                "elf"           : False,
+                "type"          : None,
+                "machine"       : None,
+                "class"         : None,
+                "endianess"     : None,
+                "architecture"  : None,
+                "patched"       : None,
+                "patchable"     : False,
+                "reason"        : None,
+             }
+
+    try:
+        with open(path, "rb") as fp:
+            ehdr = fp.read(EHDR_SIZE)
+            if not ehdr.startswith(batch.ELF_MAGIC) or len(ehdr) < 16:
+                result["reason"] = "not an ELF file"
+                return result
+
+            elfclass = ord(ehdr[4])
+            encoding = ord(ehdr[5])
+            if encoding == ELF.ELFDATA2MSB:
+                endianess = ">"
+            else:
+                endianess = "<"
+
+            layout = Elf_Layout.get("ehdr", (elfclass == ELF.ELFCLASS64), endianess)
+            if len(ehdr) < layout.size:
+                result["reason"] = "truncated ELF header"
+                return result
+            header = dict(zip(layout.names, layout.struct.unpack(ehdr[0:layout.size])))
+
+            result["elf"] = True
+            result["type"] = header["e_type"]
+            result["machine"] = header["e_machine"]
+            result["class"] = elfclass
+            if encoding == ELF.ELFDATA2MSB:
+                result["endianess"] = "big"
+            else:
+                result["endianess"] = "little"
+
+            arch = _architecture((header["e_machine"], elfclass, encoding))
+            if arch is not None:
+                result["architecture"] = arch.__class__.__name__
+
+            # Find the file offset of the entry point, and an executable load segment
+            layout = Elf_Layout.get("phdr", (elfclass == ELF.ELFCLASS64), endianess)
+            fp.seek(header["e_phoff"])
+            table = fp.read(header["e_phentsize"] * header["e_phnum"])
+
+            entry_offset = None
+            executable = False
+            for n in range(0, header["e_phnum"]):
+                record = table[n*header["e_phentsize"]:(n*header["e_phentsize"])+layout.size]
+                if len(record) < layout.size:
+                    break
+                phdr = dict(zip(layout.names, layout.struct.unpack(record)))
+                if phdr["p_type"] != ELF.PT_LOAD:
+                    continue
+                if phdr["p_flags"] & ELF.PF_X:
+                    executable = True
+                if entry_offset is None and phdr["p_vaddr"] <= header["e_entry"] < (phdr["p_vaddr"] + phdr["p_filesz"]):
+                    entry_offset = phdr["p_offset"] + (header["e_entry"] - phdr["p_vaddr"])
+
+            if arch is not None and entry_offset is not None:
+                fp.seek(entry_offset)
+                result["patched"] = (fp.read(PATCHED_CHECK_SIZE) == _payload_prefix(arch, header["e_entry"]))
+
+            # Look for a symbol hook's trampoline too, in the few places it could be;
+            # this needs the section headers, so load the file properly
+            if result["patched"] == False and header["e_type"] == ELF.ET_EXEC and arch.hook_signature():
+                with ELF(path, read_only=True, cache_headers=True) as elf:
+                    result["patched"] = (placement.find_payload(elf, arch.hook_signature()) is not None)
+    except KeyboardInterrupt as e:
+        raise e
+    except Exception as e:
+        result["reason"] = "%s: %s" % (e.__class__.__name__, str(e))
+        return result
+
+    # Same checks, in the same order, as Botox.plan()
+    if ELF.ET_EXEC != result["type"]:
+        result["reason"] = "not an executable"
+    elif arch is None:
+        result["reason"] = "unsupported architecture"
+    elif executable == False:
+        result["reason"] = "no executable load segment"
+    elif result["patched"] == True:
+        result["reason"] = "already patched"
+    else:
+        result["patchable"] = True
+
+    return result
+
+def scan_cached(path, parse_cache):
+    '''
+    Same as scan_file(), but looks the file up in a parse cache first.
+
+    @path        - Path to the file.
+    @parse_cache - An instance of cache.ParseCache.
+
+    Returns a dictionary; see scan_file().
+    '''
+    key = cache.file_key(path)
+
+    result = parse_cache.get(key)
+    if result is None:
+        result = scan_file(path)
+        parse_cache.put(key, result)
+    elif result.get("options") is not None:
+        # Batch mode found the file unpatchable with particular options (e.g., a
+        # missing target symbol); that says nothing about the entry point. Keep
+        # its summary for batch mode, and scan the file afresh.
+        result = scan_file(path)
+    else:
+        # The same file may have been cached under another (hard linked) path
+        result["path"] = path
+
+    return result
+
+def scan(paths, output, jobs=DEFAULT_JOBS, parse_cache=None):
+    '''
+    Scans files and directory trees with a pool of threads, writing one JSON
+    object per file (see scan_file()) to output as results come in.
+
+    @paths       - List of file and directory paths. Directories are scanned recursively.
+    @output      - File object to write the results to.
+    @jobs        - Number of threads.
+    @parse_cache - An instance of cache.ParseCache to skip unchanged files with, or None.
+
+    Returns a dictionary counting the ELF, patched and patchable files scanned.
+    '''
+    counts = {"files" : 0, "elf" : 0, "patched" : 0, "patchable" : 0}
+
+    files = (path for (path, reason) in batch.find_files(paths, recursive=True) if reason is None)
+
+    if parse_cache is None:
+        function = scan_file
+    else:
+        function = lambda path: scan_cached(path, parse_cache)
+
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        for result in pool.imap_unordered(function, files, batch.CHUNK_SIZE):
+            output.write(json.dumps(result, sort_keys=True) + "\n")
+            output.flush()
+
+            counts["files"] += 1
+            for key in ["elf", "patched", "patchable"]:
+                if result[key] == True:
+                    counts[key] += 1
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return counts
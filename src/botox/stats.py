@@ -0,0 +1,123 @@
+import time
+import json
+import logging
+import contextlib
+import collections
+
+logger = logging.getLogger("botox")
+
+class Stats(object):
+    '''
+    Collects wall clock time per phase of patching (load, arch resolve, assemble,
+    plan, header rewrite, insert, ...) and counters for the file I/O done by the
+    ELF class (reads, writes, seeks and bytes moved).
+
+    Callbacks registered with add_hook() are called as phases complete and as
+    counters change:
+
+        callback(stats, event, name, value)
+
+    where event is "phase" (value is the elapsed time in seconds) or "count"
+    (value is the amount the counter was incremented by).
+    '''
+
+    def __init__(self):
+        '''
+        Class constructor.
+
+        Returns None.
+        '''
+        self.phases = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.hooks = []
+
+    def add_hook(self, callback):
+        '''
+        Registers a callback; see the class documentation.
+
+        @callback - The function to call.
+
+        Returns None.
+        '''
+        self.hooks.append(callback)
+
+    def _notify(self, event, name, value):
+        for callback in self.hooks:
+            callback(self, event, name, value)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Context manager which times a phase. Time spent in the same phase more
+        than once is added up; phases may be nested.
+
+        @name - The phase name.
+        '''
+        start = time.time()
+        try:
+            yield self
+        finally:
+            elapsed = time.time() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            logger.debug("Phase %s took %.6f seconds", name, elapsed, extra={"phase" : name, "seconds" : elapsed})
+            if self.hooks:
+                self._notify("phase", name, elapsed)
+
+    def count(self, name, value=1):
+        '''
+        Increments a counter.
+
+        @name  - The counter name.
+        @value - The amount to increment it by.
+
+        Returns None.
+        '''
+        self.counters[name] = self.counters.get(name, 0) + value
+        if self.hooks:
+            self._notify("count", name, value)
+
+    def merge(self, other):
+        '''
+        Adds another set of statistics (e.g., collected in another process) to these.
+        Hooks are not called.
+
+        @other - The other statistics, as returned by to_dict().
+
+        Returns None.
+        '''
+        for (name, value) in other["phases"].iteritems():
+            self.phases[name] = self.phases.get(name, 0.0) + value
+        for (name, value) in other["counters"].iteritems():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        '''
+        Returns the collected statistics as a dictionary.
+        '''
+        return {
+                "phases"    : dict(self.phases),
+                "counters"  : dict(self.counters),
+               }
+
+    def to_json(self):
+        '''
+        Returns the collected statistics as a JSON string.
+        '''
+        return json.dumps(self.to_dict(), indent=4, sort_keys=True)
+
+@contextlib.contextmanager
+def _untimed():
+    yield None
+
+def phase(stats, name):
+    '''
+    Times a phase with an optional Stats instance.
+
+    @stats - An instance of Stats, or None.
+    @name  - The phase name.
+
+    Returns a context manager.
+    '''
+    if stats is None:
+        return _untimed()
+    return stats.phase(name)
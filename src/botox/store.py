@@ -0,0 +1,237 @@
+import os
+import json
+import errno
+import hashlib
+import tempfile
+
+import fsutil
+
+# Default maximum total size of the patched files kept in a store
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Permissions of patched files written to the store from memory; see PatchStore.emit()
+ENTRY_MODE = 0644
+
+# Number of bytes hashed at a time
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(path, prefix=""):
+    '''
+    Returns the SHA-256 hex digest of prefix followed by a file's contents.
+    '''
+    digest = hashlib.sha256(prefix)
+    with open(path, "rb") as fp:
+        while True:
+            chunk = fp.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_bytes(data, prefix=""):
+    '''
+    Returns the SHA-256 hex digest of prefix followed by data.
+    '''
+    digest = hashlib.sha256(prefix)
+    digest.update(data)
+    return digest.hexdigest()
+
+class PatchStore(object):
+    '''
+    Content-addressed store of patched ELF files. Each entry is a patched file,
+    named by a key that the caller derives from the original file's contents and
+    everything else that affects the patch (see Botox._store_prefix()), along
+    with a small JSON metadata file.
+
+    Entries are handed out as reflinks where the file system supports them, and
+    otherwise as copies, with the permissions the caller asks for. Hard links can
+    be enabled instead of copies; hard linked outputs share their contents with
+    the store, and must not be modified in place.
+
+    When the patched files take up more than max_size bytes, the least recently
+    used entries are evicted. Use is tracked by the metadata files' mtimes, since
+    touching a patched file would touch every hard link to it. The store's size
+    is only counted once per instance, then kept up to date as entries are added;
+    processes sharing a store don't see each other's additions until they next
+    evict, so it may briefly grow past max_size.
+    '''
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, hardlink=False):
+        '''
+        Class constructor.
+
+        @directory - The store directory; it is created if it doesn't exist.
+        @max_size  - The maximum total size of the stored files, in bytes.
+        @hardlink  - Set to True to hard link files that can't be reflinked, rather than copying them.
+
+        Returns None.
+        '''
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.hardlink = hardlink
+        # Total size of the stored files, counted on the first put(); see _grow()
+        self.size = None
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise e
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[0:2], key)
+
+    def _metadata_path(self, key):
+        return self._path(key) + ".json"
+
+    def get(self, key):
+        '''
+        Looks up an entry, marking it as recently used.
+
+        @key - The entry's key.
+
+        Returns the entry's metadata dictionary, or None if there is no such entry.
+        '''
+        try:
+            with open(self._metadata_path(key), "rb") as fp:
+                metadata = json.load(fp)
+            if not os.path.exists(self._path(key)):
+                return None
+            os.utime(self._metadata_path(key), None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return metadata
+
+    def emit(self, key, output, mode=None):
+        '''
+        Links or copies an entry's patched file to output, replacing it atomically.
+
+        @key    - The entry's key.
+        @output - The path to write to.
+        @mode   - Permission bits to give output (e.g., those of the original file),
+                  or None to keep the stored file's.
+
+        Returns the method used; see fsutil.link_file().
+        '''
+        return fsutil.link_file(self._path(key), output, hardlink=self.hardlink, mode=mode)
+
+    def read(self, key):
+        '''
+        Returns an entry's patched file contents.
+        '''
+        with open(self._path(key), "rb") as fp:
+            return fp.read()
+
+    def put(self, key, path, metadata):
+        '''
+        Adds a patched file to the store, then evicts old entries if the store is too big.
+        The file is reflinked or copied into the store, never hard linked, since the
+        caller still owns it and may modify it.
+
+        @key      - The entry's key.
+        @path     - The patched file.
+        @metadata - Dictionary of JSON-serializable values to store with it.
+
+        Returns None.
+        '''
+        self._prepare(key)
+        fsutil.link_file(path, self._path(key), hardlink=False)
+        self._put_metadata(key, metadata)
+        self._grow(os.stat(self._path(key)).st_size)
+
+    def put_bytes(self, key, data, metadata):
+        '''
+        Same as put(), but for patched file contents held in memory.
+        '''
+        self._prepare(key)
+        (fd, temp_file) = tempfile.mkstemp(prefix=".botox-", dir=os.path.dirname(self._path(key)))
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.chmod(temp_file, ENTRY_MODE)
+        os.rename(temp_file, self._path(key))
+        self._put_metadata(key, metadata)
+        self._grow(len(data))
+
+    def _grow(self, size):
+        '''
+        Accounts for a newly added entry of size bytes, evicting old entries if the
+        store is now too big. The store is only walked when the size isn't known yet
+        (the new entry is then counted by the walk) or when entries must be evicted.
+        '''
+        if self.size is None:
+            self.size = sum([entry_size for (used, entry_size, key) in self.entries()])
+        else:
+            self.size += size
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def _prepare(self, key):
+        directory = os.path.dirname(self._path(key))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise e
+
+    def _put_metadata(self, key, metadata):
+        # Written last, so that get() never finds metadata without a patched file
+        (fd, temp_file) = tempfile.mkstemp(prefix=".botox-", dir=os.path.dirname(self._path(key)))
+        with os.fdopen(fd, "wb") as fp:
+            json.dump(metadata, fp)
+        os.rename(temp_file, self._metadata_path(key))
+
+    def entries(self):
+        '''
+        Lists the store's entries.
+
+        Returns a list of (last used time, size, key) tuples, least recently used first.
+        '''
+        entries = []
+
+        for (root, dirs, files) in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json") or name.startswith("."):
+                    continue
+                key = name[:-len(".json")]
+                try:
+                    used = os.stat(os.path.join(root, name)).st_mtime
+                    size = os.stat(self._path(key)).st_size
+                except OSError:
+                    continue
+                entries.append((used, size, key))
+
+        entries.sort()
+        return entries
+
+    def evict(self):
+        '''
+        Removes least recently used entries until the store is no bigger than max_size,
+        and updates self.size.
+
+        Returns the number of entries removed.
+        '''
+        entries = self.entries()
+        total = sum([size for (used, size, key) in entries])
+        removed = 0
+
+        for (used, size, key) in entries:
+            if total <= self.max_size:
+                break
+
+            for path in [self._metadata_path(key), self._path(key)]:
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    # Another process may have evicted it first
+                    if e.errno != errno.ENOENT:
+                        raise e
+
+            total -= size
+            removed += 1
+
+        self.size = total
+        return removed
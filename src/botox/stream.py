@@ -0,0 +1,92 @@
+from elf import ELF
+
+# Number of bytes read from or written to a stream at a time
+CHUNK_SIZE = ELF.DEFAULT_BUFFER_SIZE
+
+def read_stream(source, chunk_size=CHUNK_SIZE, stats=None):
+    '''
+    Reads a stream (e.g., stdin) to the end, in chunks.
+
+    @source     - The file object to read from.
+    @chunk_size - Number of bytes to read at a time.
+    @stats      - An instance of stats.Stats to count I/O with, or None.
+
+    Returns the data read, as a str.
+    '''
+    chunks = []
+
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if stats is not None:
+            stats.count("reads")
+            stats.count("bytes_read", len(chunk))
+
+    return "".join(chunks)
+
+def _pieces(data, plan):
+    '''
+    Lays out the patched file without copying any of the original data.
+
+    @data - The original contents of the ELF file.
+    @plan - The PatchPlan for it.
+
+    Returns a list of (string, start, end) tuples; the patched file is the
+    concatenation of each string[start:end].
+    '''
+    if plan.insert_offset is not None:
+        return [(data, 0, plan.insert_offset),
+                (plan.payload, 0, len(plan.payload)),
+                (data, plan.insert_offset, len(data))]
+    elif plan.append == True:
+        return [(data, 0, len(data)),
+                (plan.payload, 0, len(plan.payload))]
+    else:
+        return [(data, 0, len(data))]
+
+def write_stream(destination, data, plan, chunk_size=CHUNK_SIZE, stats=None):
+    '''
+    Writes the patched ELF file to a stream (e.g., stdout), in chunks. The unchanged
+    parts of the file are written straight from the original data; only the chunks
+    which hold the modified header tables or patched code are copied and modified.
+
+    @destination - The file object to write to.
+    @data        - The original contents of the ELF file, as a str.
+    @plan        - The PatchPlan to apply.
+    @chunk_size  - Maximum number of bytes to write at a time.
+    @stats       - An instance of stats.Stats to count I/O with, or None.
+
+    Returns None.
+    '''
+    # Apply the header edits to in-memory copies of the header tables;
+    # they, and any code patched in place, are laid over the output.
+    with ELF(data, read_only=True, cache_headers=True) as elf:
+        plan.apply_edits(elf)
+        overlays = [(offset, new) for (offset, old, new) in plan.writes] + elf.dirty_tables()
+
+    offset = 0
+    for (string, start, end) in _pieces(data, plan):
+        while start < end:
+            chunk = string[start:min(end, start + chunk_size)]
+
+            patches = [(position, new) for (position, new) in overlays
+                       if position < (offset + len(chunk)) and (position + len(new)) > offset]
+            if patches:
+                chunk = bytearray(chunk)
+                for (position, new) in patches:
+                    lo = max(position, offset)
+                    hi = min(position + len(new), offset + len(chunk))
+                    chunk[lo-offset:hi-offset] = new[lo-position:hi-position]
+                chunk = str(chunk)
+
+            destination.write(chunk)
+            if stats is not None:
+                stats.count("writes")
+                stats.count("bytes_written", len(chunk))
+
+            offset += len(chunk)
+            start += len(chunk)
+
+    destination.flush()